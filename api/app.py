@@ -1,18 +1,41 @@
 # Import required FastAPI components for building the API
 import sys
-from fastapi import FastAPI, HTTPException, Depends, status
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 # Import database and models
-from database import get_db, create_tables
-from models import User, UserAPIKey
-from schemas import UserCreate, UserLogin, UserResponse, Token, APIKeyCreate, APIKeyResponse, ChatRequest
-from auth import verify_password, get_password_hash, create_access_token, verify_token, encrypt_api_key, decrypt_api_key
-# Import OpenAI client for interacting with OpenAI's API
-from openai import OpenAI
+from database import get_db, run_db, dispose_engines
+from migrations import run_migrations
+from models import User, UserAPIKey, Conversation
+from schemas import UserCreate, UserLogin, UserResponse, Token, RefreshRequest, LogoutRequest, APIKeyCreate, APIKeyResponse, APIKeyHealth, ChatRequest, BatchChatItem, BatchChatRequest
+from schemas import ConversationCreate, ConversationResponse, ConversationMessageCreate, MessageResponse, UsageResponse
+from auth import ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN, create_access_token, create_refresh_token, revoke_token, verify_token, encrypt_api_key, decrypt_api_key
+from token_cache import revoked_tokens, token_cache
+# Import the async streaming engine for interacting with OpenAI's API
+from history import append_user_turn, create_conversation, delete_message, load_messages, record_reply
+from streaming import StreamSummary, build_messages, stream_counters
+from resilience import resilience_counters, resilient_chat_completion
+from circuit_breaker import BREAKER_AUTO_FAILOVER, BreakerOpen, key_breakers
+from framing import MEDIA_TYPES, NDJSON, TEXT, frame_stream, stream_headers
+from batch import BATCH_MAX_ITEMS, BATCH_MAX_PARALLELISM, batch_counters, run_batch
+from resumable import RESUMABLE_RETRY_AFTER_SECONDS, resumable_streams
+from shared_state import shared_state
+from client_pool import client_pool
+from response_cache import response_cache
+from singleflight import single_flight
+from user_cache import CachedUser, cache_user, get_cached_user, user_cache
+from key_cache import CachedAPIKey, api_key_cache, cache_api_key, get_cached_api_key, invalidate_user_api_keys
+from last_used import last_used_buffer
+from metrics import METRICS_ENABLED, MetricsMiddleware, auth_duration, instrument_stream, key_decrypt_duration, render_metrics, request_started
+from usage import UsageScope, usage_accumulator, usage_summary
+from hashing import PasswordHasherBusy, password_hasher
+from scheduler import AUTHENTICATED, DEMO, SchedulerOverloaded, stream_scheduler
+from rate_limit import Lease, RateLimited, admit, client_ip, demo_ip_limiter, key_limiter, user_limiter
 import os
-from typing import Optional, AsyncGenerator, Dict, List
+import time
+from typing import Callable, Optional, AsyncGenerator, Dict, List, Tuple
 from sqlalchemy.orm import Session
 from datetime import datetime
 
@@ -21,6 +44,8 @@ DEFAULT_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
 # Security scheme for JWT tokens
 security = HTTPBearer()
+# Optional bearer auth for endpoints that also serve anonymous (demo) clients
+optional_security = HTTPBearer(auto_error=False)
 
 # Check Python version compatibility
 if sys.version_info < (3, 8):
@@ -44,13 +69,18 @@ async def startup_event():
         print(f"SECRET_KEY configured: {'Yes' if os.getenv('SECRET_KEY') else 'No'}")
         print(f"ENCRYPTION_KEY configured: {'Yes' if os.getenv('ENCRYPTION_KEY') else 'No'}")
         
-        # Create database tables
+        # Create database tables and apply pending schema migrations
         try:
-            create_tables()
+            run_migrations()
             print("Database tables created successfully")
         except Exception as db_error:
             print(f"Database error (non-critical): {db_error}")
         
+        # Start the write-behind flusher for API key last_used timestamps
+        last_used_buffer.start()
+        # Start the periodic flush of aggregated token usage
+        usage_accumulator.start()
+
         print("Startup completed successfully!")
     except Exception as e:
         print(f"Error during startup: {e}")
@@ -58,6 +88,15 @@ async def startup_event():
         print(f"Startup traceback: {traceback.format_exc()}")
         # Don't raise the error, just log it
 
+# Flush buffered writes and close pooled upstream clients on shutdown
+@app.on_event("shutdown")
+async def shutdown_event():
+    await last_used_buffer.stop()
+    await usage_accumulator.stop()
+    await client_pool.close()
+    password_hasher.shutdown()
+    await dispose_engines()
+
 # Configure CORS (Cross-Origin Resource Sharing) middleware
 # This allows the API to be accessed from different domains/origins
 app.add_middleware(
@@ -68,12 +107,18 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers in requests
 )
 
+# Time every request end to end (added last so it wraps CORS as well)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # Helper function to get current user from JWT token
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> CachedUser:
     """Get current user from JWT token"""
+    started = time.perf_counter()
+    source = "error"
     try:
         token = credentials.credentials
-        payload = verify_token(token)
+        payload = await verify_token(token)
         if payload is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -87,14 +132,20 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
                 detail="Could not validate credentials",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-        user = db.query(User).filter(User.username == username).first()
+        # Serve the user snapshot from cache to skip a DB round-trip
+        cached_user = get_cached_user(username)
+        if cached_user is not None:
+            source = "cache"
+            return cached_user
+        user = await run_db(lambda db: db.query(User.id, User.username, User.is_active).filter(User.username == username).first())
         if user is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="User not found",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-        return user
+        source = "db"
+        return cache_user(user)
     except Exception as e:
         print(f"Error in get_current_user: {e}")
         raise HTTPException(
@@ -102,62 +153,132 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
             detail="Authentication failed",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    finally:
+        auth_duration.observe(time.perf_counter() - started, source)
 
 # User authentication endpoints
 @app.post("/api/register", response_model=UserResponse)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate):
     """Register a new user"""
     try:
         # Check if user already exists
-        db_user = db.query(User).filter(User.username == user.username).first()
+        db_user = await run_db(lambda db: db.query(User.id).filter(User.username == user.username).first())
         if db_user:
             raise HTTPException(status_code=400, detail="Username already registered")
         
-        db_user = db.query(User).filter(User.email == user.email).first()
+        db_user = await run_db(lambda db: db.query(User.id).filter(User.email == user.email).first())
         if db_user:
             raise HTTPException(status_code=400, detail="Email already registered")
         
         # Create new user
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await password_hasher.hash(user.password)
         db_user = User(
             username=user.username,
             email=user.email,
             hashed_password=hashed_password
         )
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
-        return db_user
+
+        def save_user(db: Session) -> User:
+            db.add(db_user)
+            db.commit()
+            db.refresh(db_user)
+            return db_user
+
+        return await run_db(save_user)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server busy, please retry shortly", headers={"Retry-After": "1"})
     except Exception as e:
         print(f"Error in register: {e}")
         raise HTTPException(status_code=500, detail="Registration failed")
 
 @app.post("/api/login", response_model=Token)
-def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
+async def login(user_credentials: UserLogin):
     """Login user and return JWT token"""
     try:
-        user = db.query(User).filter(User.username == user_credentials.username).first()
-        if not user or not verify_password(user_credentials.password, user.hashed_password):
+        user = await run_db(lambda db: db.query(User.username, User.hashed_password).filter(User.username == user_credentials.username).first())
+        if not user or not await password_hasher.verify(user_credentials.password, user.hashed_password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
         
-        access_token = create_access_token(data={"sub": user.username})
-        return {"access_token": access_token, "token_type": "bearer"}
+        return issue_tokens(user.username)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server busy, please retry shortly", headers={"Retry-After": "1"})
     except Exception as e:
         print(f"Error in login: {e}")
         raise HTTPException(status_code=500, detail="Login failed")
 
+# Helper that issues an access / refresh token pair for a user
+def issue_tokens(username: str) -> Dict[str, object]:
+    return {
+        "access_token": create_access_token(data={"sub": username}),
+        "refresh_token": create_refresh_token(data={"sub": username}),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+@app.post("/api/token/refresh", response_model=Token)
+async def refresh_tokens(refresh_request: RefreshRequest):
+    """Exchange a refresh token for a new token pair without re-checking the password"""
+    payload = await verify_token(refresh_request.refresh_token, REFRESH_TOKEN)
+    if payload is None or payload.get("sub") is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    username = payload["sub"]
+    user = get_cached_user(username)
+    if user is None:
+        user = await run_db(lambda db: db.query(User.id, User.username, User.is_active).filter(User.username == username).first())
+        if user is not None:
+            user = cache_user(user)
+    if user is None or not user.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User not found",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    # Rotate: each refresh token can be used once
+    if not await revoke_token(payload):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return issue_tokens(username)
+
+@app.post("/api/logout")
+async def logout(logout_request: Optional[LogoutRequest] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Revoke the current access token and, when given, the session's refresh token"""
+    payload = await verify_token(credentials.credentials)
+    if payload is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    await revoke_token(payload)
+    if logout_request is not None and logout_request.refresh_token:
+        refresh_payload = await verify_token(logout_request.refresh_token, REFRESH_TOKEN)
+        if refresh_payload is not None and refresh_payload.get("sub") == payload.get("sub"):
+            await revoke_token(refresh_payload)
+    return {"message": "Logged out successfully"}
+
 @app.get("/api/me", response_model=UserResponse)
-def get_current_user_info(current_user: User = Depends(get_current_user)):
+def get_current_user_info(current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
     """Get current user information"""
-    return current_user
+    # The cached snapshot only carries hot-path fields, so load the full row here
+    user = db.query(User).filter(User.id == current_user.id).first()
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
 
 # API key management endpoints
 @app.post("/api/api-keys", response_model=APIKeyResponse)
-def create_api_key(api_key_data: APIKeyCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def create_api_key(api_key_data: APIKeyCreate, current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
     """Create a new API key for the current user"""
     try:
         encrypted_key = encrypt_api_key(api_key_data.api_key)
@@ -169,109 +290,268 @@ def create_api_key(api_key_data: APIKeyCreate, current_user: User = Depends(get_
         db.add(db_api_key)
         db.commit()
         db.refresh(db_api_key)
+        invalidate_user_api_keys(current_user.id)
         return db_api_key
     except Exception as e:
         print(f"Error in create_api_key: {e}")
         raise HTTPException(status_code=500, detail="Failed to create API key")
 
 @app.get("/api/api-keys", response_model=List[APIKeyResponse])
-def get_user_api_keys(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_user_api_keys(current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
     """Get all API keys for the current user"""
     try:
-        api_keys = db.query(UserAPIKey).filter(UserAPIKey.user_id == current_user.id).all()
-        return api_keys
+        # Load only the listed columns; the encrypted key never leaves the DB here
+        api_keys = db.query(
+            UserAPIKey.id,
+            UserAPIKey.key_name,
+            UserAPIKey.is_active,
+            UserAPIKey.created_at,
+            UserAPIKey.last_used
+        ).filter(UserAPIKey.user_id == current_user.id).all()
+        # Overlay last_used timestamps that are still waiting to be flushed
+        responses = []
+        for api_key in api_keys:
+            response = APIKeyResponse.model_validate(api_key)
+            pending = last_used_buffer.pending(api_key.id)
+            if pending is not None:
+                response.last_used = pending
+            response.health = APIKeyHealth(**key_breakers.health(api_key.id))
+            responses.append(response)
+        return responses
     except Exception as e:
         print(f"Error in get_user_api_keys: {e}")
         raise HTTPException(status_code=500, detail="Failed to get API keys")
 
 @app.delete("/api/api-keys/{key_id}")
-def delete_api_key(key_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def delete_api_key(key_id: int, current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
     """Delete an API key for the current user"""
     try:
-        api_key = db.query(UserAPIKey).filter(
+        deleted = db.query(UserAPIKey).filter(
             UserAPIKey.id == key_id,
             UserAPIKey.user_id == current_user.id
-        ).first()
-        if not api_key:
+        ).delete(synchronize_session=False)
+        if not deleted:
             raise HTTPException(status_code=404, detail="API key not found")
         
-        db.delete(api_key)
         db.commit()
+        invalidate_user_api_keys(current_user.id)
+        last_used_buffer.discard(key_id)
         return {"message": "API key deleted successfully"}
     except Exception as e:
         print(f"Error in delete_api_key: {e}")
         raise HTTPException(status_code=500, detail="Failed to delete API key")
 
+# Helper to resolve a user's stored API key, serving repeats from the key cache
+async def resolve_user_api_key(user_id: int, api_key_id: Optional[int]) -> Optional[CachedAPIKey]:
+    """Look up and decrypt a user's active API key (the default one when api_key_id is None)"""
+    cached_key = get_cached_api_key(user_id, api_key_id)
+    if cached_key is not None:
+        return cached_key
+
+    def load_key(db: Session):
+        query = db.query(UserAPIKey.id, UserAPIKey.key_name, UserAPIKey.encrypted_api_key).filter(
+            UserAPIKey.user_id == user_id,
+            UserAPIKey.is_active == True
+        )
+        if api_key_id:
+            query = query.filter(UserAPIKey.id == api_key_id)
+        return query.first()
+
+    user_api_key = await run_db(load_key)
+    if not user_api_key:
+        return None
+    decrypt_started = time.perf_counter()
+    api_key = decrypt_api_key(user_api_key.encrypted_api_key)
+    key_decrypt_duration.observe(time.perf_counter() - decrypt_started)
+    if api_key == "invalid-key":
+        raise HTTPException(status_code=500, detail="API key decryption failed. Please re-add your API key.")
+    return cache_api_key(user_id, api_key_id, user_api_key.id, user_api_key.key_name, api_key)
+
+# Helper that builds the response stream shared by the chat endpoints
+def open_chat_stream(api_key: str, model: str, messages: List[Dict[str, str]], http_request: Request,
+                     temperature: Optional[float] = None, bypass_cache: bool = False,
+                     usage_scope: Optional[UsageScope] = None, summary: Optional[StreamSummary] = None) -> AsyncGenerator[str, None]:
+    """Stream a completion, replaying cached answers and coalescing identical deterministic requests"""
+    params = {"temperature": temperature} if temperature is not None else {}
+    cache_key = response_cache.key_for(model, messages, params, bypass=bypass_cache)
+
+    if temperature == 0:
+        # Deterministic requests can share one upstream stream
+        flight_key = single_flight.key_for(api_key, model, messages, params, usage_scope)
+        return single_flight.stream(flight_key, lambda flight_summary: resilient_chat_completion(
+            api_key, model, messages, None, cache_key, params, usage_scope, flight_summary), summary)
+    # The key's circuit breaker is fed with the outcome of the upstream call
+    return resilient_chat_completion(api_key, model, messages, http_request, cache_key, params, usage_scope, summary)
+
+# Helper that maps a rate limit key scope to the usage accounting scope
+def usage_scope_for(user_id: int, key_scope: object) -> UsageScope:
+    return UsageScope(user_id, breaker_id_for(key_scope))
+
+# Helper that maps a rate limit key scope to its circuit breaker (0 is the default key)
+def breaker_id_for(key_scope: object) -> int:
+    return key_scope if isinstance(key_scope, int) else 0
+
+# Helper that picks a healthy API key for an authenticated chat request
+async def resolve_chat_api_key(request, current_user: CachedUser) -> Tuple[str, object]:
+    """Return (api_key, rate limit scope), failing fast (or failing over) when the key's breaker is open"""
+    api_key, key_scope = await select_chat_api_key(request, current_user)
+    breaker_id = breaker_id_for(key_scope)
+    if key_breakers.allow(breaker_id):
+        return api_key, key_scope
+    if BREAKER_AUTO_FAILOVER and breaker_id:
+        fallback_key = await failover_api_key(current_user.id, breaker_id)
+        if fallback_key is not None:
+            last_used_buffer.record(fallback_key.id)
+            print(f"API key {breaker_id} is unhealthy, failing over to: {fallback_key.key_name}")
+            return fallback_key.api_key, fallback_key.id
+    raise key_breakers.rejection(breaker_id)
+
+# Helper that finds another active key of the user whose breaker lets requests through
+async def failover_api_key(user_id: int, failed_key_id: int) -> Optional[CachedAPIKey]:
+    key_ids = await run_db(lambda db: [row.id for row in db.query(UserAPIKey.id).filter(
+        UserAPIKey.user_id == user_id,
+        UserAPIKey.is_active == True,
+        UserAPIKey.id != failed_key_id
+    ).order_by(UserAPIKey.id)])
+    for key_id in key_ids:
+        if key_breakers.allow(key_id):
+            return await resolve_user_api_key(user_id, key_id)
+    return None
+
+# Helper that picks the API key for an authenticated chat request
+async def select_chat_api_key(request, current_user: CachedUser) -> Tuple[str, object]:
+    """Return (api_key, rate limit scope) for a request's demo mode / api_key_id choice"""
+    if request.use_demo_mode:
+        # Use demo mode with default API key
+        if not DEFAULT_API_KEY:
+            raise HTTPException(status_code=500, detail="Demo mode not available - no default API key configured")
+        print("Using demo mode with default API key")
+        return DEFAULT_API_KEY, "default"
+    if request.api_key_id:
+        # Use user's stored API key
+        user_api_key = await resolve_user_api_key(current_user.id, request.api_key_id)
+        if not user_api_key:
+            raise HTTPException(status_code=404, detail="API key not found or not accessible")
+        # Record last used timestamp (written in batches by last_used_buffer)
+        last_used_buffer.record(user_api_key.id)
+        print(f"Using user's stored API key: {user_api_key.key_name}")
+        return user_api_key.api_key, user_api_key.id
+    # Try to use user's default API key
+    default_key = await resolve_user_api_key(current_user.id, None)
+    if default_key:
+        last_used_buffer.record(default_key.id)
+        print(f"Using user's default API key: {default_key.key_name}")
+        return default_key.api_key, default_key.id
+    if DEFAULT_API_KEY:
+        print("No user API key found, using default API key")
+        return DEFAULT_API_KEY, "default"
+    raise HTTPException(status_code=400, detail="No API key available. Please add an API key in settings or use demo mode.")
+
+# Helper that turns an open key breaker into a 503 response
+def breaker_open_response(e: BreakerOpen) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+# Helper that turns a rate limit rejection into a 429 response
+def rate_limited_response(e: RateLimited) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+# Helper that admits a chat request through the rate limits and the stream scheduler
+async def admit_stream(traffic_class: Optional[str], *checks: tuple, breaker_id: Optional[int] = None, streams: int = 1) -> Lease:
+    """Acquire the limits for streams and a scheduler slot; a rejection frees any probe claimed on breaker_id
+
+    Without a traffic_class no scheduler slot is taken; the caller schedules each stream itself.
+    """
+    try:
+        lease = await admit(*checks, streams=streams)
+        try:
+            if traffic_class is not None:
+                await stream_scheduler.acquire(traffic_class, lease)
+        except BaseException:
+            lease.release()
+            raise
+    except BaseException:
+        if breaker_id is not None:
+            key_breakers.release_probe(breaker_id)
+        raise
+    return lease
+
+# Helper that hands back an admission when the response could not be built
+def release_admission(lease: Lease, breaker_id: Optional[int]) -> None:
+    lease.release()
+    if breaker_id is not None:
+        key_breakers.release_probe(breaker_id)
+
+# Helper that turns a shed or timed out request into a 503 response
+def overloaded_response(e: SchedulerOverloaded) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+# Helper that rejects resumable requests for the unframed text format or while the replay buffers are full
+def check_resumable(request) -> None:
+    if request.resumable and request.stream_format == TEXT:
+        raise HTTPException(status_code=400, detail="Resumable streams require stream_format 'sse' or 'ndjson'")
+    if request.resumable and not resumable_streams.has_room():
+        raise resumable_full_response()
+
+# Helper that refuses a resumable request rather than silently serving a plain stream
+def resumable_full_response() -> HTTPException:
+    return HTTPException(status_code=503, detail="Resumable stream buffers are full",
+                         headers={"Retry-After": str(RESUMABLE_RETRY_AFTER_SECONDS)})
+
+# Helper that holds admission slots until the response stream finishes
+def limited_stream_response(generate: AsyncGenerator[str, None], lease: Lease, http_request: Request, endpoint: str,
+                            stream_format: str = TEXT, summary: Optional[StreamSummary] = None,
+                            resumable: bool = False, owner: Optional[int] = None) -> StreamingResponse:
+    if stream_format != TEXT:
+        generate = frame_stream(generate, stream_format, summary)
+    if resumable:
+        # Generation runs in its own task and releases the lease when it ends
+        stream = resumable_streams.start(generate, owner, stream_format, lease.release)
+        if stream is None:
+            # Filled up since check_resumable; the caller releases the lease
+            raise resumable_full_response()
+        generate = instrument_stream(resumable_streams.subscribe(stream), endpoint, request_started(http_request))
+        return StreamingResponse(generate, media_type=MEDIA_TYPES[stream_format],
+                                 headers={**stream_headers(stream_format), "X-Stream-Id": stream.id})
+    # The background task covers streams that are abandoned before they start
+    generate = instrument_stream(generate, endpoint, request_started(http_request), lease.release)
+    return StreamingResponse(generate, media_type=MEDIA_TYPES[stream_format],
+                             headers=stream_headers(stream_format), background=BackgroundTask(lease.release))
+
 # Define the main chat endpoint that handles POST requests
 @app.post("/api/chat")
-async def chat(request: ChatRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)) -> StreamingResponse:
+async def chat(request: ChatRequest, http_request: Request, current_user: CachedUser = Depends(get_current_user)) -> StreamingResponse:
+    check_resumable(request)
     try:
         # Determine which API key to use
-        if request.use_demo_mode:
-            # Use demo mode with default API key
-            if not DEFAULT_API_KEY:
-                raise HTTPException(status_code=500, detail="Demo mode not available - no default API key configured")
-            api_key_to_use = DEFAULT_API_KEY
-            print("Using demo mode with default API key")
-        elif request.api_key_id:
-            # Use user's stored API key
-            user_api_key = db.query(UserAPIKey).filter(
-                UserAPIKey.id == request.api_key_id,
-                UserAPIKey.user_id == current_user.id,
-                UserAPIKey.is_active == True
-            ).first()
-            if not user_api_key:
-                raise HTTPException(status_code=404, detail="API key not found or not accessible")
-            
-            api_key_to_use = decrypt_api_key(user_api_key.encrypted_api_key)
-            if api_key_to_use == "invalid-key":
-                raise HTTPException(status_code=500, detail="API key decryption failed. Please re-add your API key.")
-            # Update last used timestamp
-            user_api_key.last_used = datetime.utcnow()
-            db.commit()
-            print(f"Using user's stored API key: {user_api_key.key_name}")
-        else:
-            # Try to use user's default API key
-            default_key = db.query(UserAPIKey).filter(
-                UserAPIKey.user_id == current_user.id,
-                UserAPIKey.is_active == True
-            ).first()
-            if default_key:
-                api_key_to_use = decrypt_api_key(default_key.encrypted_api_key)
-                if api_key_to_use == "invalid-key":
-                    raise HTTPException(status_code=500, detail="API key decryption failed. Please re-add your API key.")
-                default_key.last_used = datetime.utcnow()
-                db.commit()
-                print(f"Using user's default API key: {default_key.key_name}")
-            elif DEFAULT_API_KEY:
-                api_key_to_use = DEFAULT_API_KEY
-                print("No user API key found, using default API key")
-            else:
-                raise HTTPException(status_code=400, detail="No API key available. Please add an API key in settings or use demo mode.")
-        
-        # Initialize OpenAI client with the determined API key
-        client = OpenAI(api_key=api_key_to_use)
-        
-        # Create an async generator function for streaming responses
-        async def generate() -> AsyncGenerator[str, None]:
-            # Create a streaming chat completion request
-            stream = client.chat.completions.create(
-                model=request.model,
-                messages=[
-                    {"role": "system", "content": request.developer_message},
-                    {"role": "user", "content": request.user_message}
-                ],
-                stream=True  # Enable streaming response
-            )
-            
-            # Yield each chunk of the response as it becomes available
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
-
-        # Return a streaming response to the client
-        return StreamingResponse(generate(), media_type="text/plain")
+        api_key_to_use, key_scope = await resolve_chat_api_key(request, current_user)
+
+        # Admit the request against the user's and the key's limits
+        breaker_id = breaker_id_for(key_scope)
+        lease = await admit_stream(AUTHENTICATED, (user_limiter, current_user.id), (key_limiter, key_scope),
+                                   breaker_id=breaker_id)
+        try:
+            # Stream the completion through the shared async engine
+            messages = build_messages(request.developer_message, request.user_message)
+            summary = StreamSummary() if request.stream_format != TEXT else None
+            # Resumable generations must outlive the client connection
+            generate = open_chat_stream(api_key_to_use, request.model, messages, None if request.resumable else http_request,
+                                        request.temperature, request.bypass_cache, usage_scope_for(current_user.id, key_scope), summary)
+
+            # Return a streaming response to the client
+            return limited_stream_response(generate, lease, http_request, "chat", request.stream_format, summary,
+                                           request.resumable, current_user.id)
+        except BaseException:
+            release_admission(lease, breaker_id)
+            raise
     
+    except HTTPException:
+        raise
+    except BreakerOpen as e:
+        raise breaker_open_response(e)
+    except RateLimited as e:
+        raise rate_limited_response(e)
+    except SchedulerOverloaded as e:
+        raise overloaded_response(e)
     except Exception as e:
         # Handle any errors that occur during processing
         print(f"Error in chat endpoint: {str(e)}")
@@ -280,9 +560,167 @@ async def chat(request: ChatRequest, current_user: User = Depends(get_current_us
         print(f"Full traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Batch chat endpoint that fans many prompts out over one request
+@app.post("/api/chat/batch")
+async def chat_batch(request: BatchChatRequest, http_request: Request, current_user: CachedUser = Depends(get_current_user)) -> StreamingResponse:
+    """Run a batch of prompts concurrently and stream one NDJSON result per item in completion order"""
+    if not request.items:
+        raise HTTPException(status_code=400, detail="Batch has no items")
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    try:
+        # Hold one concurrency slot per parallel worker, within the per-user and per-key caps
+        api_key_to_use, key_scope = await resolve_chat_api_key(request, current_user)
+        parallelism = min(request.parallelism or BATCH_MAX_PARALLELISM, BATCH_MAX_PARALLELISM, len(request.items))
+        for limiter in (user_limiter, key_limiter):
+            if limiter.max_concurrent:
+                parallelism = min(parallelism, limiter.max_concurrent)
+        parallelism = max(1, parallelism)
+        # Admission charges the first item; every further item takes its own token,
+        # waiting for the buckets to refill so a large batch is paced, not rejected.
+        # Scheduler slots are taken per item, so a batch never holds idle ones.
+        breaker_id = breaker_id_for(key_scope)
+        lease = await admit_stream(None, (user_limiter, current_user.id), (key_limiter, key_scope),
+                                   breaker_id=breaker_id, streams=parallelism)
+        try:
+            usage_scope = usage_scope_for(current_user.id, key_scope)
+            prepaid = 1
+
+            async def admit_item(item: BatchChatItem) -> Callable[[], None]:
+                nonlocal prepaid
+                if prepaid:
+                    prepaid -= 1
+                else:
+                    await user_limiter.throttle(current_user.id)
+                    await key_limiter.throttle(key_scope)
+                # Queue for a slot like any single chat request
+                item_lease = Lease()
+                await stream_scheduler.acquire(AUTHENTICATED, item_lease)
+                return item_lease.release
+
+            async def run_item(item: BatchChatItem) -> dict:
+                summary = StreamSummary()
+                messages = build_messages(item.developer_message, item.user_message)
+                chunks = [chunk async for chunk in open_chat_stream(api_key_to_use, item.model, messages, None, item.temperature,
+                                                                   item.bypass_cache, usage_scope, summary)]
+                return {"content": "".join(chunks), **summary.as_dict()}
+
+            generate = run_batch(request.items, run_item, parallelism, [item.id for item in request.items], admit_item=admit_item)
+            generate = instrument_stream(generate, "chat_batch", request_started(http_request), lease.release)
+            return StreamingResponse(generate, media_type=MEDIA_TYPES[NDJSON],
+                                     background=BackgroundTask(lease.release))
+        except BaseException:
+            release_admission(lease, breaker_id)
+            raise
+
+    except HTTPException:
+        raise
+    except BreakerOpen as e:
+        raise breaker_open_response(e)
+    except RateLimited as e:
+        raise rate_limited_response(e)
+    except SchedulerOverloaded as e:
+        raise overloaded_response(e)
+    except Exception as e:
+        print(f"Error in chat_batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Conversation history endpoints
+@app.post("/api/conversations", response_model=ConversationResponse)
+def start_conversation(conversation_data: ConversationCreate, current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Start a conversation whose history is kept on the server"""
+    try:
+        return create_conversation(db, current_user.id, conversation_data.title, conversation_data.model, conversation_data.developer_message)
+    except Exception as e:
+        print(f"Error in start_conversation: {e}")
+        raise HTTPException(status_code=500, detail="Failed to create conversation")
+
+@app.get("/api/conversations", response_model=List[ConversationResponse])
+def list_conversations(current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """List the current user's conversations, most recently active first"""
+    return db.query(
+        Conversation.id,
+        Conversation.title,
+        Conversation.model,
+        Conversation.created_at,
+        Conversation.updated_at
+    ).filter(Conversation.user_id == current_user.id).order_by(Conversation.updated_at.desc()).all()
+
+@app.get("/api/conversations/{conversation_id}/messages", response_model=List[MessageResponse])
+def get_conversation_messages(conversation_id: int, current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Get every stored turn of a conversation"""
+    messages = load_messages(db, current_user.id, conversation_id)
+    if messages is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return messages
+
+@app.delete("/api/conversations/{conversation_id}")
+def delete_conversation(conversation_id: int, current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Delete a conversation and its messages"""
+    deleted = db.query(Conversation).filter(
+        Conversation.id == conversation_id,
+        Conversation.user_id == current_user.id
+    ).delete(synchronize_session=False)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    db.commit()
+    return {"message": "Conversation deleted successfully"}
+
+@app.post("/api/conversations/{conversation_id}/messages")
+async def append_conversation_message(conversation_id: int, request: ConversationMessageCreate, http_request: Request,
+                                      current_user: CachedUser = Depends(get_current_user)) -> StreamingResponse:
+    """Append a user turn and stream the reply, sending the history that fits the model's context"""
+    check_resumable(request)
+    try:
+        api_key_to_use, key_scope = await resolve_chat_api_key(request, current_user)
+        breaker_id = breaker_id_for(key_scope)
+        lease = await admit_stream(AUTHENTICATED, (user_limiter, current_user.id), (key_limiter, key_scope),
+                                   breaker_id=breaker_id)
+        try:
+            # Store the turn and assemble the trimmed context in one DB round trip
+            turn = await run_db(lambda db: append_user_turn(db, current_user.id, conversation_id, request.user_message, request.model))
+            if turn is None:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            user_message_id, model, messages = turn
+            try:
+                summary = StreamSummary() if request.stream_format != TEXT else None
+                generate = open_chat_stream(api_key_to_use, model, messages, None if request.resumable else http_request,
+                                            request.temperature, request.bypass_cache, usage_scope_for(current_user.id, key_scope), summary)
+                return limited_stream_response(record_reply(generate, conversation_id, model, user_message_id), lease, http_request,
+                                               "conversation", request.stream_format, summary, request.resumable, current_user.id)
+            except BaseException:
+                # No reply will be streamed, so drop the stored turn
+                await run_db(lambda db: delete_message(db, user_message_id))
+                raise
+        except BaseException:
+            release_admission(lease, breaker_id)
+            raise
+
+    except HTTPException:
+        raise
+    except BreakerOpen as e:
+        raise breaker_open_response(e)
+    except RateLimited as e:
+        raise rate_limited_response(e)
+    except SchedulerOverloaded as e:
+        raise overloaded_response(e)
+    except Exception as e:
+        print(f"Error in append_conversation_message: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Token usage endpoint backed by hourly rollups
+@app.get("/api/usage", response_model=UsageResponse)
+def get_usage(days: int = 30, current_user: CachedUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Get the current user's token usage and estimated cost per API key and model"""
+    try:
+        return usage_summary(db, current_user.id, max(1, min(days, 366)))
+    except Exception as e:
+        print(f"Error in get_usage: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get usage")
+
 # Define a health check endpoint to verify API status
 @app.get("/api/health")
-async def health_check() -> Dict[str, str]:
+async def health_check() -> Dict[str, object]:
     try:
         # Basic health check without database access
         return {
@@ -304,40 +742,104 @@ async def health_check() -> Dict[str, str]:
 async def demo_status() -> Dict[str, bool]:
     return {"demo_available": bool(DEFAULT_API_KEY)}
 
+# Define an endpoint exposing in-process cache and pool counters
+@app.get("/api/stats")
+async def stats() -> Dict[str, dict]:
+    return {
+        "client_pool": client_pool.stats(),
+        "shared_state": shared_state.stats(),
+        "streams": stream_counters.stats(),
+        "resilience": resilience_counters.stats(),
+        "key_breakers": key_breakers.stats(),
+        "user_cache": user_cache.stats(),
+        "token_cache": token_cache.stats(),
+        "revoked_tokens": revoked_tokens.stats(),
+        "api_key_cache": api_key_cache.stats(),
+        "last_used_buffer": last_used_buffer.stats(),
+        "usage": usage_accumulator.stats(),
+        "password_hasher": password_hasher.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "scheduler": stream_scheduler.stats(),
+        "resumable_streams": resumable_streams.stats(),
+        "batches": batch_counters.stats(),
+        "rate_limits": {
+            "user": user_limiter.stats(),
+            "api_key": key_limiter.stats(),
+            "client_ip": demo_ip_limiter.stats(),
+        },
+    }
+
+# Reconnect endpoint for resumable chat streams
+@app.get("/api/streams/{stream_id}")
+async def resume_stream(stream_id: str, http_request: Request, last_seq: Optional[int] = None,
+                        last_event_id: Optional[str] = Header(None),
+                        credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> StreamingResponse:
+    """Replay the events after last_seq (or the SSE Last-Event-ID header) and follow the stream to its end"""
+    stream = await resumable_streams.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    if stream.owner is not None:
+        # Streams started by a signed-in user can only be resumed by that user
+        if credentials is None:
+            raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+        current_user = await get_current_user(credentials)
+        if current_user.id != stream.owner:
+            raise HTTPException(status_code=404, detail="Stream not found or expired")
+    if last_seq is None:
+        try:
+            last_seq = int(last_event_id) if last_event_id is not None else -1
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID must be an event sequence number")
+    if not await resumable_streams.can_resume(stream, last_seq):
+        raise HTTPException(status_code=410, detail="Events after last_seq are no longer buffered")
+    generate = instrument_stream(resumable_streams.subscribe(stream, last_seq), "resume", request_started(http_request))
+    return StreamingResponse(generate, media_type=MEDIA_TYPES[stream.format],
+                             headers={**stream_headers(stream.format), "X-Stream-Id": stream.id})
+
+# Prometheus scrape endpoint for the latency histograms
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 # Demo mode chat endpoint (no authentication required)
 @app.post("/api/chat-demo")
-async def chat_demo(request: ChatRequest) -> StreamingResponse:
+async def chat_demo(request: ChatRequest, http_request: Request) -> StreamingResponse:
     """Chat endpoint for demo mode (no authentication required)"""
     if not request.use_demo_mode:
         raise HTTPException(status_code=400, detail="Demo mode must be enabled for this endpoint")
     
     if not DEFAULT_API_KEY:
         raise HTTPException(status_code=500, detail="Demo mode not available - no default API key configured")
-    
+
+    check_resumable(request)
     try:
-        # Initialize OpenAI client with the default API key
-        client = OpenAI(api_key=DEFAULT_API_KEY)
-        
-        # Create an async generator function for streaming responses
-        async def generate() -> AsyncGenerator[str, None]:
-            # Create a streaming chat completion request
-            stream = client.chat.completions.create(
-                model=request.model,
-                messages=[
-                    {"role": "system", "content": request.developer_message},
-                    {"role": "user", "content": request.user_message}
-                ],
-                stream=True  # Enable streaming response
-            )
-            
-            # Yield each chunk of the response as it becomes available
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    yield chunk.choices[0].delta.content
-
-        # Return a streaming response to the client
-        return StreamingResponse(generate(), media_type="text/plain")
+        # Anonymous traffic is limited per client IP and against the shared key
+        key_breakers.check(0)
+        lease = await admit_stream(DEMO, (demo_ip_limiter, client_ip(http_request)), (key_limiter, "default"), breaker_id=0)
+        try:
+            # Stream the completion through the shared async engine
+            messages = build_messages(request.developer_message, request.user_message)
+            summary = StreamSummary() if request.stream_format != TEXT else None
+            generate = open_chat_stream(DEFAULT_API_KEY, request.model, messages, None if request.resumable else http_request,
+                                        request.temperature, request.bypass_cache, UsageScope(0, 0), summary)
+
+            # Return a streaming response to the client
+            return limited_stream_response(generate, lease, http_request, "chat_demo", request.stream_format, summary, request.resumable)
+        except BaseException:
+            release_admission(lease, 0)
+            raise
     
+    except HTTPException:
+        raise
+    except BreakerOpen as e:
+        raise breaker_open_response(e)
+    except RateLimited as e:
+        raise rate_limited_response(e)
+    except SchedulerOverloaded as e:
+        raise overloaded_response(e)
     except Exception as e:
         # Handle any errors that occur during processing
         print(f"Error in chat_demo endpoint: {str(e)}")
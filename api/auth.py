@@ -1,23 +1,35 @@
 # Authentication utilities for password hashing, JWT tokens, and API key encryption
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+# passlib, jose and cryptography are imported on first use to keep cold starts fast
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional
 import os
-from cryptography.fernet import Fernet
+import secrets
 import base64
+from token_cache import cache_claims, get_cached_claims, revoked_tokens
 
-# Password hashing configuration
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing configuration (bcrypt work factor is tunable per deployment)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    """Build the bcrypt context on first use"""
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 # JWT configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
+# Refresh tokens renew sessions without re-running bcrypt
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
+ACCESS_TOKEN = "access"
+REFRESH_TOKEN = "refresh"
 
 # API key encryption - ensure we have a stable key
 def get_encryption_key():
     """Get or generate a stable encryption key"""
+    from cryptography.fernet import Fernet
     encryption_key = os.getenv("ENCRYPTION_KEY")
     if not encryption_key:
         # Generate a new key and log a warning
@@ -40,43 +52,69 @@ def get_encryption_key():
     
     return encryption_key
 
-# Initialize encryption key and cipher suite
-ENCRYPTION_KEY = get_encryption_key()
+# The encryption key and cipher suite are initialized on first use
 cipher_suite = None
 
 def get_cipher_suite():
     """Get the cipher suite, initializing it if needed"""
     global cipher_suite
     if cipher_suite is None:
-        cipher_suite = Fernet(ENCRYPTION_KEY)
+        from cryptography.fernet import Fernet
+        cipher_suite = Fernet(get_encryption_key())
     return cipher_suite
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
     """Hash a password"""
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None, token_type: str = ACCESS_TOKEN):
     """Create a JWT access token"""
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    # A unique id lets a single token be revoked
+    to_encode.update({"exp": expire, "jti": secrets.token_urlsafe(12), "type": token_type})
+    from jose import jwt
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str) -> Optional[dict]:
-    """Verify and decode a JWT token"""
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+def create_refresh_token(data: dict):
+    """Create a long-lived JWT refresh token"""
+    return create_access_token(data, timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS), REFRESH_TOKEN)
+
+def decode_token(token: str, token_type: str = ACCESS_TOKEN) -> Optional[dict]:
+    """Verify and decode a JWT token, serving repeats from the verified-token cache"""
+    payload = get_cached_claims(token)
+    if payload is None:
+        from jose import JWTError, jwt
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            return None
+        cache_claims(token, payload)
+    # Tokens issued before token types existed are access tokens
+    if payload.get("type", ACCESS_TOKEN) != token_type:
         return None
+    return payload
+
+async def verify_token(token: str, token_type: str = ACCESS_TOKEN) -> Optional[dict]:
+    """Decode a JWT token and reject it if any worker has revoked it"""
+    payload = decode_token(token, token_type)
+    if payload is None or await revoked_tokens.is_revoked(payload.get("jti")):
+        return None
+    return payload
+
+async def revoke_token(payload: dict) -> bool:
+    """Revoke a verified token until it expires; False if it was already revoked"""
+    if payload.get("jti") is None:
+        return True
+    return await revoked_tokens.revoke(payload["jti"], payload["exp"])
 
 def encrypt_api_key(api_key: str) -> str:
     """Encrypt an API key for secure storage"""
@@ -0,0 +1,96 @@
+# Concurrent fan-out of batched chat requests streamed back as NDJSON
+import asyncio
+import os
+import time
+from typing import AsyncGenerator, Awaitable, Callable, List, Optional, Sequence, Tuple, TypeVar
+from framing import ndjson_event
+
+# Items per batch request and upper bound on the per-batch parallelism
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", "8"))
+# Seconds one item may take before it is reported as failed (0 disables)
+BATCH_ITEM_TIMEOUT_SECONDS = float(os.getenv("BATCH_ITEM_TIMEOUT_SECONDS", "120"))
+
+Item = TypeVar("Item")
+
+
+class BatchCounters:
+    """Counters for batches and their items"""
+
+    def __init__(self):
+        self.batches = 0
+        self.items = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "items": self.items, "failed": self.failed}
+
+
+# Shared counters reported by /api/stats
+batch_counters = BatchCounters()
+
+
+async def run_batch(items: Sequence[Item], run_item: Callable[[Item], Awaitable[dict]], parallelism: int,
+                    item_ids: Optional[List[Optional[str]]] = None,
+                    item_timeout: float = BATCH_ITEM_TIMEOUT_SECONDS,
+                    admit_item: Optional[Callable[[Item], Awaitable[Optional[Callable[[], None]]]]] = None) -> AsyncGenerator[str, None]:
+    """Run items with at most parallelism in flight, yielding one NDJSON line per item as it finishes
+
+    Each line is a result or error event carrying the item's index (and id when
+    given); a final done event reports the totals. Workers pull the next item
+    as soon as they finish one, so a slow item never holds up the others, and
+    they are cancelled if the consumer goes away. admit_item is awaited before
+    an item's timeout starts (waiting for rate limits is not running too long)
+    and may return a release called once the item is done.
+    """
+    results: asyncio.Queue = asyncio.Queue()
+    next_index = 0
+    batch_counters.batches += 1
+
+    async def run_one(index: int) -> Tuple[str, dict]:
+        started = time.monotonic()
+        labels = {"index": index}
+        if item_ids is not None and item_ids[index] is not None:
+            labels["id"] = item_ids[index]
+        release = None
+        try:
+            if admit_item is not None:
+                release = await admit_item(items[index])
+                started = time.monotonic()
+            if item_timeout > 0:
+                result = await asyncio.wait_for(run_item(items[index]), item_timeout)
+            else:
+                result = await run_item(items[index])
+        except Exception as e:
+            batch_counters.failed += 1
+            error = str(e) or type(e).__name__
+            print(f"Error in batch item {index}: {error}")
+            return ("error", {**labels, "error": error, "duration_ms": int((time.monotonic() - started) * 1000)})
+        finally:
+            if release is not None:
+                release()
+        return ("result", {**labels, **result, "duration_ms": int((time.monotonic() - started) * 1000)})
+
+    async def worker() -> None:
+        nonlocal next_index
+        while next_index < len(items):
+            index = next_index
+            next_index += 1
+            await results.put(await run_one(index))
+
+    workers = [asyncio.get_running_loop().create_task(worker()) for _ in range(max(1, min(parallelism, len(items))))]
+    try:
+        succeeded = failed = 0
+        for seq in range(len(items)):
+            event, payload = await results.get()
+            if event == "result":
+                succeeded += 1
+            else:
+                failed += 1
+            batch_counters.items += 1
+            yield ndjson_event(event, {"seq": seq, **payload})
+        yield ndjson_event("done", {"seq": len(items), "succeeded": succeeded, "failed": failed})
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
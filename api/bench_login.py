@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Benchmark /api/login throughput for different bcrypt rounds and concurrency.
+
+Usage: python bench_login.py [--rounds 10,12] [--concurrency 1,8,32] [--requests 64]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from bench_streaming import start_server
+
+APP_PORT = 8103
+BASE_URL = f"http://127.0.0.1:{APP_PORT}"
+CREDENTIALS = {"username": "bench", "password": "bench-password"}
+
+
+async def run_level(concurrency: int, total: int) -> dict:
+    """Send total logins with at most concurrency in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = {}
+
+    async def one(client: httpx.AsyncClient) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(f"{BASE_URL}/api/login", json=CREDENTIALS)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=concurrency + 5)) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(client) for _ in range(total)))
+        wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "logins_per_second": total / wall,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "statuses": statuses,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", default="10,12", help="comma-separated bcrypt rounds to compare")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=64, help="logins per concurrency level")
+    args = parser.parse_args()
+
+    for rounds in [int(r) for r in args.rounds.split(",")]:
+        db_path = os.path.join(tempfile.gettempdir(), f"bench_login_{rounds}.db")
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        env = dict(os.environ, BCRYPT_ROUNDS=str(rounds), DATABASE_URL=f"sqlite:///{db_path}")
+        server = start_server("app", APP_PORT, env)
+        try:
+            httpx.post(f"{BASE_URL}/api/register", json={**CREDENTIALS, "email": "bench@example.com"}, timeout=60)
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                result = asyncio.run(run_level(concurrency, args.requests))
+                print(
+                    f"rounds={rounds:<3} concurrency={result['concurrency']:<4} "
+                    f"{result['logins_per_second']:8.1f} logins/s  "
+                    f"p50={result['p50_ms']:8.1f}ms  p95={result['p95_ms']:8.1f}ms  statuses={result['statuses']}"
+                )
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark concurrent /api/chat-demo streams against a local fake upstream.
+
+Usage: python bench_streaming.py [concurrency]
+"""
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+FAKE_PORT = 8101
+APP_PORT = 8102
+
+
+def start_server(module: str, port: int, env: dict) -> subprocess.Popen:
+    """Run a uvicorn server in a subprocess and wait until it accepts requests"""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    for _ in range(200):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"{module} did not start on port {port}")
+
+
+async def one_stream(client: httpx.AsyncClient) -> dict:
+    """Drive one chat-demo stream and time it"""
+    payload = {"developer_message": "You are a benchmark.", "user_message": "Hi", "use_demo_mode": True}
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", f"http://127.0.0.1:{APP_PORT}/api/chat-demo", json=payload) as response:
+        async for text in response.aiter_text():
+            if ttft is None and text:
+                ttft = time.perf_counter() - start
+    return {"ttft": ttft or 0.0, "total": time.perf_counter() - start}
+
+
+async def probe_latency(client: httpx.AsyncClient, stop: asyncio.Event) -> list:
+    """Measure latency of a trivial endpoint while streams are in flight"""
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.get(f"http://127.0.0.1:{APP_PORT}/")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.05)
+    return latencies
+
+
+async def run(concurrency: int, tokens: int, token_delay: float) -> None:
+    limits = httpx.Limits(max_connections=concurrency + 10, max_keepalive_connections=concurrency + 10)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_latency(client, stop))
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one_stream(client) for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+        stop.set()
+        probe_latencies = await probe
+
+    ideal = tokens * token_delay
+    ttfts = sorted(r["ttft"] for r in results)
+    totals = sorted(r["total"] for r in results)
+    print(f"Concurrent streams:     {concurrency}")
+    print(f"Ideal single stream:    {ideal:.3f}s")
+    print(f"Wall time:              {wall:.3f}s")
+    print(f"Stream time p50/max:    {statistics.median(totals):.3f}s / {totals[-1]:.3f}s")
+    print(f"TTFT p50/max:           {statistics.median(ttfts):.3f}s / {ttfts[-1]:.3f}s")
+    if probe_latencies:
+        print(f"GET / p50/max:          {statistics.median(probe_latencies) * 1000:.1f}ms / {max(probe_latencies) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    env = dict(os.environ)
+    env.setdefault("FAKE_TOKENS", "50")
+    env.setdefault("FAKE_TOKEN_DELAY", "0.01")
+    # Point the app at the fake upstream
+    env.setdefault("OPENAI_API_KEY", "sk-fake")
+    env["OPENAI_BASE_URL"] = f"http://127.0.0.1:{FAKE_PORT}/v1"
+    env.setdefault("DATABASE_URL", f"sqlite:///{tempfile.gettempdir()}/bench_chat_app.db")
+    # Every benchmark stream comes from one IP on the shared key; lift admission limits
+    for name in ("DEMO_IP_REQUESTS_PER_MINUTE", "DEMO_IP_MAX_CONCURRENT_STREAMS", "KEY_REQUESTS_PER_MINUTE", "KEY_MAX_CONCURRENT_STREAMS", "SCHEDULER_MAX_STREAMS"):
+        env.setdefault(name, "0")
+
+    servers = [start_server("fake_openai", FAKE_PORT, env), start_server("app", APP_PORT, env)]
+    try:
+        asyncio.run(run(concurrency, int(env["FAKE_TOKENS"]), float(env["FAKE_TOKEN_DELAY"])))
+    finally:
+        for server in servers:
+            server.terminate()
@@ -0,0 +1,122 @@
+# Small in-process caching primitives shared by the API
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after a TTL
+
+    With sliding=True every hit pushes the expiry forward, which turns the TTL
+    into an idle timeout. The optional on_evict callback receives (key, value)
+    whenever an entry leaves the cache for any reason. Operations are guarded
+    by a lock because sync dependencies run on the threadpool.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, on_evict: Optional[Callable[[Hashable, Any], None]] = None, sliding: bool = False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.sliding = sliding
+        self._data: "OrderedDict[Hashable, list]" = OrderedDict()  # key -> [expires_at, value]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return a live entry and mark it as most recently used"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            now = time.monotonic()
+            if entry[0] <= now:
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            if self.sliding:
+                entry[0] = now + self.ttl
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Insert or replace an entry, evicting expired and least recently used ones"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            now = time.monotonic()
+            self._data[key] = [now + (self.ttl if ttl is None else ttl), value]
+            self._purge(now)
+
+    def pop(self, key: Hashable) -> Any:
+        """Invalidate one entry, returning its value if it was cached"""
+        with self._lock:
+            if key not in self._data:
+                return None
+            return self._remove(key)
+
+    def pop_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Invalidate every entry whose key matches the predicate"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def pop_oldest(self) -> Any:
+        """Evict the least recently used entry, returning its value"""
+        with self._lock:
+            if not self._data:
+                return None
+            self.evictions += 1
+            return self._remove(next(iter(self._data)))
+
+    def purge(self) -> None:
+        """Drop entries that have expired at the LRU end of the cache"""
+        with self._lock:
+            self._purge(time.monotonic())
+
+    def clear(self) -> None:
+        """Invalidate every entry"""
+        with self._lock:
+            for key in list(self._data):
+                self._remove(key)
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters for monitoring"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def _purge(self, now: float) -> None:
+        # Expired entries at the LRU end go first, then enforce the size bound
+        while self._data:
+            key, entry = next(iter(self._data.items()))
+            if entry[0] > now and len(self._data) <= self.maxsize:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _remove(self, key: Hashable) -> Any:
+        _, value = self._data.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+        return value
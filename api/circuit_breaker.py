@@ -0,0 +1,185 @@
+# Per-API-key circuit breakers that fail fast on dead or exhausted keys
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, Optional, Tuple
+from cache import TTLCache
+
+# Consecutive transient failures (timeouts, 5xx, rate limits) that open a breaker
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+# How long a breaker stays open before a probe; auth and quota failures wait longer
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_KEY_ERROR_OPEN_SECONDS = float(os.getenv("BREAKER_KEY_ERROR_OPEN_SECONDS", "300"))
+# Window for the per-type failure counts shown in the key listing
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "600"))
+# Switch to another active key of the same user while the selected one is open
+BREAKER_AUTO_FAILOVER = os.getenv("BREAKER_AUTO_FAILOVER", "0") == "1"
+# Breakers are only kept for keys that failed recently
+BREAKER_MAX_KEYS = int(os.getenv("BREAKER_MAX_KEYS", "100000"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Failure types; auth and quota are properties of the key and open the breaker at once
+AUTH = "auth"
+QUOTA = "quota"
+RATE_LIMIT = "rate_limit"
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+SERVER = "server"
+KEY_ERRORS = (AUTH, QUOTA)
+
+
+def classify_failure(e: BaseException) -> Optional[str]:
+    """Map an upstream error to a failure type, or None when it says nothing about the key"""
+    import openai
+    if isinstance(e, openai.APITimeoutError):
+        return TIMEOUT
+    if isinstance(e, openai.APIConnectionError):
+        return CONNECTION
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code in (401, 403):
+            return AUTH
+        if e.status_code == 429:
+            return QUOTA if getattr(e, "code", None) == "insufficient_quota" else RATE_LIMIT
+        if e.status_code >= 500:
+            return SERVER
+    return None
+
+
+class BreakerOpen(Exception):
+    """Raised when a key's breaker rejects a request; retry_after is in seconds"""
+
+    def __init__(self, key_id: int, failure: Optional[str], retry_after: int):
+        super().__init__(f"API key is failing upstream ({failure}); retry in {retry_after}s or use another key")
+        self.key_id = key_id
+        self.failure = failure
+        self.retry_after = retry_after
+
+
+class _Breaker:
+    __slots__ = ("state", "consecutive", "open_until", "probe_started", "failures")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.consecutive = 0
+        self.open_until = 0.0
+        self.probe_started: Optional[float] = None
+        # (monotonic time, wall time, failure type) of recent failures
+        self.failures: Deque[Tuple[float, datetime, str]] = deque(maxlen=32)
+
+
+class KeyBreakers:
+    """Closed / open / half-open breakers keyed by API key id (0 is the shared default key)
+
+    A key-level failure (revoked key, exhausted quota) opens the breaker at once;
+    transient ones only after threshold in a row. While open, requests fail fast
+    without an upstream call. After the open period one request is let through
+    as a probe: success closes the breaker, failure reopens it. A probe that
+    never reports back frees its slot after another open period.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, open_seconds: float = BREAKER_OPEN_SECONDS,
+                 key_error_open_seconds: float = BREAKER_KEY_ERROR_OPEN_SECONDS, window_seconds: float = BREAKER_WINDOW_SECONDS,
+                 max_keys: int = BREAKER_MAX_KEYS):
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.key_error_open_seconds = key_error_open_seconds
+        self.window_seconds = window_seconds
+        self._breakers = TTLCache(max_keys, max(window_seconds, key_error_open_seconds), sliding=True)
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+        self.probes = 0
+
+    def allow(self, key_id: int) -> bool:
+        """Whether a request may use the key; in half-open state this claims the probe"""
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breakers.get(key_id)
+            if breaker is None or breaker.state == CLOSED:
+                return True
+            if breaker.state == OPEN and now >= breaker.open_until:
+                breaker.state = HALF_OPEN
+                breaker.probe_started = None
+            if breaker.state == HALF_OPEN and (breaker.probe_started is None or now - breaker.probe_started > self.open_seconds):
+                breaker.probe_started = now
+                self.probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def release_probe(self, key_id: int) -> None:
+        """Free a half-open probe claimed by a request that was rejected before calling upstream"""
+        with self._lock:
+            breaker = self._breakers.get(key_id)
+            if breaker is not None and breaker.state == HALF_OPEN:
+                breaker.probe_started = None
+
+    def check(self, key_id: int) -> None:
+        """Raise BreakerOpen unless a request may use the key"""
+        if not self.allow(key_id):
+            raise self.rejection(key_id)
+
+    def rejection(self, key_id: int) -> BreakerOpen:
+        """The error for a request the key's breaker did not allow"""
+        breaker = self._breakers.get(key_id)
+        failure = breaker.failures[-1][2] if breaker is not None and breaker.failures else None
+        retry_after = max(1, int((breaker.open_until if breaker is not None else 0) - time.monotonic()) + 1)
+        return BreakerOpen(key_id, failure, retry_after)
+
+    def record_success(self, key_id: int) -> None:
+        with self._lock:
+            breaker = self._breakers.get(key_id)
+            if breaker is not None:
+                breaker.state = CLOSED
+                breaker.consecutive = 0
+                breaker.probe_started = None
+
+    def record_failure(self, key_id: int, failure: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breakers.get(key_id)
+            if breaker is None:
+                breaker = _Breaker()
+                self._breakers.set(key_id, breaker)
+            breaker.consecutive += 1
+            breaker.failures.append((now, datetime.utcnow(), failure))
+            if breaker.state == HALF_OPEN or failure in KEY_ERRORS or breaker.consecutive >= self.threshold:
+                if breaker.state != OPEN:
+                    self.opened += 1
+                breaker.state = OPEN
+                breaker.probe_started = None
+                breaker.open_until = now + (self.key_error_open_seconds if failure in KEY_ERRORS else self.open_seconds)
+                print(f"Circuit breaker opened for API key {key_id or 'default'} after {failure} failure")
+
+    def health(self, key_id: int) -> dict:
+        """Breaker state and recent failures per type for the key listing"""
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breakers.get(key_id)
+            if breaker is None:
+                return {"state": CLOSED, "recent_failures": {}, "last_failure": None, "last_failure_at": None, "retry_after": None}
+            recent: Dict[str, int] = {}
+            for at, _, failure in breaker.failures:
+                if now - at <= self.window_seconds:
+                    recent[failure] = recent.get(failure, 0) + 1
+            last_failure = breaker.failures[-1] if breaker.failures else None
+            state = HALF_OPEN if breaker.state == OPEN and now >= breaker.open_until else breaker.state
+            return {
+                "state": state,
+                "recent_failures": recent,
+                "last_failure": last_failure[2] if last_failure else None,
+                "last_failure_at": last_failure[1] if last_failure else None,
+                "retry_after": max(1, int(breaker.open_until - now) + 1) if state == OPEN else None,
+            }
+
+    def stats(self) -> dict:
+        return {"tracked": len(self._breakers), "opened": self.opened, "rejected": self.rejected, "probes": self.probes}
+
+
+# Shared breakers consulted before every upstream call
+key_breakers = KeyBreakers()
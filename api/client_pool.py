@@ -0,0 +1,83 @@
+# Pool of reusable upstream OpenAI clients keyed by API key
+import asyncio
+import hashlib
+import os
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator
+from cache import TTLCache
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# Pool configuration
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "64"))
+CLIENT_POOL_IDLE_SECONDS = float(os.getenv("CLIENT_POOL_IDLE_SECONDS", "300"))
+# SDK-level retries; resilience.py retries with jittered backoff and model fallback instead
+CLIENT_MAX_RETRIES = int(os.getenv("CLIENT_MAX_RETRIES", "0"))
+
+
+class _PooledClient:
+    """An upstream client plus the number of streams currently using it"""
+
+    def __init__(self, client: "AsyncOpenAI"):
+        self.client = client
+        self.leases = 0
+        self.evicted = False
+
+
+class ClientPool:
+    """Bounded LRU pool of AsyncOpenAI clients with idle eviction
+
+    Each client owns an HTTP connection pool, so reusing it keeps TLS sessions
+    and keep-alive connections warm across requests. Clients evicted while a
+    stream still uses them are closed once the last lease is released.
+    """
+
+    def __init__(self, maxsize: int = CLIENT_POOL_SIZE, idle_seconds: float = CLIENT_POOL_IDLE_SECONDS):
+        self._clients = TTLCache(maxsize, idle_seconds, on_evict=self._on_evict, sliding=True)
+        self._closing = set()
+
+    @staticmethod
+    def _key(api_key: str) -> str:
+        # Keep raw API keys out of the pool's index
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    @asynccontextmanager
+    async def lease(self, api_key: str) -> AsyncIterator["AsyncOpenAI"]:
+        """Borrow the pooled client for an API key, creating it on a miss"""
+        key = self._key(api_key)
+        self._clients.purge()
+        pooled = self._clients.get(key)
+        if pooled is None:
+            # The SDK is imported on the first upstream call, not at app import
+            from openai import AsyncOpenAI
+            pooled = _PooledClient(AsyncOpenAI(api_key=api_key, max_retries=CLIENT_MAX_RETRIES))
+            self._clients.set(key, pooled)
+        pooled.leases += 1
+        try:
+            yield pooled.client
+        finally:
+            pooled.leases -= 1
+            if pooled.evicted and pooled.leases == 0:
+                await pooled.client.close()
+
+    def _on_evict(self, key: str, pooled: _PooledClient) -> None:
+        pooled.evicted = True
+        if pooled.leases == 0:
+            task = asyncio.ensure_future(pooled.client.close())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    async def close(self) -> None:
+        """Close every idle client (used on shutdown)"""
+        self._clients.clear()
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def stats(self) -> dict:
+        """Return pool hit/miss and eviction counters"""
+        return self._clients.stats()
+
+
+# Shared pool used by the streaming engine
+client_pool = ClientPool()
@@ -1,31 +1,140 @@
 # Database configuration and session management
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.declarative import declarative_base
+from starlette.concurrency import run_in_threadpool
+from typing import Callable, Optional, TypeVar
+import importlib.util
 import os
+import time
+from metrics import db_duration
 
 # Database URL - use SQLite for development, can be changed to PostgreSQL for production
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chat_app.db")
 
+# Connection pool tuning
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds before a connection is replaced
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Async drivers used when the async session path is enabled
+ASYNC_DRIVERS = {
+    "sqlite": ("sqlite+aiosqlite", "aiosqlite"),
+    "postgresql": ("postgresql+asyncpg", "asyncpg"),
+    "postgres": ("postgresql+asyncpg", "asyncpg"),
+}
+
+T = TypeVar("T")
+
+def is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+def engine_options(url: str) -> dict:
+    """Pool settings for an engine created from the given URL"""
+    options = {"pool_pre_ping": True}
+    if is_sqlite(url):
+        options["connect_args"] = {"check_same_thread": False}
+        # In-memory SQLite uses a per-thread singleton pool without overflow settings
+        if ":memory:" in url or url.rstrip("/").endswith("sqlite:"):
+            return options
+        # aiosqlite defaults to NullPool; pool its connections like the sync engine
+        if url.startswith("sqlite+aiosqlite"):
+            options["poolclass"] = AsyncAdaptedQueuePool
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+    return options
+
+def async_database_url(url: str) -> Optional[str]:
+    """Derive the async driver URL for DATABASE_URL, if its driver is installed"""
+    if os.getenv("ASYNC_DATABASE_URL"):
+        return os.getenv("ASYNC_DATABASE_URL")
+    # The async engine is opt-in; by default run_db uses the threadpool
+    if os.getenv("DB_ASYNC", "0") != "1":
+        return None
+    scheme, _, rest = url.partition("://")
+    if scheme not in ASYNC_DRIVERS:
+        return None
+    async_scheme, driver_module = ASYNC_DRIVERS[scheme]
+    if importlib.util.find_spec(driver_module) is None:
+        return None
+    return f"{async_scheme}://{rest}"
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL mode, a busy timeout and foreign keys on every new SQLite connection"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
 # Create database engine
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
-)
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+if is_sqlite(DATABASE_URL):
+    event.listen(engine, "connect", set_sqlite_pragmas)
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Optional async engine so ORM work in async endpoints never blocks the event loop
+ASYNC_DATABASE_URL = async_database_url(DATABASE_URL)
+async_engine = None
+AsyncSessionLocal = None
+if ASYNC_DATABASE_URL:
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+    if is_sqlite(ASYNC_DATABASE_URL):
+        event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+    AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 # Create base class for models
 Base = declarative_base()
 
 def get_db():
     """Dependency to get database session"""
+    started = time.perf_counter()
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+        # The session holds its connection until closed, so time its whole lifetime
+        db_duration.observe(time.perf_counter() - started, "get_db")
+
+def _run_in_session(fn: Callable[[Session], T]) -> T:
+    db = SessionLocal()
+    try:
+        return fn(db)
+    finally:
+        db.close()
+
+async def run_db(fn: Callable[[Session], T]) -> T:
+    """Run sync ORM code from an async endpoint without blocking the event loop
+
+    Uses the async engine when an async driver is available and otherwise runs
+    the callable on the threadpool with a regular session.
+    """
+    started = time.perf_counter()
+    try:
+        if AsyncSessionLocal is not None:
+            async with AsyncSessionLocal() as session:
+                return await session.run_sync(fn)
+        return await run_in_threadpool(_run_in_session, fn)
+    finally:
+        db_duration.observe(time.perf_counter() - started, "run_db")
+
+async def dispose_engines() -> None:
+    """Close pooled connections (used on shutdown)"""
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
 
 def create_tables():
     """Create all database tables"""
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Local fake OpenAI chat-completions server for benchmarks.
+Streams OpenAI-style SSE chunks with a configurable per-token delay, chunk
+size and error rate.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Fake upstream configuration
+FAKE_TOKEN_DELAY = float(os.getenv("FAKE_TOKEN_DELAY", "0.01"))  # Seconds between tokens
+FAKE_TOKENS = int(os.getenv("FAKE_TOKENS", "50"))  # Tokens per completion
+FAKE_FIRST_TOKEN_DELAY = float(os.getenv("FAKE_FIRST_TOKEN_DELAY", "0"))  # Extra delay before the first token
+FAKE_CHUNK_CHARS = int(os.getenv("FAKE_CHUNK_CHARS", "0"))  # Pad each token to this many characters
+FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))  # Fraction of requests that fail
+FAKE_ERROR_STATUS = int(os.getenv("FAKE_ERROR_STATUS", "500"))  # Status code of failed requests
+
+app = FastAPI(title="Fake OpenAI API")
+
+
+def make_chunk(completion_id: str, model: str, content=None, finish_reason=None, usage=None) -> str:
+    """Format one chat.completion.chunk as an SSE event"""
+    delta = {"content": content} if content is not None else {}
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage is not None:
+        # Final usage chunk as sent for stream_options.include_usage
+        payload["choices"] = []
+        payload["usage"] = usage
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request) -> StreamingResponse:
+    body = await request.json()
+    model = body.get("model", "gpt-4o-mini")
+    if FAKE_ERROR_RATE and random.random() < FAKE_ERROR_RATE:
+        error = {"error": {"message": "Injected failure", "type": "server_error", "code": None}}
+        return JSONResponse(error, status_code=FAKE_ERROR_STATUS)
+    completion_id = f"chatcmpl-fake-{time.monotonic_ns()}"
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+    # Rough prompt size: ~4 characters per token
+    prompt_tokens = sum(len(message.get("content", "")) for message in body.get("messages", [])) // 4 + 1
+
+    async def generate():
+        yield make_chunk(completion_id, model, content="")
+        if FAKE_FIRST_TOKEN_DELAY:
+            await asyncio.sleep(FAKE_FIRST_TOKEN_DELAY)
+        for i in range(FAKE_TOKENS):
+            await asyncio.sleep(FAKE_TOKEN_DELAY)
+            yield make_chunk(completion_id, model, content=f"tok{i} ".ljust(FAKE_CHUNK_CHARS, "x"))
+        yield make_chunk(completion_id, model, finish_reason="stop")
+        if include_usage:
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": FAKE_TOKENS, "total_tokens": prompt_tokens + FAKE_TOKENS}
+            yield make_chunk(completion_id, model, usage=usage)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+# Entry point for running the fake server directly
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=int(os.getenv("FAKE_OPENAI_PORT", "8100")))
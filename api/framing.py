@@ -0,0 +1,112 @@
+# Structured stream framing (SSE / NDJSON) with delta coalescing
+import asyncio
+import json
+import os
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional, Tuple
+from streaming import StreamSummary
+
+# Stream formats accepted in ChatRequest.stream_format
+TEXT = "text"
+SSE = "sse"
+NDJSON = "ndjson"
+MEDIA_TYPES = {TEXT: "text/plain", SSE: "text/event-stream", NDJSON: "application/x-ndjson"}
+
+# Deltas are buffered until this many characters or this many milliseconds
+# have accumulated, whichever comes first (0 ms sends every delta at once)
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", "512"))
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "50"))
+
+
+def sse_event(event: str, payload: dict) -> str:
+    return f"id: {payload['seq']}\nevent: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+
+def ndjson_event(event: str, payload: dict) -> str:
+    return json.dumps({"type": event, **payload}, separators=(",", ":")) + "\n"
+
+
+ENCODERS: Dict[str, Callable[[str, dict], str]] = {SSE: sse_event, NDJSON: ndjson_event}
+
+
+def stream_headers(stream_format: str) -> Dict[str, str]:
+    """Extra response headers for a stream format"""
+    if stream_format == SSE:
+        # Keep proxies from buffering the event stream
+        return {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return {}
+
+
+async def _next(iterator: AsyncIterator[str]) -> Tuple[bool, Optional[str]]:
+    try:
+        return True, await iterator.__anext__()
+    except StopAsyncIteration:
+        return False, None
+
+
+async def frame_stream(stream: AsyncGenerator[str, None], stream_format: str, summary: Optional[StreamSummary] = None,
+                       coalesce_chars: int = STREAM_COALESCE_CHARS, coalesce_ms: float = STREAM_COALESCE_MS) -> AsyncGenerator[str, None]:
+    """Wrap raw deltas in numbered delta events, ending with a done or error event
+
+    Deltas that arrive within coalesce_ms of the first buffered one are merged
+    into one event (flushed early once coalesce_chars are buffered), so the
+    socket sees a few larger writes instead of one per token. A stream that
+    ends without a done event was truncated.
+    """
+    encode = ENCODERS[stream_format]
+    coalesce_seconds = coalesce_ms / 1000
+    loop = asyncio.get_running_loop()
+    seq = 0
+    buffer: List[str] = []
+    buffered = 0
+    deadline = 0.0
+    pending: Optional[asyncio.Task] = None
+
+    def flush() -> str:
+        nonlocal seq, buffered
+        event = encode("delta", {"seq": seq, "delta": "".join(buffer)})
+        seq += 1
+        buffer.clear()
+        buffered = 0
+        return event
+
+    try:
+        try:
+            while True:
+                if coalesce_seconds <= 0:
+                    more, chunk = await _next(stream)
+                else:
+                    if pending is None:
+                        pending = loop.create_task(_next(stream))
+                    if buffer:
+                        # Wait for the next delta only until the buffer is due
+                        done, _ = await asyncio.wait({pending}, timeout=max(deadline - loop.time(), 0))
+                        if not done:
+                            yield flush()
+                            continue
+                    more, chunk = await pending
+                    pending = None
+                if not more:
+                    break
+                if not buffer:
+                    deadline = loop.time() + coalesce_seconds
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if buffered >= coalesce_chars or coalesce_seconds <= 0:
+                    yield flush()
+        except Exception as e:
+            if buffer:
+                yield flush()
+            print(f"Error in framed stream: {e}")
+            yield encode("error", {"seq": seq, "error": str(e)})
+            return
+        if buffer:
+            yield flush()
+        yield encode("done", {"seq": seq, **(summary.as_dict() if summary is not None else {})})
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, Exception):
+                pass
+        await stream.aclose()
@@ -0,0 +1,175 @@
+# Conversation history: compact message storage and context assembly
+import hashlib
+import os
+import anyio
+import zlib
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from cache import TTLCache
+from database import run_db
+from models import Conversation, Message, SystemPrompt
+from tokens import MESSAGE_OVERHEAD_TOKENS, count_tokens, prompt_budget
+
+# Compress message bodies at least this large (0 disables compression)
+HISTORY_COMPRESS_MIN_BYTES = int(os.getenv("HISTORY_COMPRESS_MIN_BYTES", "256"))
+# Upper bound on the turns read when assembling context
+HISTORY_WINDOW_MAX_MESSAGES = int(os.getenv("HISTORY_WINDOW_MAX_MESSAGES", "200"))
+
+# Prompt hash -> system_prompts.id, so repeated prompts skip the lookup
+system_prompt_ids = TTLCache(maxsize=1024, ttl=3600)
+
+
+def pack_text(text: str) -> Tuple[bytes, bool]:
+    """Encode text for storage, compressing it when that saves space"""
+    raw = text.encode()
+    if HISTORY_COMPRESS_MIN_BYTES and len(raw) >= HISTORY_COMPRESS_MIN_BYTES:
+        packed = zlib.compress(raw, 6)
+        if len(packed) < len(raw):
+            return packed, True
+    return raw, False
+
+
+def unpack_text(body: bytes, compressed: bool) -> str:
+    return (zlib.decompress(body) if compressed else body).decode()
+
+
+def intern_system_prompt(db: Session, text: str, model: str) -> int:
+    """Return the id of the stored copy of a system prompt, storing it on first use"""
+    content_hash = hashlib.sha256(text.encode()).hexdigest()
+    prompt_id = system_prompt_ids.get(content_hash)
+    if prompt_id is not None:
+        return prompt_id
+    prompt_id = db.query(SystemPrompt.id).filter(SystemPrompt.content_hash == content_hash).scalar()
+    if prompt_id is None:
+        body, compressed = pack_text(text)
+        prompt = SystemPrompt(content_hash=content_hash, body=body, compressed=compressed, token_count=count_tokens(text, model))
+        db.add(prompt)
+        try:
+            db.commit()
+            prompt_id = prompt.id
+        except IntegrityError:
+            # Another request stored the same prompt first
+            db.rollback()
+            prompt_id = db.query(SystemPrompt.id).filter(SystemPrompt.content_hash == content_hash).scalar()
+    system_prompt_ids.set(content_hash, prompt_id)
+    return prompt_id
+
+
+def create_conversation(db: Session, user_id: int, title: str, model: str, developer_message: Optional[str]) -> Conversation:
+    prompt_id = intern_system_prompt(db, developer_message, model) if developer_message else None
+    conversation = Conversation(user_id=user_id, title=title, model=model, system_prompt_id=prompt_id)
+    db.add(conversation)
+    db.commit()
+    db.refresh(conversation)
+    return conversation
+
+
+def add_message(db: Session, conversation_id: int, role: str, text: str, model: str, truncated: bool = False) -> int:
+    """Store a turn and return its id"""
+    body, compressed = pack_text(text)
+    message = Message(conversation_id=conversation_id, role=role, body=body, compressed=compressed,
+                      token_count=count_tokens(text, model), truncated=truncated)
+    db.add(message)
+    db.flush()
+    message_id = message.id
+    db.execute(update(Conversation).where(Conversation.id == conversation_id).values(updated_at=func.now()))
+    db.commit()
+    return message_id
+
+
+def delete_message(db: Session, message_id: int) -> None:
+    db.query(Message).filter(Message.id == message_id).delete(synchronize_session=False)
+    db.commit()
+
+
+def assemble_context(db: Session, conversation_id: int, system_prompt_id: Optional[int], model: str) -> List[Dict[str, str]]:
+    """Build the upstream messages for a conversation within the model's prompt budget
+
+    The newest turns are kept and older ones dropped once the budget is spent;
+    token counts are stored per message, so only the kept turns are decoded.
+    The latest turn is always included.
+    """
+    budget = prompt_budget(model)
+    system = []
+    if system_prompt_id is not None:
+        prompt = db.query(SystemPrompt.body, SystemPrompt.compressed, SystemPrompt.token_count).filter(SystemPrompt.id == system_prompt_id).first()
+        if prompt is not None:
+            system = [{"role": "system", "content": unpack_text(prompt.body, prompt.compressed)}]
+            budget -= prompt.token_count + MESSAGE_OVERHEAD_TOKENS
+
+    rows = (
+        db.query(Message.role, Message.body, Message.compressed, Message.token_count)
+        .filter(Message.conversation_id == conversation_id)
+        .order_by(Message.id.desc())
+        .limit(HISTORY_WINDOW_MAX_MESSAGES)
+        .all()
+    )
+    kept = []
+    for row in rows:
+        cost = row.token_count + MESSAGE_OVERHEAD_TOKENS
+        if kept and cost > budget:
+            break
+        budget -= cost
+        kept.append(row)
+    turns = [{"role": row.role, "content": unpack_text(row.body, row.compressed)} for row in reversed(kept)]
+    return system + turns
+
+
+def append_user_turn(db: Session, user_id: int, conversation_id: int, text: str, model: Optional[str]) -> Optional[Tuple[int, str, List[Dict[str, str]]]]:
+    """Store a user turn and return (turn id, model, context messages), or None if the conversation is not the user's"""
+    conversation = (
+        db.query(Conversation.id, Conversation.model, Conversation.system_prompt_id)
+        .filter(Conversation.id == conversation_id, Conversation.user_id == user_id)
+        .first()
+    )
+    if conversation is None:
+        return None
+    model = model or conversation.model
+    message_id = add_message(db, conversation_id, "user", text, model)
+    return message_id, model, assemble_context(db, conversation_id, conversation.system_prompt_id, model)
+
+
+def load_messages(db: Session, user_id: int, conversation_id: int) -> Optional[List[dict]]:
+    """Decoded turns of a conversation, or None if it is not the user's"""
+    owned = db.query(Conversation.id).filter(Conversation.id == conversation_id, Conversation.user_id == user_id).first()
+    if owned is None:
+        return None
+    rows = (
+        db.query(Message.id, Message.role, Message.body, Message.compressed, Message.truncated, Message.created_at)
+        .filter(Message.conversation_id == conversation_id)
+        .order_by(Message.id)
+        .all()
+    )
+    return [
+        {"id": row.id, "role": row.role, "content": unpack_text(row.body, row.compressed), "truncated": row.truncated,
+         "created_at": row.created_at}
+        for row in rows
+    ]
+
+
+async def record_reply(stream: AsyncGenerator[str, None], conversation_id: int, model: str,
+                       user_message_id: int) -> AsyncGenerator[str, None]:
+    """Pass a reply stream through and store what was streamed as the assistant turn
+
+    A reply cut short by a disconnect or an upstream error is stored with its
+    truncated flag set. When nothing was streamed the unanswered user turn is
+    removed instead, so the history never holds two user turns in a row.
+    """
+    chunks = []
+    completed = False
+    try:
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        completed = True
+    finally:
+        reply = "".join(chunks)
+        # Shielded so the write still happens when the response task is cancelled
+        with anyio.CancelScope(shield=True):
+            if reply:
+                await run_db(lambda db: add_message(db, conversation_id, "assistant", reply, model, truncated=not completed))
+            else:
+                await run_db(lambda db: delete_message(db, user_message_id))
@@ -0,0 +1,48 @@
+# Short-lived cache of decrypted user API keys
+import os
+from typing import Optional
+from cache import TTLCache
+
+# API key cache configuration
+API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", "1000"))
+API_KEY_CACHE_TTL_SECONDS = float(os.getenv("API_KEY_CACHE_TTL_SECONDS", "30"))
+
+
+class CachedAPIKey:
+    """A decrypted API key held in a mutable buffer so it can be zeroed"""
+    __slots__ = ("id", "key_name", "secret")
+
+    def __init__(self, id: int, key_name: str, api_key: str):
+        self.id = id
+        self.key_name = key_name
+        self.secret = bytearray(api_key.encode())
+
+    @property
+    def api_key(self) -> str:
+        return self.secret.decode()
+
+    def wipe(self) -> None:
+        """Overwrite the key material in place"""
+        for i in range(len(self.secret)):
+            self.secret[i] = 0
+
+
+# Keys are (user_id, api_key_id); api_key_id None caches the user's default key
+api_key_cache = TTLCache(API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL_SECONDS, on_evict=lambda key, value: value.wipe())
+
+
+def get_cached_api_key(user_id: int, api_key_id: Optional[int]) -> Optional[CachedAPIKey]:
+    """Return the cached decrypted key for a user's key selection, if any"""
+    return api_key_cache.get((user_id, api_key_id))
+
+
+def cache_api_key(user_id: int, api_key_id: Optional[int], row_id: int, key_name: str, api_key: str) -> CachedAPIKey:
+    """Cache a freshly decrypted key under the user's key selection"""
+    cached_key = CachedAPIKey(row_id, key_name, api_key)
+    api_key_cache.set((user_id, api_key_id), cached_key)
+    return cached_key
+
+
+def invalidate_user_api_keys(user_id: int) -> int:
+    """Drop (and zero) every cached key belonging to a user"""
+    return api_key_cache.pop_where(lambda key: key[0] == user_id)
@@ -0,0 +1,106 @@
+# Write-behind buffer for UserAPIKey.last_used timestamps
+import asyncio
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+from sqlalchemy import bindparam, update
+from starlette.concurrency import run_in_threadpool
+from database import SessionLocal
+from models import UserAPIKey
+
+# Seconds between bulk flushes of buffered timestamps
+LAST_USED_FLUSH_SECONDS = float(os.getenv("LAST_USED_FLUSH_SECONDS", "5"))
+
+
+class LastUsedBuffer:
+    """Coalesces last-used timestamps in memory and writes them in one bulk UPDATE
+
+    Chat requests only record a timestamp here, so they no longer open a write
+    transaction before streaming. Repeated uses of the same key between flushes
+    collapse into a single row update.
+    """
+
+    def __init__(self, flush_seconds: float = LAST_USED_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self._pending: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    def record(self, api_key_id: int, when: Optional[datetime] = None) -> None:
+        """Remember that a key was used; the newest timestamp wins"""
+        when = when or datetime.utcnow()
+        with self._lock:
+            previous = self._pending.get(api_key_id)
+            if previous is None or when > previous:
+                self._pending[api_key_id] = when
+
+    def discard(self, api_key_id: int) -> None:
+        """Forget a buffered timestamp (e.g. when the key is deleted)"""
+        with self._lock:
+            self._pending.pop(api_key_id, None)
+
+    def pending(self, api_key_id: int) -> Optional[datetime]:
+        """Return a timestamp that has not been written yet, if any"""
+        with self._lock:
+            return self._pending.get(api_key_id)
+
+    def flush(self) -> int:
+        """Write all buffered timestamps in one bulk UPDATE"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        db = SessionLocal()
+        try:
+            # Core executemany UPDATE so rows deleted meanwhile are simply skipped
+            table = UserAPIKey.__table__
+            db.execute(
+                update(table).where(table.c.id == bindparam("key_id")).values(last_used=bindparam("used_at")),
+                [{"key_id": key_id, "used_at": when} for key_id, when in batch.items()],
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error flushing last_used timestamps: {e}")
+            # Put the batch back so the next flush retries it
+            for key_id, when in batch.items():
+                self.record(key_id, when)
+            return 0
+        finally:
+            db.close()
+        self.flushes += 1
+        self.rows_written += len(batch)
+        return len(batch)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await run_in_threadpool(self.flush)
+
+    def start(self) -> None:
+        """Start the periodic flush task on the running event loop"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the periodic task and write whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await run_in_threadpool(self.flush)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {"pending": pending, "flushes": self.flushes, "rows_written": self.rows_written}
+
+
+# Shared buffer used by the chat endpoint
+last_used_buffer = LastUsedBuffer()
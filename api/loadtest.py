@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Load test the API against a local fake OpenAI server and report JSON results.
+
+Starts fake_openai.py and the app, registers a user with a stored API key, then
+drives each scenario at each concurrency level and reports throughput, status
+counts, p50/p95/p99 latency and (for streams) time-to-first-token.
+
+Usage: python loadtest.py [--scenarios login,chat,chat-demo,chat-batch,api-keys]
+                          [--concurrency 1,16,64] [--requests 200]
+                          [--tokens 50] [--token-delay 0.01] [--chunk-chars 0]
+                          [--error-rate 0] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from bench_streaming import start_server
+
+FAKE_PORT = 8104
+APP_PORT = 8105
+BASE_URL = f"http://127.0.0.1:{APP_PORT}"
+CREDENTIALS = {"username": "loadtest", "password": "loadtest-password"}
+CHAT_PAYLOAD = {"developer_message": "You are a load test.", "user_message": "Hi"}
+SCENARIOS = ("login", "chat", "chat-demo", "chat-batch", "api-keys")
+# Items per request in the chat-batch scenario
+BATCH_ITEMS = 10
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    return {
+        "p50_ms": _ms(percentile(values, 0.50)),
+        "p95_ms": _ms(percentile(values, 0.95)),
+        "p99_ms": _ms(percentile(values, 0.99)),
+        "max_ms": _ms(values[-1] if values else None),
+    }
+
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return round(value * 1000, 2) if value is not None else None
+
+
+class Session:
+    """Credentials shared by the scenarios"""
+
+    def __init__(self, token: str, api_key_id: int):
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.api_key_id = api_key_id
+
+
+async def setup(client: httpx.AsyncClient) -> Session:
+    """Register the load test user and store an API key for it"""
+    await client.post(f"{BASE_URL}/api/register", json={**CREDENTIALS, "email": "loadtest@example.com"})
+    response = await client.post(f"{BASE_URL}/api/login", json=CREDENTIALS)
+    response.raise_for_status()
+    token = response.json()["access_token"]
+    response = await client.post(f"{BASE_URL}/api/api-keys", headers={"Authorization": f"Bearer {token}"},
+                                 json={"api_key": "sk-fake", "key_name": "loadtest"})
+    response.raise_for_status()
+    return Session(token, response.json()["id"])
+
+
+async def timed_request(client: httpx.AsyncClient, method: str, path: str, **kwargs) -> dict:
+    start = time.perf_counter()
+    response = await client.request(method, f"{BASE_URL}{path}", **kwargs)
+    return {"status": response.status_code, "latency": time.perf_counter() - start, "ttft": None}
+
+
+async def timed_stream(client: httpx.AsyncClient, path: str, **kwargs) -> dict:
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", f"{BASE_URL}{path}", **kwargs) as response:
+        async for text in response.aiter_text():
+            if ttft is None and text:
+                ttft = time.perf_counter() - start
+    # Upstream failures surface after the 200 headers as an empty or cut-off body
+    status = "empty_stream" if response.status_code == 200 and ttft is None else response.status_code
+    return {"status": status, "latency": time.perf_counter() - start, "ttft": ttft}
+
+
+def scenario_request(name: str, session: Session) -> Callable[[httpx.AsyncClient], Awaitable[dict]]:
+    """Return a coroutine factory issuing one request of the scenario"""
+    if name == "login":
+        return lambda client: timed_request(client, "POST", "/api/login", json=CREDENTIALS)
+    if name == "api-keys":
+        return lambda client: timed_request(client, "GET", "/api/api-keys", headers=session.headers)
+    if name == "chat":
+        payload = {**CHAT_PAYLOAD, "api_key_id": session.api_key_id}
+        return lambda client: timed_stream(client, "/api/chat", headers=session.headers, json=payload)
+    if name == "chat-demo":
+        payload = {**CHAT_PAYLOAD, "use_demo_mode": True}
+        return lambda client: timed_stream(client, "/api/chat-demo", json=payload)
+    if name == "chat-batch":
+        payload = {"items": [CHAT_PAYLOAD] * BATCH_ITEMS, "api_key_id": session.api_key_id}
+        return lambda client: timed_stream(client, "/api/chat/batch", headers=session.headers, json=payload)
+    raise ValueError(f"Unknown scenario: {name}")
+
+
+async def run_level(name: str, session: Session, concurrency: int, total: int) -> dict:
+    """Issue total requests of a scenario with at most concurrency in flight"""
+    make_request = scenario_request(name, session)
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def one(client: httpx.AsyncClient) -> None:
+        async with semaphore:
+            try:
+                results.append(await make_request(client))
+            except httpx.HTTPError as e:
+                results.append({"status": type(e).__name__, "latency": None, "ttft": None})
+
+    limits = httpx.Limits(max_connections=concurrency + 5, max_keepalive_connections=concurrency + 5)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(client) for _ in range(total)))
+        wall = time.perf_counter() - start
+
+    statuses: Dict[str, int] = {}
+    for result in results:
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+    ok = [result for result in results if result["status"] == 200]
+    report = {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": total,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 2) if wall else None,
+        "error_rate": round(1 - len(ok) / total, 4) if total else 0.0,
+        "statuses": statuses,
+        "latency": summarize([result["latency"] for result in ok]),
+    }
+    ttfts = [result["ttft"] for result in ok if result["ttft"] is not None]
+    if ttfts:
+        report["ttft"] = summarize(ttfts)
+    return report
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> List[dict]:
+    async with httpx.AsyncClient(timeout=60) as client:
+        session = await setup(client)
+    reports = []
+    for name in args.scenarios:
+        for concurrency in args.concurrency:
+            report = await run_level(name, session, concurrency, args.requests)
+            print(f"{name:>10} c={concurrency:<4} {report['throughput_rps']} req/s  p50={report['latency']['p50_ms']}ms  "
+                  f"p99={report['latency']['p99_ms']}ms  statuses={report['statuses']}", file=sys.stderr)
+            reports.append(report)
+    return reports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated scenarios to run")
+    parser.add_argument("--concurrency", default="1,16,64", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per fake completion")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between fake tokens")
+    parser.add_argument("--first-token-delay", type=float, default=0.0, help="extra fake delay before the first token")
+    parser.add_argument("--chunk-chars", type=int, default=0, help="pad each fake token to this many characters")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake upstream requests that fail")
+    parser.add_argument("--bcrypt-rounds", type=int, default=None, help="override BCRYPT_ROUNDS for the app")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+
+    db_path = os.path.join(tempfile.gettempdir(), "loadtest_chat_app.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    env = dict(os.environ)
+    env.update(
+        FAKE_TOKENS=str(args.tokens),
+        FAKE_TOKEN_DELAY=str(args.token_delay),
+        FAKE_FIRST_TOKEN_DELAY=str(args.first_token_delay),
+        FAKE_CHUNK_CHARS=str(args.chunk_chars),
+        FAKE_ERROR_RATE=str(args.error_rate),
+        OPENAI_BASE_URL=f"http://127.0.0.1:{FAKE_PORT}/v1",
+        DATABASE_URL=f"sqlite:///{db_path}",
+    )
+    env.setdefault("OPENAI_API_KEY", "sk-fake")
+    if args.bcrypt_rounds is not None:
+        env["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    # All traffic comes from one user and one IP; lift admission limits by default
+    for name in ("USER_REQUESTS_PER_MINUTE", "USER_MAX_CONCURRENT_STREAMS", "KEY_REQUESTS_PER_MINUTE", "KEY_MAX_CONCURRENT_STREAMS",
+                 "DEMO_IP_REQUESTS_PER_MINUTE", "DEMO_IP_MAX_CONCURRENT_STREAMS", "SCHEDULER_MAX_STREAMS"):
+        env.setdefault(name, "0")
+
+    servers = [start_server("fake_openai", FAKE_PORT, env), start_server("app", APP_PORT, env)]
+    try:
+        reports = asyncio.run(run(args))
+    finally:
+        for server in servers:
+            server.terminate()
+
+    output = {
+        "version": git_revision(),
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": reports,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Low-overhead latency histograms exposed in the Prometheus text format
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Sequence, Tuple
+from fastapi import Request
+
+# Set METRICS_ENABLED=0 to turn off the /metrics endpoint and the HTTP middleware
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+# Bucket upper bounds in seconds / bytes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram:
+    """Fixed-bucket histogram with optional labels
+
+    observe() is a bisect plus two increments under a lock, so it is cheap
+    enough to call for every streamed chunk.
+    """
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        # labels -> [per-bucket counts (last is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(snapshot):
+            pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labels)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = ",".join(pairs + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(pairs)}}}" if pairs else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+# Hot-path histograms
+http_request_duration = Histogram("http_request_duration_seconds", "Time to complete an HTTP request, including the streamed body", labelnames=("handler", "method", "status"))
+auth_duration = Histogram("auth_duration_seconds", "Time to authenticate a bearer token", labelnames=("source",))
+db_duration = Histogram("db_duration_seconds", "Time spent in database sessions, including waiting for a connection", labelnames=("path",))
+key_decrypt_duration = Histogram("key_decrypt_duration_seconds", "Time to decrypt a stored API key")
+stream_ttft = Histogram("stream_time_to_first_token_seconds", "Time from request arrival to the first streamed chunk", labelnames=("endpoint",))
+stream_chunk_gap = Histogram("stream_chunk_gap_seconds", "Time between consecutive streamed chunks", GAP_BUCKETS, labelnames=("endpoint",))
+stream_duration = Histogram("stream_duration_seconds", "Time from request arrival to the end of the stream", labelnames=("endpoint",))
+stream_bytes = Histogram("stream_bytes", "Bytes streamed per response", BYTE_BUCKETS, labelnames=("endpoint",))
+
+REGISTRY = [
+    http_request_duration,
+    auth_duration,
+    db_duration,
+    key_decrypt_duration,
+    stream_ttft,
+    stream_chunk_gap,
+    stream_duration,
+    stream_bytes,
+]
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in REGISTRY:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each HTTP request until its last body chunk is sent
+
+    It also stamps the arrival time into the request state so stream hooks can
+    measure time-to-first-token from the moment the request came in.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        scope.setdefault("state", {})["request_started"] = started
+        status = ["500"]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched endpoint in the scope
+            endpoint = scope.get("endpoint")
+            handler = getattr(endpoint, "__name__", "unmatched")
+            http_request_duration.observe(time.perf_counter() - started, handler, scope["method"], status[0])
+
+
+def request_started(request: Request) -> float:
+    """Arrival time stamped by MetricsMiddleware, or now if it is not installed"""
+    return request.scope.get("state", {}).get("request_started") or time.perf_counter()
+
+
+async def instrument_stream(stream: AsyncGenerator[str, None], endpoint: str, started: Optional[float] = None,
+                            release: Optional[Callable[[], None]] = None) -> AsyncGenerator[str, None]:
+    """Record TTFT, inter-chunk gaps, duration and bytes of a response stream, then call release"""
+    started = started or time.perf_counter()
+    last = None
+    size = 0
+    try:
+        async for chunk in stream:
+            now = time.perf_counter()
+            if last is None:
+                stream_ttft.observe(now - started, endpoint)
+            else:
+                stream_chunk_gap.observe(now - last, endpoint)
+            last = now
+            size += len(chunk.encode())
+            yield chunk
+    finally:
+        # Admission slots are held by the same generator to keep the chunk path short
+        if release is not None:
+            release()
+        stream_duration.observe(time.perf_counter() - started, endpoint)
+        stream_bytes.observe(size, endpoint)
@@ -0,0 +1,116 @@
+# Lightweight schema migrations applied at startup
+from datetime import datetime
+from typing import Callable, List, Tuple
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, text
+from sqlalchemy.engine import Connection
+from database import Base, engine
+from models import UserAPIKey
+
+# Bookkeeping table recording which migrations have been applied
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Postgres advisory lock id serializing migrations across workers
+MIGRATION_LOCK_ID = 72_090_001
+
+
+def _add_user_api_key_constraints(conn: Connection) -> None:
+    """Add the users FK and the (user_id, is_active) index to user_api_keys"""
+    inspector = inspect(conn)
+    table = UserAPIKey.__table__
+    has_fk = any(fk["referred_table"] == "users" for fk in inspector.get_foreign_keys(table.name))
+
+    if not has_fk:
+        # Keys of deleted users would violate the new constraint on every dialect
+        orphans = conn.execute(text(
+            f"DELETE FROM {table.name} WHERE user_id NOT IN (SELECT id FROM users)"
+        )).rowcount
+        if orphans:
+            print(f"Dropped {orphans} API keys that belonged to deleted users")
+
+    if not has_fk and conn.dialect.name == "sqlite":
+        # SQLite cannot add a foreign key in place, so rebuild the table
+        for index in inspector.get_indexes(table.name):
+            conn.execute(text(f'DROP INDEX IF EXISTS "{index["name"]}"'))
+        conn.execute(text(f'ALTER TABLE {table.name} RENAME TO _{table.name}_old'))
+        table.create(conn)
+        columns = ", ".join(column.name for column in table.columns)
+        conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM _{table.name}_old"))
+        conn.execute(text(f"DROP TABLE _{table.name}_old"))
+        return
+
+    if not has_fk:
+        conn.execute(text(
+            f"ALTER TABLE {table.name} ADD CONSTRAINT fk_{table.name}_user_id "
+            f"FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE"
+        ))
+    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+
+def _add_message_truncated(conn: Connection) -> None:
+    """Add messages.truncated, which flags assistant turns that were cut short"""
+    columns = {column["name"] for column in inspect(conn).get_columns("messages")}
+    if "truncated" not in columns:
+        conn.execute(text("ALTER TABLE messages ADD COLUMN truncated BOOLEAN NOT NULL DEFAULT FALSE"))
+
+
+# Ordered list of (version, description, upgrade). Upgrades must be safe to run
+# against a schema that create_all() already brought up to date.
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "user_api_keys: users FK and (user_id, is_active) index", _add_user_api_key_constraints),
+    (2, "messages: truncated flag for interrupted replies", _add_message_truncated),
+]
+
+
+def schema_is_current(conn: Connection) -> bool:
+    """Whether every table exists and every migration is recorded (two cheap queries)"""
+    tables = set(inspect(conn).get_table_names())
+    if schema_migrations.name not in tables or not set(Base.metadata.tables) <= tables:
+        return False
+    applied = {row.version for row in conn.execute(schema_migrations.select())}
+    return all(version in applied for version, _, _ in MIGRATIONS)
+
+
+def _lock_schema(conn: Connection) -> None:
+    """Hold a cross-process migration lock until the transaction ends"""
+    if conn.dialect.name == "sqlite":
+        # Take the write lock up front; other workers wait here up to the busy timeout
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    elif conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+
+def run_migrations() -> List[int]:
+    """Create missing tables and apply pending migrations, returning the versions applied"""
+    applied_now = []
+    # Most starts find the schema current; skip the lock and the per-table checks of create_all
+    with engine.connect() as conn:
+        if schema_is_current(conn):
+            return applied_now
+    with engine.begin() as conn:
+        # Workers starting together migrate one at a time; later ones find the work done
+        _lock_schema(conn)
+        if schema_is_current(conn):
+            return applied_now
+        Base.metadata.create_all(bind=conn)
+        migration_metadata.create_all(bind=conn)
+        applied = {row.version for row in conn.execute(schema_migrations.select())}
+        for version, description, upgrade in MIGRATIONS:
+            if version in applied:
+                continue
+            print(f"Applying migration {version}: {description}")
+            upgrade(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+            applied_now.append(version)
+    return applied_now
@@ -1,5 +1,5 @@
-# Database models for user management and API key storage
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text
+# Database models for user management, API key storage, conversation history and usage
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, Index, LargeBinary, BigInteger, UniqueConstraint
 from sqlalchemy.sql import func
 from datetime import datetime
 from database import Base
@@ -19,11 +19,78 @@ class User(Base):
 class UserAPIKey(Base):
     """Encrypted API key storage for users"""
     __tablename__ = "user_api_keys"
+    __table_args__ = (
+        # Every chat filters on (user_id, is_active), so keep that lookup indexed
+        Index("ix_user_api_keys_user_id_is_active", "user_id", "is_active"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     encrypted_api_key = Column(Text, nullable=False)  # Encrypted OpenAI API key
     key_name = Column(String(100), default="Default")  # User can name their keys
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=func.now())
     last_used = Column(DateTime, nullable=True)
+
+class SystemPrompt(Base):
+    """Developer/system prompts stored once and shared by conversations"""
+    __tablename__ = "system_prompts"
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), unique=True, nullable=False)  # sha256 of the prompt text
+    body = Column(LargeBinary, nullable=False)  # UTF-8 text, zlib-compressed when flagged
+    compressed = Column(Boolean, default=False, nullable=False)
+    token_count = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=func.now())
+
+class Conversation(Base):
+    """A chat thread owned by a user"""
+    __tablename__ = "conversations"
+    __table_args__ = (
+        # Conversation lists are per user, most recent first
+        Index("ix_conversations_user_id_updated_at", "user_id", "updated_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    system_prompt_id = Column(Integer, ForeignKey("system_prompts.id"), nullable=True)
+    title = Column(String(200), default="New conversation")
+    model = Column(String(50), default="gpt-4o-mini")
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+class Message(Base):
+    """One user or assistant turn of a conversation"""
+    __tablename__ = "messages"
+    __table_args__ = (
+        # Context assembly reads the newest turns of one conversation
+        Index("ix_messages_conversation_id_id", "conversation_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    role = Column(String(16), nullable=False)  # "user" or "assistant"
+    body = Column(LargeBinary, nullable=False)  # UTF-8 text, zlib-compressed when flagged
+    compressed = Column(Boolean, default=False, nullable=False)
+    token_count = Column(Integer, nullable=False)
+    truncated = Column(Boolean, default=False, nullable=False)  # Reply cut short by a disconnect or upstream error
+    created_at = Column(DateTime, default=func.now())
+
+class UsageRollup(Base):
+    """Hourly token and latency totals per user, API key and model"""
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        # One row per bucket; also serves per-user range reads for /api/usage
+        UniqueConstraint("user_id", "period_start", "api_key_id", "model", name="uq_usage_rollups_bucket"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)  # 0 for anonymous demo traffic
+    api_key_id = Column(Integer, nullable=False)  # 0 for the shared default key
+    model = Column(String(50), nullable=False)
+    period_start = Column(DateTime, nullable=False)  # Start of the hour (UTC)
+    requests = Column(Integer, default=0, nullable=False)
+    cached_requests = Column(Integer, default=0, nullable=False)
+    prompt_tokens = Column(BigInteger, default=0, nullable=False)
+    completion_tokens = Column(BigInteger, default=0, nullable=False)
+    duration_ms = Column(BigInteger, default=0, nullable=False)
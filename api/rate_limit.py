@@ -0,0 +1,128 @@
+# Admission control: token-bucket rate limits plus concurrent stream caps
+import asyncio
+import functools
+import math
+import os
+from typing import Callable, Hashable, List, Optional
+from fastapi import Request
+from shared_state import SharedState, shared_state
+
+# Limits per minute / concurrent streams; 0 disables a limit
+USER_REQUESTS_PER_MINUTE = float(os.getenv("USER_REQUESTS_PER_MINUTE", "60"))
+USER_MAX_CONCURRENT_STREAMS = int(os.getenv("USER_MAX_CONCURRENT_STREAMS", "4"))
+KEY_REQUESTS_PER_MINUTE = float(os.getenv("KEY_REQUESTS_PER_MINUTE", "120"))
+KEY_MAX_CONCURRENT_STREAMS = int(os.getenv("KEY_MAX_CONCURRENT_STREAMS", "16"))
+DEMO_IP_REQUESTS_PER_MINUTE = float(os.getenv("DEMO_IP_REQUESTS_PER_MINUTE", "10"))
+DEMO_IP_MAX_CONCURRENT_STREAMS = int(os.getenv("DEMO_IP_MAX_CONCURRENT_STREAMS", "2"))
+# How long an idle bucket or concurrency count is kept
+RATE_LIMIT_IDLE_SECONDS = float(os.getenv("RATE_LIMIT_IDLE_SECONDS", "900"))
+# Use the proxy-appended X-Forwarded-For entry as the client IP; only enable behind a
+# proxy that appends it (Vercel/Railway), or clients can pick their own IP
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "0") == "1"
+
+
+class RateLimited(Exception):
+    """Raised when a request is over a limit; retry_after is in seconds"""
+
+    def __init__(self, limiter: str, retry_after: int):
+        super().__init__(f"Rate limit exceeded ({limiter})")
+        self.limiter = limiter
+        self.retry_after = retry_after
+
+
+class Lease:
+    """Concurrency slots held for one stream; release() is idempotent"""
+
+    def __init__(self):
+        self._held: List[Callable[[], None]] = []
+
+    def add(self, release: Callable[[], None]) -> None:
+        self._held.append(release)
+
+    def release(self) -> None:
+        held, self._held = self._held, []
+        for release in held:
+            release()
+
+
+class RateLimiter:
+    """Token bucket (requests/minute with a burst of one minute) plus a concurrency cap
+
+    Buckets and concurrency counts live in the shared state backend, so a limit
+    holds across every worker sharing it. Each check is one atomic operation:
+    the bucket is refilled and charged in a single step, and a concurrency slot
+    is an increment that is undone when over the cap. Idle keys expire after
+    idle_seconds; releases never take a count below zero, so a count that
+    expired or was evicted under an open stream cannot go negative.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float, max_concurrent: int,
+                 state: Optional[SharedState] = None, idle_seconds: float = RATE_LIMIT_IDLE_SECONDS):
+        self.name = name
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(requests_per_minute, 1.0)
+        self.max_concurrent = max_concurrent
+        self.state = state or shared_state
+        self.idle_seconds = idle_seconds
+        self.admitted = 0
+        self.rejected = 0
+        self.throttled = 0
+
+    async def acquire(self, key: Hashable, lease: Lease, streams: int = 1) -> None:
+        """Admit one request holding streams concurrent slots for key or raise RateLimited"""
+        prefix = f"rl:{self.name}:{key}"
+        active_key = f"{prefix}:active"
+        if self.max_concurrent:
+            if await self.state.incr(active_key, streams, self.idle_seconds) > self.max_concurrent:
+                self.state.incr_nowait(active_key, -streams, self.idle_seconds, 0)
+                self.rejected += 1
+                raise RateLimited(self.name, 1)
+            lease.add(functools.partial(self.state.incr_nowait, active_key, -streams, self.idle_seconds, 0))
+        if self.rate > 0:
+            wait = await self.state.take(f"{prefix}:tokens", 1, self.rate, self.capacity, self.idle_seconds)
+            if wait > 0:
+                # The lease releases the concurrency slot taken above
+                self.rejected += 1
+                raise RateLimited(self.name, math.ceil(wait))
+        self.admitted += 1
+
+    async def throttle(self, key: Hashable) -> None:
+        """Charge one more request for key, waiting for the bucket to refill instead of rejecting"""
+        while self.rate > 0:
+            wait = await self.state.take(f"rl:{self.name}:{key}:tokens", 1, self.rate, self.capacity, self.idle_seconds)
+            if wait <= 0:
+                break
+            self.throttled += 1
+            await asyncio.sleep(wait)
+        self.admitted += 1
+
+    def stats(self) -> dict:
+        return {"admitted": self.admitted, "rejected": self.rejected, "throttled": self.throttled}
+
+
+# Shared limiters used by the chat endpoints
+user_limiter = RateLimiter("user", USER_REQUESTS_PER_MINUTE, USER_MAX_CONCURRENT_STREAMS)
+key_limiter = RateLimiter("api_key", KEY_REQUESTS_PER_MINUTE, KEY_MAX_CONCURRENT_STREAMS)
+demo_ip_limiter = RateLimiter("client_ip", DEMO_IP_REQUESTS_PER_MINUTE, DEMO_IP_MAX_CONCURRENT_STREAMS)
+
+
+async def admit(*checks: tuple, streams: int = 1) -> Lease:
+    """Acquire (limiter, key) pairs in order, releasing them all if any is over its limit"""
+    lease = Lease()
+    try:
+        for limiter, key in checks:
+            await limiter.acquire(key, lease, streams)
+    except BaseException:
+        lease.release()
+        raise
+    return lease
+
+
+def client_ip(request: Request) -> str:
+    """Best-effort client IP for anonymous rate limiting"""
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if TRUST_FORWARDED_FOR and forwarded_for:
+        # The right-most entry is the one appended by our own proxy
+        return forwarded_for.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
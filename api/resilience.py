@@ -0,0 +1,233 @@
+# Tail-latency controls for upstream streams: retries, model fallback and hedging
+import asyncio
+import os
+import random
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Tuple
+from fastapi import Request
+from circuit_breaker import classify_failure, key_breakers
+from streaming import HEDGE_CANCELLED, CancelReason, StreamSummary, stream_chat_completion
+from usage import UsageScope
+
+# Attempts after the first when the upstream fails before sending any content
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+# Full-jitter exponential backoff between attempts
+RETRY_BACKOFF_SECONDS = float(os.getenv("RETRY_BACKOFF_SECONDS", "0.25"))
+RETRY_BACKOFF_MAX_SECONDS = float(os.getenv("RETRY_BACKOFF_MAX_SECONDS", "4"))
+# Launch a hedged attempt when no content arrived within this many seconds (0 disables)
+HEDGE_TTFT_SECONDS = float(os.getenv("HEDGE_TTFT_SECONDS", "0"))
+
+
+def parse_fallbacks(spec: str) -> Dict[str, List[str]]:
+    """Parse "gpt-4o:gpt-4o-mini,gpt-3.5-turbo;gpt-4-turbo:gpt-4o" into model -> fallback models"""
+    fallbacks = {}
+    for entry in spec.split(";"):
+        model, _, targets = entry.partition(":")
+        if model.strip() and targets.strip():
+            fallbacks[model.strip()] = [target.strip() for target in targets.split(",") if target.strip()]
+    return fallbacks
+
+
+# Models tried, in order, by retries and hedges of a request for the key model
+MODEL_FALLBACKS = parse_fallbacks(os.getenv("MODEL_FALLBACKS", ""))
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Connection failures, timeouts, rate limits and 5xx are worth another attempt"""
+    import openai
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 429:
+            # An exhausted quota will not recover by retrying
+            return getattr(e, "code", None) != "insufficient_quota"
+        return e.status_code >= 500
+    return False
+
+
+def backoff_delay(failures: int, base: float = RETRY_BACKOFF_SECONDS, cap: float = RETRY_BACKOFF_MAX_SECONDS) -> float:
+    return random.uniform(0, min(cap, base * 2 ** (failures - 1)))
+
+
+class ResilienceCounters:
+    """Counters for retries, fallbacks and hedges"""
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failures = 0
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failures": self.failures,
+            "hedge_rate": round(self.hedged / self.requests, 4) if self.requests else 0.0,
+            "hedge_win_rate": round(self.hedge_wins / self.hedged, 4) if self.hedged else 0.0,
+        }
+
+
+# Shared counters reported by /api/stats
+resilience_counters = ResilienceCounters()
+
+
+async def _first_chunk(stream: AsyncGenerator[str, None]) -> Tuple[bool, Optional[str]]:
+    try:
+        return True, await stream.__anext__()
+    except StopAsyncIteration:
+        return False, None
+
+
+class _Attempt:
+    """One upstream stream racing for the first content chunk"""
+
+    def __init__(self, model: str, open_attempt: Callable[[str, CancelReason], AsyncGenerator[str, None]], hedge: bool):
+        self.model = model
+        self.cancel_reason = CancelReason()
+        self.stream = open_attempt(model, self.cancel_reason)
+        self.hedge = hedge
+        self.first: Optional[asyncio.Task] = None
+
+    def race(self) -> asyncio.Task:
+        """The task reading the first chunk, started on first use"""
+        if self.first is None:
+            self.first = asyncio.get_running_loop().create_task(_first_chunk(self.stream))
+        return self.first
+
+    async def close(self, outcome: Optional[str] = None) -> None:
+        if outcome is not None:
+            self.cancel_reason.outcome = outcome
+        if self.first is not None and not self.first.done():
+            self.first.cancel()
+            try:
+                await self.first
+            except (asyncio.CancelledError, Exception):
+                pass
+        await self.stream.aclose()
+
+
+async def resilient_stream(open_attempt: Callable[[str, CancelReason], AsyncGenerator[str, None]], model: str,
+                           fallbacks: Optional[List[str]] = None, retries: int = UPSTREAM_RETRIES,
+                           hedge_after: float = HEDGE_TTFT_SECONDS, breaker_id: Optional[int] = None) -> AsyncGenerator[str, None]:
+    """Yield the stream of whichever attempt sends content first
+
+    Until the first chunk arrives nothing has reached the client, so a failed
+    attempt can be retried after a jittered backoff, and an attempt still silent
+    after hedge_after seconds gets one hedged twin racing it; the loser is
+    cancelled and recorded as a hedge cancellation. Without hedging the first
+    chunk is read in place, with no extra task. Each attempt after the first
+    moves one step down the model's fallback list (staying on the last entry)
+    or reuses the model if it has none. Once content flows the winner is
+    followed to the end and later errors propagate as before. With a
+    breaker_id, the outcome of the request is recorded on that key's breaker.
+    """
+    candidates = [model] + list(fallbacks if fallbacks is not None else MODEL_FALLBACKS.get(model, []))
+    loop = asyncio.get_running_loop()
+    attempts: List[_Attempt] = []
+    launched = 0
+    failures = 0
+    hedged = False
+    deadline = 0.0
+    resilience_counters.requests += 1
+
+    def launch(hedge: bool = False) -> None:
+        nonlocal launched
+        attempt_model = candidates[min(launched, len(candidates) - 1)]
+        launched += 1
+        attempts.append(_Attempt(attempt_model, open_attempt, hedge))
+
+    async def drop(attempt: _Attempt, e: Exception) -> bool:
+        """Close a failed attempt; True once a retry is launched, False if another is still racing"""
+        nonlocal failures, deadline
+        attempts.remove(attempt)
+        await attempt.close()
+        if attempts:
+            return False
+        if failures >= retries or not is_retryable(e):
+            resilience_counters.failures += 1
+            raise e
+        failures += 1
+        resilience_counters.retries += 1
+        print(f"Upstream attempt on {attempt.model} failed ({e}), retrying")
+        await asyncio.sleep(backoff_delay(failures))
+        launch()
+        deadline = loop.time() + hedge_after
+        return True
+
+    try:
+        launch()
+        deadline = loop.time() + hedge_after
+        winner = None
+        while winner is None:
+            if hedge_after <= 0:
+                attempt = attempts[0]
+                try:
+                    more, chunk = await _first_chunk(attempt.stream)
+                except Exception as e:
+                    await drop(attempt, e)
+                    continue
+                winner = attempt
+                break
+            timeout = max(deadline - loop.time(), 0) if not hedged else None
+            done, _ = await asyncio.wait({attempt.race() for attempt in attempts}, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                resilience_counters.hedged += 1
+                launch(hedge=True)
+                continue
+            for attempt in [attempt for attempt in attempts if attempt.first in done]:
+                try:
+                    more, chunk = attempt.first.result()
+                except Exception as e:
+                    if await drop(attempt, e):
+                        break
+                    # The other attempt is still racing
+                    continue
+                winner = attempt
+                break
+
+        # Cancel the losing attempt before following the winner
+        for attempt in attempts:
+            if attempt is not winner:
+                await attempt.close(HEDGE_CANCELLED)
+        attempts = [winner]
+        if winner.hedge:
+            resilience_counters.hedge_wins += 1
+        if winner.model != model:
+            resilience_counters.fallbacks += 1
+        if breaker_id is not None:
+            # The key works once the upstream answers
+            key_breakers.record_success(breaker_id)
+        if more:
+            yield chunk
+            async for chunk in winner.stream:
+                yield chunk
+    except Exception as e:
+        failure = classify_failure(e) if breaker_id is not None else None
+        if failure is not None:
+            key_breakers.record_failure(breaker_id, failure)
+        raise
+    finally:
+        for attempt in attempts:
+            await attempt.close()
+
+
+def resilient_chat_completion(api_key: str, model: str, messages: List[Dict[str, str]], request: Optional[Request] = None,
+                              cache_key: Optional[str] = None, params: Optional[dict] = None,
+                              usage_scope: Optional[UsageScope] = None, summary: Optional[StreamSummary] = None) -> AsyncGenerator[str, None]:
+    """stream_chat_completion with retries, model fallback and hedging; usage is billed to the model that ran
+
+    With a usage_scope the outcome is also recorded on its API key's circuit breaker.
+    """
+    def open_attempt(attempt_model: str, cancel_reason: CancelReason) -> AsyncGenerator[str, None]:
+        # Answers from a fallback model are not cached under the requested model
+        attempt_cache_key = cache_key if attempt_model == model else None
+        return stream_chat_completion(api_key, attempt_model, messages, request, attempt_cache_key, params, usage_scope,
+                                      summary, cancel_reason)
+    return resilient_stream(open_attempt, model, breaker_id=usage_scope.api_key_id if usage_scope is not None else None)
@@ -0,0 +1,97 @@
+# Opt-in exact-match cache of completed chat streams
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+from cache import TTLCache
+from shared_state import SharedState, shared_state
+
+# Response cache configuration (disabled unless RESPONSE_CACHE_ENABLED=1)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(256 * 1024)))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+
+
+def request_fingerprint(model: str, messages: List[Dict[str, str]], params: Optional[dict] = None) -> str:
+    """Stable hash of everything that determines an upstream completion"""
+    payload = json.dumps({"model": model, "messages": messages, "params": params or {}}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of completed streams keyed by a hash of the upstream request
+
+    Entries keep the original chunk boundaries so a hit replays as a stream.
+    The cache is bounded by entry count, total bytes and a TTL. With a
+    cross-process state backend, stores are also written there and local
+    misses read through it, so workers share each other's completions.
+    """
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE_ENABLED, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY_BYTES,
+                 ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS, state: Optional[SharedState] = None):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.state = state or shared_state
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = TTLCache(max_entries, ttl_seconds, on_evict=self._on_evict)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.stores = 0
+        self.oversized = 0
+        self.shared_hits = 0
+
+    def key_for(self, model: str, messages: List[Dict[str, str]], params: Optional[dict] = None, bypass: bool = False) -> Optional[str]:
+        """Return the cache key for a request, or None when caching does not apply"""
+        if not self.enabled or bypass:
+            return None
+        return request_fingerprint(model, messages, params)
+
+    async def get(self, key: str) -> Optional[Tuple[str, ...]]:
+        """Return the cached chunks for a key, if present"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry[0]
+        if self.state.cross_process:
+            raw = await self.state.get(f"rc:{key}")
+            if raw is not None:
+                chunks = json.loads(raw)
+                self._store(key, chunks, sum(len(chunk.encode()) for chunk in chunks))
+                self.shared_hits += 1
+                return tuple(chunks)
+        return None
+
+    def put(self, key: str, chunks: List[str]) -> None:
+        """Store a completed stream, evicting least recently used entries to fit"""
+        size = sum(len(chunk.encode()) for chunk in chunks)
+        if size > self.max_entry_bytes:
+            self.oversized += 1
+            return
+        self._store(key, chunks, size)
+        self.stores += 1
+        if self.state.cross_process:
+            self.state.set_nowait(f"rc:{key}", json.dumps(chunks).encode(), self.ttl_seconds)
+
+    def _store(self, key: str, chunks: List[str], size: int) -> None:
+        with self._lock:
+            self._entries.set(key, (tuple(chunks), size))
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._entries):
+                self._entries.pop_oldest()
+
+    def _on_evict(self, key: str, entry: Tuple[Tuple[str, ...], int]) -> None:
+        self.bytes -= entry[1]
+
+    def stats(self) -> dict:
+        stats = self._entries.stats()
+        stats.update({"enabled": self.enabled, "bytes": self.bytes, "max_bytes": self.max_bytes, "stores": self.stores, "oversized": self.oversized,
+                      "shared_hits": self.shared_hits})
+        return stats
+
+
+# Shared cache used by the streaming engine
+response_cache = ResponseCache()
@@ -0,0 +1,293 @@
+# Resumable chat streams backed by per-stream replay buffers
+import asyncio
+import json
+import os
+import secrets
+from collections import OrderedDict, deque
+from typing import AsyncGenerator, Callable, Deque, Optional, Set, Union
+from shared_state import SharedState, shared_state
+
+# How long a finished stream stays available for reconnects
+RESUMABLE_TTL_SECONDS = float(os.getenv("RESUMABLE_TTL_SECONDS", "300"))
+# How long generation continues with no client attached before it is cancelled
+RESUMABLE_GRACE_SECONDS = float(os.getenv("RESUMABLE_GRACE_SECONDS", "30"))
+# Replay buffer caps per stream and across all streams
+RESUMABLE_STREAM_MAX_BYTES = int(os.getenv("RESUMABLE_STREAM_MAX_BYTES", str(256 * 1024)))
+RESUMABLE_MAX_BYTES = int(os.getenv("RESUMABLE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Retry-After (seconds) sent to resumable requests refused while the buffer is full
+RESUMABLE_RETRY_AFTER_SECONDS = int(os.getenv("RESUMABLE_RETRY_AFTER_SECONDS", "5"))
+
+
+class ResumableStream:
+    """Framed events of one generation; event seq k is events[k - first_seq]"""
+
+    def __init__(self, stream_id: str, owner: Optional[int], stream_format: str):
+        self.id = stream_id
+        self.owner = owner
+        self.format = stream_format
+        self.events: Deque[str] = deque()
+        self.first_seq = 0
+        self.size = 0
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.changed = asyncio.Event()
+        self.meta_expires_at = 0.0
+
+    @property
+    def next_seq(self) -> int:
+        return self.first_seq + len(self.events)
+
+    def wake(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class RemoteStream:
+    """A stream produced by another worker, known from its shared metadata"""
+
+    def __init__(self, stream_id: str, owner: Optional[int], stream_format: str, done: bool, next_seq: int):
+        self.id = stream_id
+        self.owner = owner
+        self.format = stream_format
+        self.done = done
+        self.next_seq = next_seq
+
+
+class ResumableStreams:
+    """Runs opted-in generations in the background so clients can reconnect
+
+    The generation is drained into a bounded replay buffer by its own task, so
+    it keeps going when the client drops. A client reconnects with the stream
+    ID and the last sequence number it saw and receives the rest. With nobody
+    attached, generation is cancelled after grace_seconds; finished streams are
+    kept for ttl_seconds. Buffers are capped per stream and in total: the oldest
+    finished streams are dropped first, and when the total is still exceeded no
+    new resumable streams are started.
+
+    With a cross-process state backend every event is also written there and
+    published on the stream's channel, so a reconnect that lands on another
+    worker replays from the shared copy and then follows the live channel.
+    """
+
+    def __init__(self, ttl_seconds: float = RESUMABLE_TTL_SECONDS, grace_seconds: float = RESUMABLE_GRACE_SECONDS,
+                 stream_max_bytes: int = RESUMABLE_STREAM_MAX_BYTES, max_bytes: int = RESUMABLE_MAX_BYTES,
+                 state: Optional[SharedState] = None):
+        self.state = state or shared_state
+        self.ttl_seconds = ttl_seconds
+        self.grace_seconds = grace_seconds
+        self.stream_max_bytes = stream_max_bytes
+        self.max_bytes = max_bytes
+        self._streams: "OrderedDict[str, ResumableStream]" = OrderedDict()
+        self.bytes = 0
+        self.started = 0
+        self.resumed = 0
+        self.abandoned = 0
+        self.refused = 0
+        self.remote_resumed = 0
+        self._checks: Set[asyncio.Task] = set()
+
+    def start(self, events: AsyncGenerator[str, None], owner: Optional[int], stream_format: str,
+              on_finish: Callable[[], None]) -> Optional[ResumableStream]:
+        """Start draining framed events in the background, or return None when over the memory cap"""
+        if not self.has_room():
+            self.refused += 1
+            return None
+        stream = ResumableStream(secrets.token_urlsafe(16), owner, stream_format)
+        self._streams[stream.id] = stream
+        if self.state.cross_process:
+            # Queued ahead of the first event, so other workers know the stream before its events
+            self._share_meta(stream)
+        stream.task = asyncio.get_running_loop().create_task(self._produce(stream, events, on_finish))
+        self.started += 1
+        return stream
+
+    def has_room(self) -> bool:
+        """Whether a new stream fits under the memory cap, evicting finished ones if needed"""
+        if self.bytes > self.max_bytes:
+            self._evict_finished()
+        return self.bytes <= self.max_bytes
+
+    async def get(self, stream_id: str) -> Optional[Union[ResumableStream, RemoteStream]]:
+        stream = self._streams.get(stream_id)
+        if stream is None and self.state.cross_process:
+            raw = await self.state.get(f"rs:{stream_id}")
+            if raw is not None:
+                meta = json.loads(raw)
+                stream = RemoteStream(stream_id, meta["owner"], meta["format"], meta["done"], meta["next_seq"])
+        return stream
+
+    async def can_resume(self, stream: Union[ResumableStream, RemoteStream], last_seq: int) -> bool:
+        """Whether every event after last_seq is still buffered"""
+        if isinstance(stream, RemoteStream):
+            # A missing event is either not produced yet or expired with a finished stream
+            return (not stream.done or last_seq + 1 >= stream.next_seq
+                    or await self.state.get(f"rs:{stream.id}:{last_seq + 1}") is not None)
+        return stream.first_seq <= last_seq + 1 <= stream.next_seq
+
+    def subscribe(self, stream: Union[ResumableStream, RemoteStream], last_seq: int = -1) -> AsyncGenerator[str, None]:
+        """Yield the events after last_seq, following the stream until it ends"""
+        if isinstance(stream, RemoteStream):
+            return self._subscribe_remote(stream, last_seq)
+        return self._subscribe_local(stream, last_seq)
+
+    async def _subscribe_local(self, stream: ResumableStream, last_seq: int) -> AsyncGenerator[str, None]:
+        if last_seq >= 0:
+            self.resumed += 1
+        stream.subscribers += 1
+        if stream.timer is not None and not stream.done:
+            stream.timer.cancel()
+            stream.timer = None
+        cursor = last_seq + 1
+        try:
+            while True:
+                changed = stream.changed
+                if cursor < stream.first_seq:
+                    # This reader fell further behind than the buffer holds
+                    return
+                while cursor < stream.next_seq:
+                    event = stream.events[cursor - stream.first_seq]
+                    cursor += 1
+                    yield event
+                if stream.done:
+                    return
+                await changed.wait()
+        finally:
+            stream.subscribers -= 1
+            if stream.subscribers == 0 and not stream.done:
+                stream.timer = asyncio.get_running_loop().call_later(self.grace_seconds, self._abandon, stream)
+
+    async def _subscribe_remote(self, stream: RemoteStream, last_seq: int) -> AsyncGenerator[str, None]:
+        # Subscribe before replaying so no event falls between the two; duplicates are skipped by seq
+        subscription = await self.state.subscribe(f"rs:{stream.id}")
+        self.remote_resumed += 1
+        cursor = last_seq + 1
+        try:
+            # Counted so the producing worker does not abandon the stream
+            await self.state.incr(f"rs:{stream.id}:subscribers", 1, self.ttl_seconds)
+            while True:
+                event = await self.state.get(f"rs:{stream.id}:{cursor}")
+                if event is None:
+                    break
+                cursor += 1
+                yield event.decode()
+            raw = await self.state.get(f"rs:{stream.id}")
+            if raw is None or json.loads(raw)["done"]:
+                return
+            while True:
+                try:
+                    # The producing worker may have died; give up after a TTL of silence
+                    message = await asyncio.wait_for(subscription.__anext__(), self.ttl_seconds)
+                except asyncio.TimeoutError:
+                    return
+                if message == b"end":
+                    return
+                seq, _, event = message.partition(b"\n")
+                if int(seq) < cursor:
+                    continue
+                cursor = int(seq) + 1
+                yield event.decode()
+        finally:
+            subscription.close()
+            self.state.incr_nowait(f"rs:{stream.id}:subscribers", -1, self.ttl_seconds, 0)
+
+    def _share_meta(self, stream: ResumableStream) -> None:
+        meta = {"owner": stream.owner, "format": stream.format, "done": stream.done, "next_seq": stream.next_seq}
+        self.state.set_nowait(f"rs:{stream.id}", json.dumps(meta).encode(), self.ttl_seconds)
+        stream.meta_expires_at = asyncio.get_running_loop().time() + self.ttl_seconds
+
+    def _share_event(self, stream: ResumableStream, event: str) -> None:
+        seq = stream.next_seq - 1
+        # Writes are queued in order, so an event is stored before it is announced
+        self.state.set_nowait(f"rs:{stream.id}:{seq}", event.encode(), self.ttl_seconds)
+        self.state.publish_nowait(f"rs:{stream.id}", f"{seq}\n{event}".encode())
+        if asyncio.get_running_loop().time() > stream.meta_expires_at - self.ttl_seconds / 2:
+            # Keep the metadata of a long generation from expiring
+            self._share_meta(stream)
+
+    async def _produce(self, stream: ResumableStream, events: AsyncGenerator[str, None], on_finish: Callable[[], None]) -> None:
+        shared = self.state.cross_process
+        try:
+            async for event in events:
+                stream.events.append(event)
+                stream.size += len(event)
+                self.bytes += len(event)
+                if shared:
+                    self._share_event(stream, event)
+                while stream.size > self.stream_max_bytes and len(stream.events) > 1:
+                    self._drop_oldest_event(stream)
+                if self.bytes > self.max_bytes:
+                    self._evict_finished()
+                stream.wake()
+        except Exception as e:
+            print(f"Error in resumable stream {stream.id}: {e}")
+        finally:
+            await events.aclose()
+            stream.done = True
+            stream.wake()
+            if shared:
+                self._share_meta(stream)
+                self.state.publish_nowait(f"rs:{stream.id}", b"end")
+            on_finish()
+            if stream.timer is not None:
+                stream.timer.cancel()
+            stream.timer = asyncio.get_running_loop().call_later(self.ttl_seconds, self._discard, stream)
+
+    def _drop_oldest_event(self, stream: ResumableStream) -> None:
+        event = stream.events.popleft()
+        stream.first_seq += 1
+        stream.size -= len(event)
+        self.bytes -= len(event)
+
+    def _abandon(self, stream: ResumableStream) -> None:
+        # Nobody reconnected within the grace period; stop paying for the upstream
+        if stream.done or stream.subscribers > 0:
+            return
+        if self.state.cross_process:
+            stream.timer = None
+            self._checks.add(asyncio.get_running_loop().create_task(self._abandon_unless_followed(stream)))
+            return
+        self.abandoned += 1
+        stream.task.cancel()
+
+    async def _abandon_unless_followed(self, stream: ResumableStream) -> None:
+        try:
+            if await self.state.get_count(f"rs:{stream.id}:subscribers") > 0:
+                # A client is following from another worker
+                if stream.timer is None and not stream.done:
+                    stream.timer = asyncio.get_running_loop().call_later(self.grace_seconds, self._abandon, stream)
+            elif stream.subscribers == 0 and not stream.done:
+                self.abandoned += 1
+                stream.task.cancel()
+        finally:
+            self._checks.discard(asyncio.current_task())
+
+    def _discard(self, stream: ResumableStream) -> None:
+        if self._streams.get(stream.id) is stream:
+            del self._streams[stream.id]
+            self.bytes -= stream.size
+
+    def _evict_finished(self) -> None:
+        for stream in list(self._streams.values()):
+            if self.bytes <= self.max_bytes:
+                return
+            if stream.done and stream.subscribers == 0:
+                stream.timer.cancel()
+                self._discard(stream)
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "started": self.started,
+            "resumed": self.resumed,
+            "abandoned": self.abandoned,
+            "refused": self.refused,
+            "remote_resumed": self.remote_resumed,
+        }
+
+
+# Shared registry used by the chat endpoints
+resumable_streams = ResumableStreams()
@@ -0,0 +1,165 @@
+# Priority scheduler in front of the streaming engine
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+from rate_limit import Lease
+
+# Traffic classes
+AUTHENTICATED = "authenticated"
+DEMO = "demo"
+
+# Global cap on concurrently running chat streams (0 disables scheduling)
+SCHEDULER_MAX_STREAMS = int(os.getenv("SCHEDULER_MAX_STREAMS", "100"))
+# Share of freed slots each queue receives while both are waiting
+SCHEDULER_AUTH_WEIGHT = int(os.getenv("SCHEDULER_AUTH_WEIGHT", "4"))
+SCHEDULER_DEMO_WEIGHT = int(os.getenv("SCHEDULER_DEMO_WEIGHT", "1"))
+# Queue length caps and how long a request may wait for a slot
+SCHEDULER_AUTH_MAX_QUEUE = int(os.getenv("SCHEDULER_AUTH_MAX_QUEUE", "200"))
+SCHEDULER_DEMO_MAX_QUEUE = int(os.getenv("SCHEDULER_DEMO_MAX_QUEUE", "50"))
+SCHEDULER_AUTH_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_AUTH_QUEUE_TIMEOUT", "15"))
+SCHEDULER_DEMO_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_DEMO_QUEUE_TIMEOUT", "5"))
+# Once this many requests are queued in total, demo traffic is shed
+SCHEDULER_SHED_DEMO_DEPTH = int(os.getenv("SCHEDULER_SHED_DEMO_DEPTH", "20"))
+
+
+class SchedulerOverloaded(Exception):
+    """Raised when a request is shed or its queue deadline passes"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Server busy ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Queue:
+    __slots__ = ("weight", "max_size", "timeout", "waiters", "current", "admitted", "shed", "timed_out", "wait_seconds")
+
+    def __init__(self, weight: int, max_size: int, timeout: float):
+        self.weight = weight
+        self.max_size = max_size
+        self.timeout = timeout
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.current = 0  # Smooth weighted round-robin credit
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.wait_seconds = 0.0
+
+
+class StreamScheduler:
+    """Global concurrency cap with weighted queues per traffic class
+
+    Requests run immediately while slots are free. Otherwise they wait in their
+    class's queue; freed slots go to the queues by smooth weighted round-robin,
+    FIFO within a queue. Each class has a queue length cap and a deadline, and
+    once the total backlog reaches shed_demo_depth new demo requests are rejected
+    and queued demo requests are dropped to make room for authenticated ones.
+    """
+
+    def __init__(self, max_streams: int = SCHEDULER_MAX_STREAMS, shed_demo_depth: int = SCHEDULER_SHED_DEMO_DEPTH):
+        self.max_streams = max_streams
+        self.shed_demo_depth = shed_demo_depth
+        self.active = 0
+        self._queues: Dict[str, _Queue] = {
+            AUTHENTICATED: _Queue(SCHEDULER_AUTH_WEIGHT, SCHEDULER_AUTH_MAX_QUEUE, SCHEDULER_AUTH_QUEUE_TIMEOUT),
+            DEMO: _Queue(SCHEDULER_DEMO_WEIGHT, SCHEDULER_DEMO_MAX_QUEUE, SCHEDULER_DEMO_QUEUE_TIMEOUT),
+        }
+
+    def queued(self) -> int:
+        return sum(len(queue.waiters) for queue in self._queues.values())
+
+    async def acquire(self, traffic_class: str, lease: Lease) -> None:
+        """Wait for a stream slot and attach its release to lease"""
+        if not self.max_streams:
+            return
+        queue = self._queues[traffic_class]
+        if self.active < self.max_streams and not self.queued():
+            self._start(queue)
+            lease.add(self.release)
+            return
+
+        if len(queue.waiters) >= queue.max_size:
+            queue.shed += 1
+            raise SchedulerOverloaded("queue full", math.ceil(queue.timeout))
+        if self.queued() >= self.shed_demo_depth:
+            if traffic_class == DEMO:
+                queue.shed += 1
+                raise SchedulerOverloaded("demo traffic shed", math.ceil(queue.timeout))
+            self._shed_queued_demo()
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.waiters.append(waiter)
+        enqueued = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, queue.timeout)
+        except asyncio.TimeoutError:
+            queue.timed_out += 1
+            raise SchedulerOverloaded("queue deadline passed", 1)
+        except BaseException:
+            # Cancelled after being granted a slot: hand it back
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release()
+            raise
+        finally:
+            if waiter in queue.waiters:
+                queue.waiters.remove(waiter)
+        queue.wait_seconds += time.monotonic() - enqueued
+        lease.add(self.release)
+
+    def release(self) -> None:
+        """Free a slot and hand it to the next queued request"""
+        self.active -= 1
+        while self.active < self.max_streams:
+            queue = self._next_queue()
+            if queue is None:
+                return
+            waiter = queue.waiters.popleft()
+            if waiter.done():
+                continue
+            self._start(queue)
+            waiter.set_result(True)
+
+    def _start(self, queue: _Queue) -> None:
+        self.active += 1
+        queue.admitted += 1
+
+    def _next_queue(self) -> Optional[_Queue]:
+        # Smooth weighted round-robin over the queues that have waiters
+        ready = [queue for queue in self._queues.values() if queue.waiters]
+        if not ready:
+            return None
+        total = 0
+        for queue in ready:
+            queue.current += queue.weight
+            total += queue.weight
+        chosen = max(ready, key=lambda queue: queue.current)
+        chosen.current -= total
+        return chosen
+
+    def _shed_queued_demo(self) -> None:
+        demo = self._queues[DEMO]
+        while demo.waiters:
+            waiter = demo.waiters.popleft()
+            if not waiter.done():
+                demo.shed += 1
+                waiter.set_exception(SchedulerOverloaded("demo traffic shed", math.ceil(demo.timeout)))
+                return
+
+    def stats(self) -> dict:
+        stats = {"active": self.active, "max_streams": self.max_streams}
+        for name, queue in self._queues.items():
+            stats[name] = {
+                "queued": len(queue.waiters),
+                "admitted": queue.admitted,
+                "shed": queue.shed,
+                "timed_out": queue.timed_out,
+                "avg_queue_wait": round(queue.wait_seconds / queue.admitted, 4) if queue.admitted else 0.0,
+            }
+        return stats
+
+
+# Shared scheduler used by the chat endpoints
+stream_scheduler = StreamScheduler()
@@ -1,6 +1,6 @@
 # Pydantic schemas for request/response validation
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from typing import Dict, Literal, Optional, List
 from datetime import datetime
 
 # User authentication schemas
@@ -30,6 +30,16 @@ class Token(BaseModel):
     """Schema for JWT token response"""
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None  # Access token lifetime in seconds
+
+class RefreshRequest(BaseModel):
+    """Schema for exchanging a refresh token for new tokens"""
+    refresh_token: str
+
+class LogoutRequest(BaseModel):
+    """Schema for logging out; the refresh token is revoked too when given"""
+    refresh_token: Optional[str] = None
 
 class TokenData(BaseModel):
     """Schema for token payload data"""
@@ -41,6 +51,14 @@ class APIKeyCreate(BaseModel):
     api_key: str
     key_name: Optional[str] = "Default"
 
+class APIKeyHealth(BaseModel):
+    """Circuit breaker state of an API key as seen by this server"""
+    state: Literal["closed", "open", "half_open"]
+    recent_failures: Dict[str, int]  # Failures per type (auth, quota, rate_limit, timeout, connection, server)
+    last_failure: Optional[str]
+    last_failure_at: Optional[datetime]
+    retry_after: Optional[int]  # Seconds until the next probe while open
+
 class APIKeyResponse(BaseModel):
     """Schema for API key response (without the actual key)"""
     id: int
@@ -48,6 +66,7 @@ class APIKeyResponse(BaseModel):
     is_active: bool
     created_at: datetime
     last_used: Optional[datetime]
+    health: Optional[APIKeyHealth] = None
 
     class Config:
         from_attributes = True
@@ -58,5 +77,84 @@ class ChatRequest(BaseModel):
     developer_message: str
     user_message: str
     model: Optional[str] = "gpt-4o-mini"
+    temperature: Optional[float] = None  # Upstream default when omitted; 0 allows request coalescing
     use_demo_mode: Optional[bool] = False
     api_key_id: Optional[int] = None  # ID of the user's stored API key to use
+    bypass_cache: Optional[bool] = False  # Skip the response cache for this request
+    stream_format: Literal["text", "sse", "ndjson"] = "text"  # Framed formats add sequence numbers and a final event
+    resumable: bool = False  # Keep generating after a disconnect so the client can reconnect (framed formats only)
+
+# Batch chat schemas
+class BatchChatItem(BaseModel):
+    """One prompt of a batch; id is echoed back in its result line"""
+    id: Optional[str] = None
+    developer_message: str
+    user_message: str
+    model: Optional[str] = "gpt-4o-mini"
+    temperature: Optional[float] = None
+    bypass_cache: Optional[bool] = False
+
+class BatchChatRequest(BaseModel):
+    """Schema for batch chat requests; the API key is resolved once for every item"""
+    items: List[BatchChatItem]
+    use_demo_mode: Optional[bool] = False
+    api_key_id: Optional[int] = None
+    parallelism: Optional[int] = None  # Items in flight at once, capped by BATCH_MAX_PARALLELISM
+
+# Conversation history schemas
+class ConversationCreate(BaseModel):
+    """Schema for starting a conversation"""
+    title: Optional[str] = "New conversation"
+    developer_message: Optional[str] = None  # System prompt used for every turn
+    model: Optional[str] = "gpt-4o-mini"
+
+class ConversationResponse(BaseModel):
+    """Schema for conversation response"""
+    id: int
+    title: str
+    model: str
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class ConversationMessageCreate(BaseModel):
+    """Schema for appending a user turn to a conversation"""
+    user_message: str
+    model: Optional[str] = None  # Defaults to the conversation's model
+    temperature: Optional[float] = None
+    use_demo_mode: Optional[bool] = False
+    api_key_id: Optional[int] = None
+    bypass_cache: Optional[bool] = False
+    stream_format: Literal["text", "sse", "ndjson"] = "text"
+    resumable: bool = False
+
+class MessageResponse(BaseModel):
+    """Schema for a stored conversation turn"""
+    id: int
+    role: str
+    content: str
+    truncated: bool
+    created_at: datetime
+
+# Usage accounting schemas
+class UsageEntry(BaseModel):
+    """Token usage for one API key and model"""
+    api_key_id: Optional[int]  # None for the shared default key
+    model: str
+    requests: int
+    cached_requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    avg_duration_ms: int
+    estimated_cost_usd: float
+
+class UsageResponse(BaseModel):
+    """Schema for the usage summary of the current user"""
+    since: datetime
+    requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    estimated_cost_usd: float
+    breakdown: List[UsageEntry]
@@ -0,0 +1,373 @@
+# Pluggable shared state (counters, token buckets, TTL key-value, pub/sub) for multi-worker deployments
+import asyncio
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Set
+from cache import TTLCache
+
+# "memory" keeps state per process; "sqlite" shares it between workers on one host
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", os.path.join(tempfile.gettempdir(), "chat_app_state.db"))
+# Key bound of the in-memory backend (least recently used keys are dropped first)
+SHARED_STATE_MAX_KEYS = int(os.getenv("SHARED_STATE_MAX_KEYS", "100000"))
+# How often the SQLite backend polls for channel messages, and how long messages are kept
+SHARED_STATE_POLL_SECONDS = float(os.getenv("SHARED_STATE_POLL_SECONDS", "0.02"))
+SHARED_STATE_MESSAGE_TTL_SECONDS = float(os.getenv("SHARED_STATE_MESSAGE_TTL_SECONDS", "60"))
+# Seconds between sweeps of expired keys and old messages in the SQLite backend
+SHARED_STATE_PURGE_SECONDS = float(os.getenv("SHARED_STATE_PURGE_SECONDS", "30"))
+
+
+class Subscription:
+    """Messages published to a channel after subscribe() returned; iterate, then close()"""
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> bytes:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SharedState:
+    """Interface of the shared state backends
+
+    Counters, buckets and values live in one key space and expire ttl seconds
+    after their last write. Every operation is atomic, so check-then-undo
+    patterns stay exact across workers. Backends implement the synchronous
+    _operations; _call runs one for an awaiting caller and _submit runs one
+    without waiting for it (in order with other operations), which suits
+    releases and write-through from synchronous code. cross_process tells
+    callers whether other workers see the same state.
+    """
+
+    name = "base"
+    cross_process = False
+
+    async def _call(self, fn: Callable, *args):
+        return fn(*args)
+
+    def _submit(self, fn: Callable, *args) -> None:
+        fn(*args)
+
+    async def incr(self, key: str, amount: float = 1, ttl: float = 3600, floor: Optional[float] = None) -> float:
+        """Add amount to a counter (starting from 0, never below floor) and return the new value"""
+        return await self._call(self._incr, key, amount, ttl, floor)
+
+    def incr_nowait(self, key: str, amount: float = 1, ttl: float = 3600, floor: Optional[float] = None) -> None:
+        self._submit(self._incr, key, amount, ttl, floor)
+
+    async def get_count(self, key: str) -> float:
+        return await self._call(self._get_count, key)
+
+    async def take(self, key: str, cost: float, rate: float, capacity: float, ttl: float) -> float:
+        """Refill a token bucket at rate per second up to capacity and take cost tokens
+
+        Returns 0 when the tokens were taken, otherwise the seconds until they
+        would be available (nothing is taken then).
+        """
+        return await self._call(self._take, key, cost, rate, capacity, ttl)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._call(self._get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self._call(self._set, key, value, ttl)
+
+    def set_nowait(self, key: str, value: bytes, ttl: float) -> None:
+        self._submit(self._set, key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self._call(self._delete, key)
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        await self._call(self._publish, channel, message)
+
+    def publish_nowait(self, channel: str, message: bytes) -> None:
+        self._submit(self._publish, channel, message)
+
+    async def subscribe(self, channel: str) -> Subscription:
+        """Start receiving a channel's messages; messages published earlier are not delivered"""
+        raise NotImplementedError
+
+    def _incr(self, key: str, amount: float, ttl: float, floor: Optional[float]) -> float:
+        raise NotImplementedError
+
+    def _get_count(self, key: str) -> float:
+        raise NotImplementedError
+
+    def _take(self, key: str, cost: float, rate: float, capacity: float, ttl: float) -> float:
+        raise NotImplementedError
+
+    def _get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: bytes, ttl: float) -> None:
+        raise NotImplementedError
+
+    def _delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def _publish(self, channel: str, message: bytes) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+
+class _QueueSubscription(Subscription):
+    """Subscription fed (message id, payload) pairs; ids up to start predate it"""
+
+    def __init__(self, subscribers: Dict[str, Set["_QueueSubscription"]], channel: str):
+        self._subscribers = subscribers
+        self.channel = channel
+        self.start = 0
+        self.queue: asyncio.Queue = asyncio.Queue()
+        subscribers.setdefault(channel, set()).add(self)
+
+    async def __anext__(self) -> bytes:
+        while True:
+            message_id, payload = await self.queue.get()
+            if message_id > self.start:
+                return payload
+
+    def close(self) -> None:
+        subscriptions = self._subscribers.get(self.channel)
+        if subscriptions is not None:
+            subscriptions.discard(self)
+            if not subscriptions:
+                del self._subscribers[self.channel]
+
+
+class MemoryState(SharedState):
+    """Single-process backend: an LRU of counters, buckets and values plus in-loop queues"""
+
+    name = "memory"
+    cross_process = False
+
+    def __init__(self, max_keys: int = SHARED_STATE_MAX_KEYS):
+        self._data = TTLCache(max_keys, 3600)
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[_QueueSubscription]] = {}
+        self._published = 0
+
+    def _incr(self, key: str, amount: float, ttl: float, floor: Optional[float]) -> float:
+        with self._lock:
+            value = (self._data.get(key) or 0) + amount
+            if floor is not None:
+                value = max(floor, value)
+            self._data.set(key, value, ttl)
+            return value
+
+    def _get_count(self, key: str) -> float:
+        return self._data.get(key) or 0
+
+    def _take(self, key: str, cost: float, rate: float, capacity: float, ttl: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._data.get(key) or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            taken = tokens >= cost
+            if taken:
+                tokens -= cost
+            self._data.set(key, (tokens, now), ttl)
+        return 0.0 if taken else (cost - tokens) / rate
+
+    def _get(self, key: str) -> Optional[bytes]:
+        return self._data.get(key)
+
+    def _set(self, key: str, value: bytes, ttl: float) -> None:
+        self._data.set(key, value, ttl)
+
+    def _delete(self, key: str) -> None:
+        self._data.pop(key)
+
+    def _publish(self, channel: str, message: bytes) -> None:
+        self._published += 1
+        for subscription in self._subscribers.get(channel, ()):
+            subscription.queue.put_nowait((self._published, message))
+
+    async def subscribe(self, channel: str) -> Subscription:
+        subscription = _QueueSubscription(self._subscribers, channel)
+        subscription.start = self._published
+        return subscription
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "keys": len(self._data), "channels": len(self._subscribers)}
+
+
+class SQLiteState(SharedState):
+    """Cross-process backend in a SQLite file shared by the workers of one host
+
+    Every statement runs on one dedicated I/O thread with its own connection,
+    so a worker waiting on another's write lock never stalls the event loop.
+    Each operation is a single autocommit statement in WAL mode (counters and
+    buckets are one UPSERT ... RETURNING), which makes it atomic across
+    processes without a server. Durability is traded for speed
+    (synchronous=OFF): the file only holds short-lived counters and caches.
+    Pub/sub is a message table; one poller per process reads new rows for all
+    local subscribers.
+    """
+
+    name = "sqlite"
+    cross_process = True
+
+    def __init__(self, path: str = SHARED_STATE_PATH, poll_seconds: float = SHARED_STATE_POLL_SECONDS,
+                 message_ttl: float = SHARED_STATE_MESSAGE_TTL_SECONDS, purge_seconds: float = SHARED_STATE_PURGE_SECONDS):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self.message_ttl = message_ttl
+        self.purge_seconds = purge_seconds
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._next_purge = 0.0
+        self._subscribers: Dict[str, Set[_QueueSubscription]] = {}
+        self._poller: Optional[asyncio.Task] = None
+        self.published = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self._executor.submit(self._connect).result()
+
+    async def _call(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _submit(self, fn: Callable, *args) -> None:
+        self._executor.submit(self._logged, fn, *args)
+
+    @staticmethod
+    def _logged(fn: Callable, *args) -> None:
+        try:
+            fn(*args)
+        except sqlite3.Error as e:
+            print(f"Shared state write failed: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Only ever called on the I/O thread
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, num REAL NOT NULL DEFAULT 0, "
+                         "expires_at REAL NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_kv_expires_at ON kv (expires_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, "
+                         "taken INTEGER NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_buckets_expires_at ON buckets (expires_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, "
+                         "payload BLOB NOT NULL, created_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_messages_created_at ON messages (created_at)")
+            self._conn = conn
+        return self._conn
+
+    def _write(self, sql: str, params) -> sqlite3.Cursor:
+        now = time.time()
+        conn = self._connect()
+        if now >= self._next_purge:
+            self._next_purge = now + self.purge_seconds
+            conn.execute("DELETE FROM kv WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM buckets WHERE expires_at <= ?", (now,))
+            conn.execute("DELETE FROM messages WHERE created_at < ?", (now - self.message_ttl,))
+        return conn.execute(sql, params)
+
+    def _incr(self, key: str, amount: float, ttl: float, floor: Optional[float]) -> float:
+        now = time.time()
+        value = "CASE WHEN kv.expires_at <= :now THEN :amount ELSE kv.num + :amount END"
+        if floor is not None:
+            value = f"MAX(:floor, {value})"
+            amount_start = max(floor, amount)
+        else:
+            amount_start = amount
+        return self._write(
+            f"INSERT INTO kv (key, num, expires_at) VALUES (:key, :start, :expires) ON CONFLICT (key) DO UPDATE SET "
+            f"num = {value}, expires_at = :expires RETURNING num",
+            {"key": key, "amount": amount, "start": amount_start, "floor": floor, "now": now, "expires": now + ttl},
+        ).fetchone()[0]
+
+    def _take(self, key: str, cost: float, rate: float, capacity: float, ttl: float) -> float:
+        now = time.time()
+        refilled = "MIN(:capacity, buckets.tokens + MAX(:now - buckets.updated_at, 0) * :rate)"
+        tokens, taken = self._write(
+            f"INSERT INTO buckets (key, tokens, updated_at, taken, expires_at) "
+            f"VALUES (:key, CASE WHEN :capacity >= :cost THEN :capacity - :cost ELSE :capacity END, :now, :capacity >= :cost, :expires) "
+            f"ON CONFLICT (key) DO UPDATE SET "
+            f"tokens = {refilled} - CASE WHEN {refilled} >= :cost THEN :cost ELSE 0 END, "
+            f"taken = {refilled} >= :cost, updated_at = :now, expires_at = :expires RETURNING tokens, taken",
+            {"key": key, "cost": cost, "rate": rate, "capacity": capacity, "now": now, "expires": now + ttl},
+        ).fetchone()
+        return 0.0 if taken else (cost - tokens) / rate
+
+    def _get_count(self, key: str) -> float:
+        row = self._connect().execute("SELECT num FROM kv WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return row[0] if row is not None else 0
+
+    def _get(self, key: str) -> Optional[bytes]:
+        row = self._connect().execute("SELECT value FROM kv WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return bytes(row[0]) if row is not None and row[0] is not None else None
+
+    def _set(self, key: str, value: bytes, ttl: float) -> None:
+        self._write("INSERT OR REPLACE INTO kv (key, value, num, expires_at) VALUES (?, ?, 0, ?)", (key, value, time.time() + ttl))
+
+    def _delete(self, key: str) -> None:
+        self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def _publish(self, channel: str, message: bytes) -> None:
+        self._write("INSERT INTO messages (channel, payload, created_at) VALUES (?, ?, ?)", (channel, message, time.time()))
+        self.published += 1
+
+    def _last_message_id(self) -> int:
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    def _messages_after(self, cursor: int) -> list:
+        return self._connect().execute(
+            "SELECT id, channel, payload FROM messages WHERE id > ? ORDER BY id LIMIT 1000", (cursor,)
+        ).fetchall()
+
+    async def subscribe(self, channel: str) -> Subscription:
+        # Register before reading the start id so no message falls between the two
+        subscription = _QueueSubscription(self._subscribers, channel)
+        subscription.start = await self._call(self._last_message_id)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.get_running_loop().create_task(self._poll(subscription.start))
+        return subscription
+
+    async def _poll(self, cursor: int) -> None:
+        failures = 0
+        while self._subscribers:
+            try:
+                rows = await self._call(self._messages_after, cursor)
+            except sqlite3.Error as e:
+                # Keep the cursor and retry, so a locked database delays messages instead of losing them
+                failures += 1
+                self.poll_errors += 1
+                print(f"Shared state poll failed ({e}), retrying")
+                await asyncio.sleep(min(self.poll_seconds * 2 ** failures, 1.0))
+                continue
+            failures = 0
+            self.polls += 1
+            for message_id, channel, payload in rows:
+                cursor = message_id
+                for subscription in self._subscribers.get(channel, ()):
+                    subscription.queue.put_nowait((message_id, bytes(payload)))
+            if len(rows) < 1000:
+                await asyncio.sleep(self.poll_seconds)
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "path": self.path, "published": self.published, "polls": self.polls,
+                "poll_errors": self.poll_errors, "channels": len(self._subscribers)}
+
+
+def create_shared_state(backend: str = SHARED_STATE_BACKEND) -> SharedState:
+    if backend == "sqlite":
+        return SQLiteState()
+    if backend != "memory":
+        print(f"WARNING: Unknown SHARED_STATE_BACKEND {backend!r}, using memory")
+    return MemoryState()
+
+
+# Shared backend used by the rate limiters, the response cache, resumable streams and token revocation
+shared_state = create_shared_state()
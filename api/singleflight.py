@@ -0,0 +1,174 @@
+# Single-flight coalescing of identical in-flight chat streams
+import asyncio
+import hashlib
+import os
+from collections import deque
+from typing import AsyncGenerator, Callable, Deque, Dict, List, Optional, Set
+from response_cache import request_fingerprint
+from streaming import StreamSummary
+
+# Byte cap on the shared chunk log of a flight; larger streams stop accepting joiners
+SINGLEFLIGHT_MAX_BYTES = int(os.getenv("SINGLEFLIGHT_MAX_BYTES", str(1024 * 1024)))
+# How far (bytes) one subscriber may fall behind the upstream before it is detached
+SINGLEFLIGHT_MAX_LAG_BYTES = int(os.getenv("SINGLEFLIGHT_MAX_LAG_BYTES", str(1024 * 1024)))
+
+
+class SubscriberLagged(Exception):
+    """Raised to a subscriber that fell too far behind its flight"""
+
+
+class _Flight:
+    """One upstream stream shared by every subscriber; chunk k is chunks[k - first]"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: Deque[str] = deque()
+        self.first = 0
+        self.size = 0
+        self.appended = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.joinable = True
+        self.subscribers = 0
+        # Chunk index and bytes read per subscriber; detached ones land in lagging
+        self.cursors: Dict[object, int] = {}
+        self.read: Dict[object, int] = {}
+        self.lagging: Set[object] = set()
+        self.summary = StreamSummary()
+        self.task: Optional[asyncio.Task] = None
+        self.changed = asyncio.Event()
+
+    def wake(self) -> None:
+        # Swap in a fresh event so waiters see each publish exactly once
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def trim(self) -> None:
+        # Once nobody can join, drop the prefix every subscriber has read
+        if self.joinable:
+            return
+        oldest = min(self.cursors.values(), default=self.first + len(self.chunks))
+        if oldest > self.first:
+            while self.first < oldest:
+                self.size -= len(self.chunks.popleft())
+                self.first += 1
+
+    def detach_laggards(self, max_lag: int) -> int:
+        """Detach subscribers more than max_lag bytes behind, so trim can move past them"""
+        laggards = [token for token, read in self.read.items() if self.appended - read > max_lag]
+        for token in laggards:
+            self.lagging.add(token)
+            del self.cursors[token]
+            del self.read[token]
+        return len(laggards)
+
+
+class SingleFlight:
+    """Attaches concurrent identical requests to one upstream stream
+
+    A background task drains the upstream into the flight's chunk log and never
+    waits on subscribers. Each subscriber reads the log through its own cursor,
+    so a slow reader only falls behind itself. Joiners replay the whole log, so
+    it is kept only up to max_bytes; past that the flight stops accepting new
+    subscribers and the prefix every subscriber has read is dropped, leaving
+    just the slowest reader's backlog. A reader more than max_lag_bytes behind
+    is detached with SubscriberLagged, so that backlog stays bounded too. The
+    upstream is cancelled once every
+    subscriber has gone. The factory fills the flight's summary, which every
+    subscriber copies into its own when the stream ends.
+    """
+
+    def __init__(self, max_bytes: int = SINGLEFLIGHT_MAX_BYTES, max_lag_bytes: int = SINGLEFLIGHT_MAX_LAG_BYTES):
+        self.max_bytes = max_bytes
+        self.max_lag_bytes = max_lag_bytes
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.lagged = 0
+
+    @staticmethod
+    def key_for(api_key: str, model: str, messages: List[Dict[str, str]], params: Optional[dict] = None,
+                usage_scope: Optional[tuple] = None) -> str:
+        """Flights are scoped per API key and usage scope so coalesced usage stays on the right account"""
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest()[:16]
+        # Only the leader's stream records usage, so every subscriber must be billed to the same scope
+        scope = ":".join(str(part) for part in usage_scope) if usage_scope is not None else "-"
+        return f"{key_hash}:{scope}:{request_fingerprint(model, messages, params)}"
+
+    async def stream(self, key: str, factory: Callable[[StreamSummary], AsyncGenerator[str, None]],
+                     summary: Optional[StreamSummary] = None) -> AsyncGenerator[str, None]:
+        """Yield the chunks of the flight for key, starting it if none is joinable"""
+        flight = self._flights.get(key)
+        if flight is None or not flight.joinable:
+            flight = _Flight(key)
+            self._flights[key] = flight
+            flight.task = asyncio.get_running_loop().create_task(self._produce(flight, factory))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        flight.subscribers += 1
+        token = object()
+        cursor = flight.cursors[token] = 0
+        read = flight.read[token] = 0
+        try:
+            while True:
+                changed = flight.changed
+                while token not in flight.lagging and cursor < flight.first + len(flight.chunks):
+                    chunk = flight.chunks[cursor - flight.first]
+                    cursor = flight.cursors[token] = cursor + 1
+                    read = flight.read[token] = read + len(chunk)
+                    yield chunk
+                if token in flight.lagging:
+                    raise SubscriberLagged(f"Fell more than {self.max_lag_bytes} bytes behind the shared stream")
+                flight.trim()
+                if flight.done:
+                    if summary is not None:
+                        summary.copy_from(flight.summary)
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await changed.wait()
+        finally:
+            flight.subscribers -= 1
+            flight.cursors.pop(token, None)
+            flight.read.pop(token, None)
+            flight.lagging.discard(token)
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is listening any more; stop paying for the upstream
+                self._retire(flight)
+                flight.task.cancel()
+
+    async def _produce(self, flight: _Flight, factory: Callable[[StreamSummary], AsyncGenerator[str, None]]) -> None:
+        upstream = factory(flight.summary)
+        try:
+            async for chunk in upstream:
+                flight.chunks.append(chunk)
+                flight.size += len(chunk)
+                flight.appended += len(chunk)
+                if flight.joinable and flight.size > self.max_bytes:
+                    self._retire(flight)
+                if flight.size > self.max_lag_bytes:
+                    lagged = flight.detach_laggards(self.max_lag_bytes)
+                    if lagged:
+                        self.lagged += lagged
+                        flight.trim()
+                flight.wake()
+        except Exception as e:
+            flight.error = e
+        finally:
+            await upstream.aclose()
+            flight.done = True
+            self._retire(flight)
+            flight.wake()
+
+    def _retire(self, flight: _Flight) -> None:
+        flight.joinable = False
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "followers": self.followers, "lagged": self.lagged}
+
+
+# Shared coalescing layer used by the chat endpoints
+single_flight = SingleFlight()
@@ -1,76 +1,142 @@
 #!/usr/bin/env python3
 """
-Startup debug script to test if the FastAPI app can be imported and started
+Startup profiler: where does a cold start spend its time?
+
+Reports, each measured in a fresh interpreter like a serverless cold start:
+  - per-module import time of `import app` (python -X importtime)
+  - schema setup time for a new database and for one that is already current
+  - time from spawning uvicorn to the first successful GET /api/health
+
+Usage: python startup_debug.py [--runs 3] [--top 15] [--port 8106] [--json]
 """
+import argparse
+import json
 import os
+import statistics
+import subprocess
 import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, List, Optional
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def fresh_env(db_path: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env["DATABASE_URL"] = f"sqlite:///{db_path}"
+    return env
+
+
+def remove_db(db_path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
+def import_profile(env: Dict[str, str]) -> List[dict]:
+    """Run `import app` under -X importtime and return one entry per module"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=API_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        # "import time:  self [us] | cumulative | <indent>module"; the indent is the nesting depth
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append({"module": name.strip(), "depth": depth, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    return modules
+
+
+def direct_imports(modules: List[dict], parent: str) -> List[dict]:
+    """Modules imported directly by parent; importtime lists children just before their parent"""
+    index = next(i for i, m in enumerate(modules) if m["module"] == parent)
+    children = []
+    for module in reversed(modules[:index]):
+        if module["depth"] <= modules[index]["depth"]:
+            break
+        if module["depth"] == modules[index]["depth"] + 1:
+            children.append(module)
+    return children
+
+
+def schema_setup_ms(env: Dict[str, str]) -> float:
+    code = "import time, migrations; t = time.perf_counter(); migrations.run_migrations(); print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=API_DIR, env=env, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1]) * 1000
+
+
+def time_to_first_request(env: Dict[str, str], port: int) -> Optional[float]:
+    """Seconds from spawning uvicorn until /api/health answers 200"""
+    url = f"http://127.0.0.1:{port}/api/health"
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=API_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < 60:
+            try:
+                with urllib.request.urlopen(url, timeout=5) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        return None
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="cold starts per measurement (median is reported)")
+    parser.add_argument("--top", type=int, default=15, help="modules to list by cumulative import time")
+    parser.add_argument("--port", type=int, default=8106, help="port for the uvicorn cold starts")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.gettempdir(), "startup_profile.db")
+    env = fresh_env(db_path)
+    remove_db(db_path)
+
+    profiles = [import_profile(env) for _ in range(args.runs)]
+    totals = [next(m["cumulative_ms"] for m in profile if m["module"] == "app") for profile in profiles]
+    profile = profiles[totals.index(sorted(totals)[len(totals) // 2])]
+    listed = sorted(direct_imports(profile, "app"), key=lambda m: -m["cumulative_ms"])[:args.top]
+
+    remove_db(db_path)
+    schema_new = schema_setup_ms(env)
+    schema_current = statistics.median(schema_setup_ms(env) for _ in range(args.runs))
+    first_requests = [time_to_first_request(env, args.port) for _ in range(args.runs)]
+    measured = [value for value in first_requests if value is not None]
+    remove_db(db_path)
+
+    report = {
+        "python": sys.version.split()[0],
+        "import_app_ms": round(statistics.median(totals), 1),
+        "top_imports": [{"module": m["module"], "cumulative_ms": round(m["cumulative_ms"], 1)} for m in listed],
+        "lazy_modules_loaded": sorted({m["module"] for m in profile} & {"openai", "passlib", "jose", "cryptography", "tiktoken"}),
+        "schema_setup_new_db_ms": round(schema_new, 1),
+        "schema_setup_current_db_ms": round(schema_current, 1),
+        "time_to_first_health_ms": round(statistics.median(measured) * 1000, 1) if measured else None,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"=== Startup profile (Python {report['python']}, median of {args.runs}) ===")
+    print(f"import app: {report['import_app_ms']} ms")
+    for module in report["top_imports"]:
+        print(f"  {module['cumulative_ms']:>8.1f} ms  {module['module']}")
+    print(f"heavy dependencies imported at startup: {', '.join(report['lazy_modules_loaded']) or 'none'}")
+    print(f"schema setup: {report['schema_setup_new_db_ms']} ms on a new database, "
+          f"{report['schema_setup_current_db_ms']} ms when already current")
+    print(f"spawn to first 200 from /api/health: {report['time_to_first_health_ms']} ms")
+
 
-print("=== Startup Debug Script ===")
-print(f"Python version: {sys.version}")
-print(f"Current working directory: {os.getcwd()}")
-print(f"Files in current directory: {os.listdir('.')}")
-
-# Test environment variables
-print("\n=== Environment Variables ===")
-print(f"OPENAI_API_KEY: {'Set' if os.getenv('OPENAI_API_KEY') else 'Not set'}")
-print(f"SECRET_KEY: {'Set' if os.getenv('SECRET_KEY') else 'Not set'}")
-print(f"ENCRYPTION_KEY: {'Set' if os.getenv('ENCRYPTION_KEY') else 'Not set'}")
-print(f"PORT: {os.getenv('PORT', 'Not set')}")
-
-# Test imports
-print("\n=== Testing Imports ===")
-try:
-    print("Importing FastAPI...")
-    from fastapi import FastAPI
-    print("✓ FastAPI imported successfully")
-except Exception as e:
-    print(f"✗ FastAPI import failed: {e}")
-
-try:
-    print("Importing database...")
-    from database import get_db, create_tables
-    print("✓ Database imported successfully")
-except Exception as e:
-    print(f"✗ Database import failed: {e}")
-
-try:
-    print("Importing models...")
-    from models import User, UserAPIKey
-    print("✓ Models imported successfully")
-except Exception as e:
-    print(f"✗ Models import failed: {e}")
-
-try:
-    print("Importing auth...")
-    from auth import verify_password, get_password_hash, create_access_token, verify_token, encrypt_api_key, decrypt_api_key
-    print("✓ Auth imported successfully")
-except Exception as e:
-    print(f"✗ Auth import failed: {e}")
-
-try:
-    print("Importing schemas...")
-    from schemas import UserCreate, UserLogin, UserResponse, Token, APIKeyCreate, APIKeyResponse, ChatRequest
-    print("✓ Schemas imported successfully")
-except Exception as e:
-    print(f"✗ Schemas import failed: {e}")
-
-try:
-    print("Importing OpenAI...")
-    from openai import OpenAI
-    print("✓ OpenAI imported successfully")
-except Exception as e:
-    print(f"✗ OpenAI import failed: {e}")
-
-# Test app import
-print("\n=== Testing App Import ===")
-try:
-    print("Importing app...")
-    from app import app
-    print("✓ App imported successfully")
-    print(f"App title: {app.title}")
-except Exception as e:
-    print(f"✗ App import failed: {e}")
-    import traceback
-    print(f"Traceback: {traceback.format_exc()}")
-
-print("\n=== Debug Complete ===")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# Async streaming engine shared by the chat endpoints
+import os
+import time
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+import anyio
+from fastapi import Request
+# Pooled async OpenAI clients so chunk reads never block the event loop
+from client_pool import client_pool
+from response_cache import response_cache
+from tokens import count_message_tokens, count_tokens
+from usage import UsageScope, usage_accumulator
+
+# How often (seconds) a stream checks whether its client is still connected
+DISCONNECT_CHECK_INTERVAL = float(os.getenv("DISCONNECT_CHECK_INTERVAL", "0.25"))
+# Ask the upstream for a final usage chunk (disable for servers without stream_options)
+STREAM_INCLUDE_USAGE = os.getenv("STREAM_INCLUDE_USAGE", "1") == "1"
+
+# Outcome of a stream closed because a hedged twin answered first
+HEDGE_CANCELLED = "hedge_cancelled"
+
+
+class StreamCounters:
+    """Counters for finished, cancelled and failed streams
+
+    Hedge losers are counted apart from client cancellations: nobody was
+    waiting for them, so aborting them saved no tokens anyone asked for.
+    """
+
+    def __init__(self):
+        self.completed = 0
+        self.cancelled = 0
+        self.hedge_cancelled = 0
+        self.errors = 0
+        self.completed_chunks = 0
+        self.estimated_tokens_saved = 0
+
+    def record(self, outcome: str, chunks: int) -> None:
+        """Record how a stream ended and how many content chunks it emitted"""
+        if outcome == "completed":
+            self.completed += 1
+            self.completed_chunks += chunks
+        elif outcome == "cancelled":
+            self.cancelled += 1
+            # Each streamed delta is roughly one token, so the tokens saved by
+            # aborting are estimated against the average completed stream
+            if self.completed:
+                average = self.completed_chunks / self.completed
+                self.estimated_tokens_saved += max(int(average) - chunks, 0)
+        elif outcome == HEDGE_CANCELLED:
+            self.hedge_cancelled += 1
+        else:
+            self.errors += 1
+
+    def stats(self) -> dict:
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "hedge_cancelled": self.hedge_cancelled,
+            "errors": self.errors,
+            "estimated_tokens_saved": self.estimated_tokens_saved,
+        }
+
+
+# Shared counters reported by /api/stats
+stream_counters = StreamCounters()
+
+
+class StreamSummary:
+    """How a stream ended; filled in by stream_chat_completion for final events"""
+
+    def __init__(self):
+        self.model: Optional[str] = None
+        self.finish_reason: Optional[str] = None
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.estimated = False
+        self.cached = False
+
+    def as_dict(self) -> dict:
+        usage = None
+        if self.prompt_tokens is not None:
+            usage = {"prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens, "estimated": self.estimated}
+        return {"model": self.model, "finish_reason": self.finish_reason, "usage": usage, "cached": self.cached}
+
+    def copy_from(self, other: "StreamSummary") -> None:
+        self.__dict__.update(other.__dict__)
+
+
+class CancelReason:
+    """Set by whoever closes a stream early to record why, before closing it"""
+
+    __slots__ = ("outcome",)
+
+    def __init__(self):
+        self.outcome = "cancelled"
+
+
+def build_messages(developer_message: str, user_message: str) -> List[Dict[str, str]]:
+    """Build the chat messages list sent upstream"""
+    return [
+        {"role": "system", "content": developer_message},
+        {"role": "user", "content": user_message}
+    ]
+
+
+async def stream_chat_completion(api_key: str, model: str, messages: List[Dict[str, str]], request: Optional[Request] = None,
+                                 cache_key: Optional[str] = None, params: Optional[dict] = None,
+                                 usage_scope: Optional[UsageScope] = None, summary: Optional[StreamSummary] = None,
+                                 cancel_reason: Optional[CancelReason] = None) -> AsyncGenerator[str, None]:
+    """Stream content deltas for a chat completion without blocking the event loop
+
+    When the originating request is given, the upstream stream is aborted as
+    soon as the client disconnects instead of running to completion. With a
+    cache_key, a cached response is replayed and completed streams are stored.
+    Extra params (e.g. temperature) are passed through to the upstream call.
+    With a usage_scope, token counts and duration are recorded for it; a
+    summary receives the finish reason and token counts when the stream ends.
+    A stream closed early is recorded with the outcome in cancel_reason.
+    """
+    started = time.monotonic()
+    if cache_key is not None:
+        cached_chunks = await response_cache.get(cache_key)
+        if cached_chunks is not None:
+            for content in cached_chunks:
+                yield content
+            if usage_scope is not None:
+                usage_accumulator.record(usage_scope, model, 0, 0, time.monotonic() - started, cached=True)
+            if summary is not None:
+                summary.model, summary.finish_reason, summary.cached = model, "stop", True
+            return
+    collected = []
+    outcome = "cancelled"
+    chunks = 0
+    usage = None
+    finish_reason = None
+    if STREAM_INCLUDE_USAGE:
+        params = {**(params or {}), "stream_options": {"include_usage": True}}
+    async with client_pool.lease(api_key) as client:
+        try:
+            # Create a streaming chat completion request; chunks are read as plain
+            # dicts, since building the SDK's typed chunk models dominated per-chunk CPU
+            from openai import AsyncStream
+            stream = await client.post(
+                "/chat/completions",
+                body={"model": model, "messages": messages, "stream": True, **(params or {})},
+                cast_to=object,
+                stream=True,  # Enable streaming response
+                stream_cls=AsyncStream[object],
+            )
+        except Exception:
+            stream_counters.record("error", 0)
+            raise
+        try:
+            next_check = time.monotonic() + DISCONNECT_CHECK_INTERVAL
+            # Yield each chunk of the response as it becomes available
+            async for chunk in stream:
+                if request is not None and time.monotonic() >= next_check:
+                    if await request.is_disconnected():
+                        print("Client disconnected, aborting upstream stream")
+                        break
+                    next_check = time.monotonic() + DISCONNECT_CHECK_INTERVAL
+                if chunk.get("usage") is not None:
+                    usage = chunk["usage"]
+                choices = chunk.get("choices")
+                if choices:
+                    if choices[0].get("finish_reason") is not None:
+                        finish_reason = choices[0]["finish_reason"]
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content is not None:
+                        chunks += 1
+                        collected.append(content)
+                        yield content
+            else:
+                outcome = "completed"
+                if cache_key is not None:
+                    response_cache.put(cache_key, collected)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            # Release the upstream connection even if the consumer stops early;
+            # shield it so a cancelled response task still closes the socket
+            with anyio.CancelScope(shield=True):
+                await stream.close()
+            if outcome == "cancelled" and cancel_reason is not None:
+                outcome = cancel_reason.outcome
+            stream_counters.record(outcome, chunks)
+            if outcome != "error" and (usage_scope is not None or summary is not None):
+                prompt_tokens, completion_tokens, estimated = usage_counts(model, messages, collected, usage)
+                if usage_scope is not None:
+                    usage_accumulator.record(usage_scope, model, prompt_tokens, completion_tokens,
+                                             time.monotonic() - started, estimated=estimated)
+                # A hedge loser's summary would describe the attempt the client never saw
+                if summary is not None and outcome != HEDGE_CANCELLED:
+                    summary.model = model
+                    summary.finish_reason = finish_reason if outcome == "completed" else "cancelled"
+                    summary.prompt_tokens, summary.completion_tokens, summary.estimated = prompt_tokens, completion_tokens, estimated
+
+
+def usage_counts(model: str, messages: List[Dict[str, str]], collected: List[str], usage: Optional[dict]) -> Tuple[int, int, bool]:
+    """Return (prompt, completion, estimated), counting locally when the upstream sent no usage"""
+    if usage is not None:
+        return usage["prompt_tokens"], usage["completion_tokens"], False
+    # Aborted streams (and servers without include_usage) end without a usage chunk
+    prompt_tokens = count_message_tokens(messages, model)
+    completion_tokens = count_tokens("".join(collected), model) if collected else 0
+    return prompt_tokens, completion_tokens, True
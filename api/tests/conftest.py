@@ -0,0 +1,34 @@
+# Shared test setup: an isolated database and demo key before any app module is imported
+import os
+import tempfile
+import pytest
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/test.db")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("SHARED_STATE_BACKEND", "memory")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class FakeClock:
+    """Monotonic clock that only moves when a test advances it"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
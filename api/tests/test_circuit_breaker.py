@@ -0,0 +1,102 @@
+import types
+import httpx
+import openai
+import pytest
+import circuit_breaker
+from circuit_breaker import AUTH, CLOSED, HALF_OPEN, OPEN, QUOTA, RATE_LIMIT, SERVER, TIMEOUT, BreakerOpen, KeyBreakers, classify_failure
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def status_error(status: int, code: str = None) -> openai.APIStatusError:
+    response = httpx.Response(status, request=REQUEST)
+    return openai.APIStatusError("upstream error", response=response, body={"code": code} if code else None)
+
+
+@pytest.fixture
+def breakers(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return KeyBreakers(threshold=3, open_seconds=30, key_error_open_seconds=300)
+
+
+def test_transient_failures_open_after_the_threshold(breakers):
+    for _ in range(2):
+        breakers.record_failure(1, SERVER)
+        assert breakers.allow(1)
+    breakers.record_failure(1, SERVER)
+    assert breakers.health(1)["state"] == OPEN
+    assert not breakers.allow(1)
+    with pytest.raises(BreakerOpen) as raised:
+        breakers.check(1)
+    assert raised.value.failure == SERVER
+    assert breakers.stats()["rejected"] == 2
+
+
+def test_success_resets_the_consecutive_count(breakers):
+    breakers.record_failure(1, TIMEOUT)
+    breakers.record_failure(1, TIMEOUT)
+    breakers.record_success(1)
+    breakers.record_failure(1, TIMEOUT)
+    assert breakers.health(1)["state"] == CLOSED
+
+
+def test_key_errors_open_at_once_for_longer(breakers, clock):
+    breakers.record_failure(1, AUTH)
+    assert not breakers.allow(1)
+    clock.advance(31)
+    assert not breakers.allow(1)
+    clock.advance(300)
+    assert breakers.allow(1)
+
+
+def test_half_open_lets_one_probe_through(breakers, clock):
+    for _ in range(3):
+        breakers.record_failure(1, SERVER)
+    clock.advance(30)
+    assert breakers.health(1)["state"] == HALF_OPEN
+    assert breakers.allow(1)
+    assert not breakers.allow(1)
+
+    breakers.record_success(1)
+    assert breakers.health(1)["state"] == CLOSED
+    assert breakers.allow(1) and breakers.allow(1)
+
+
+def test_failed_probe_reopens(breakers, clock):
+    for _ in range(3):
+        breakers.record_failure(1, SERVER)
+    clock.advance(30)
+    assert breakers.allow(1)
+    breakers.record_failure(1, RATE_LIMIT)
+    assert breakers.health(1)["state"] == OPEN
+    assert not breakers.allow(1)
+
+
+def test_released_probe_can_be_claimed_again(breakers, clock):
+    for _ in range(3):
+        breakers.record_failure(1, SERVER)
+    clock.advance(30)
+    assert breakers.allow(1)
+    breakers.release_probe(1)
+    assert breakers.allow(1)
+
+
+def test_breakers_are_per_key(breakers):
+    breakers.record_failure(1, AUTH)
+    assert not breakers.allow(1)
+    assert breakers.allow(2)
+
+
+@pytest.mark.parametrize("error, failure", [
+    (status_error(401), AUTH),
+    (status_error(403), AUTH),
+    (status_error(429), RATE_LIMIT),
+    (status_error(429, "insufficient_quota"), QUOTA),
+    (status_error(503), SERVER),
+    (status_error(400), None),
+    (openai.APITimeoutError(request=REQUEST), TIMEOUT),
+    (openai.APIConnectionError(request=REQUEST), circuit_breaker.CONNECTION),
+    (ValueError("not upstream"), None),
+])
+def test_classify_failure(error, failure):
+    assert classify_failure(error) == failure
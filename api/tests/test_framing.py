@@ -0,0 +1,53 @@
+import asyncio
+import json
+import pytest
+from framing import NDJSON, SSE, frame_stream
+from streaming import StreamSummary
+
+pytestmark = pytest.mark.anyio
+
+
+async def deltas(*chunks, error: Exception = None, delay: float = 0):
+    for chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        yield chunk
+    if error is not None:
+        raise error
+
+
+async def ndjson(stream) -> list:
+    return [json.loads(line) async for line in stream]
+
+
+async def test_deltas_are_numbered_and_end_with_done():
+    summary = StreamSummary()
+    summary.model, summary.finish_reason = "gpt-4o-mini", "stop"
+    events = await ndjson(frame_stream(deltas("a", "b", "c"), NDJSON, summary, coalesce_ms=0))
+    assert [(event["type"], event["seq"]) for event in events] == [("delta", 0), ("delta", 1), ("delta", 2), ("done", 3)]
+    assert "".join(event["delta"] for event in events[:-1]) == "abc"
+    assert events[-1]["model"] == "gpt-4o-mini" and events[-1]["finish_reason"] == "stop"
+
+
+async def test_upstream_error_ends_with_an_error_event_instead_of_done():
+    events = await ndjson(frame_stream(deltas("a", error=RuntimeError("boom")), NDJSON, coalesce_ms=0))
+    assert [(event["type"], event["seq"]) for event in events] == [("delta", 0), ("error", 1)]
+    assert events[-1]["error"] == "boom"
+
+
+async def test_sse_events_carry_the_seq_as_id():
+    events = [event async for event in frame_stream(deltas("a", "b"), SSE, coalesce_ms=0)]
+    assert events[0] == 'id: 0\nevent: delta\ndata: {"seq":0,"delta":"a"}\n\n'
+    assert events[-1].startswith("id: 2\nevent: done\n")
+
+
+async def test_close_deltas_are_coalesced():
+    events = await ndjson(frame_stream(deltas("a", "b", "c"), NDJSON, coalesce_ms=1000))
+    assert [(event["type"], event["seq"]) for event in events] == [("delta", 0), ("done", 1)]
+    assert events[0]["delta"] == "abc"
+
+
+async def test_coalescing_flushes_at_the_char_limit():
+    events = await ndjson(frame_stream(deltas("ab", "cd", "e"), NDJSON, coalesce_chars=4, coalesce_ms=1000))
+    assert [event.get("delta") for event in events] == ["abcd", "e", None]
+    assert [event["seq"] for event in events] == [0, 1, 2]
@@ -0,0 +1,85 @@
+import threading
+import pytest
+from sqlalchemy import create_engine, event, inspect, text
+import migrations
+from database import Base, set_sqlite_pragmas
+from models import Message, UserAPIKey
+
+# user_api_keys and messages as they were before migrations 1 and 2
+LEGACY_TABLES = [
+    """CREATE TABLE user_api_keys (
+        id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, encrypted_api_key TEXT NOT NULL,
+        key_name VARCHAR(100), is_active BOOLEAN, created_at DATETIME, last_used DATETIME)""",
+    """CREATE TABLE messages (
+        id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+        role VARCHAR(16) NOT NULL, body BLOB NOT NULL, compressed BOOLEAN NOT NULL,
+        token_count INTEGER NOT NULL, created_at DATETIME)""",
+]
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path}/legacy.db", connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    monkeypatch.setattr(migrations, "engine", engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def legacy_engine(engine):
+    """A database created before the migrations, with keys of a deleted user"""
+    legacy = {UserAPIKey.__table__.name, Message.__table__.name}
+    Base.metadata.create_all(engine, tables=[table for table in Base.metadata.sorted_tables if table.name not in legacy])
+    with engine.begin() as conn:
+        for statement in LEGACY_TABLES:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO users (id, username, email, hashed_password) VALUES (1, 'alice', 'a@x.com', 'h')"))
+        conn.execute(text("INSERT INTO user_api_keys (user_id, encrypted_api_key, key_name, is_active) "
+                          "VALUES (1, 'k1', 'alice', 1), (99, 'k2', 'orphan', 1), (99, 'k3', 'orphan', 0)"))
+        conn.execute(text("INSERT INTO conversations (id, user_id, title, model) VALUES (1, 1, 't', 'gpt-4o-mini')"))
+        conn.execute(text("INSERT INTO messages (conversation_id, role, body, compressed, token_count) "
+                          "VALUES (1, 'user', x'6869', 0, 1)"))
+    return engine
+
+
+def test_upgrades_a_legacy_database_with_orphan_rows(legacy_engine):
+    assert migrations.run_migrations() == [1, 2]
+
+    inspector = inspect(legacy_engine)
+    assert [fk["referred_table"] for fk in inspector.get_foreign_keys("user_api_keys")] == ["users"]
+    assert "ix_user_api_keys_user_id_is_active" in {index["name"] for index in inspector.get_indexes("user_api_keys")}
+    assert "truncated" in {column["name"] for column in inspector.get_columns("messages")}
+    with legacy_engine.connect() as conn:
+        assert conn.execute(text("SELECT user_id, key_name FROM user_api_keys")).all() == [(1, "alice")]
+        assert conn.execute(text("SELECT role, truncated FROM messages")).all() == [("user", 0)]
+
+
+def test_migrations_are_idempotent(legacy_engine):
+    migrations.run_migrations()
+    assert migrations.run_migrations() == []
+    with legacy_engine.connect() as conn:
+        assert conn.execute(text("SELECT version FROM schema_migrations ORDER BY version")).scalars().all() == [1, 2]
+        assert conn.execute(text("SELECT count(*) FROM user_api_keys")).scalar() == 1
+
+
+def test_fresh_database_records_every_migration(engine):
+    assert migrations.run_migrations() == [version for version, _, _ in migrations.MIGRATIONS]
+    with engine.connect() as conn:
+        assert migrations.schema_is_current(conn)
+
+
+def test_concurrent_runs_apply_each_migration_once(legacy_engine):
+    results = []
+    barrier = threading.Barrier(3)
+
+    def run():
+        barrier.wait()
+        results.append(migrations.run_migrations())
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [[], [], [1, 2]]
@@ -0,0 +1,75 @@
+import types
+import pytest
+from fastapi.testclient import TestClient
+import shared_state as shared_state_module
+from rate_limit import Lease, RateLimited, RateLimiter, admit, demo_ip_limiter
+from shared_state import MemoryState
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def state(clock, monkeypatch):
+    monkeypatch.setattr(shared_state_module, "time", types.SimpleNamespace(monotonic=clock.monotonic, time=clock.time))
+    return MemoryState()
+
+
+async def test_bucket_allows_a_burst_then_refills(state, clock):
+    limiter = RateLimiter("t", 60, 0, state=state)
+    for _ in range(60):
+        await limiter.acquire("u", Lease())
+    with pytest.raises(RateLimited) as raised:
+        await limiter.acquire("u", Lease())
+    assert raised.value.retry_after == 1
+
+    clock.advance(1)
+    await limiter.acquire("u", Lease())
+    with pytest.raises(RateLimited):
+        await limiter.acquire("u", Lease())
+    assert limiter.stats() == {"admitted": 61, "rejected": 2, "throttled": 0}
+
+
+async def test_buckets_are_per_key(state):
+    limiter = RateLimiter("t", 1, 0, state=state)
+    await limiter.acquire("a", Lease())
+    with pytest.raises(RateLimited) as raised:
+        await limiter.acquire("a", Lease())
+    assert raised.value.retry_after == 60
+    await limiter.acquire("b", Lease())
+
+
+async def test_concurrency_slots_are_returned_on_release(state):
+    limiter = RateLimiter("t", 0, 2, state=state)
+    first, second = Lease(), Lease()
+    await limiter.acquire("u", first)
+    await limiter.acquire("u", second)
+    with pytest.raises(RateLimited):
+        await limiter.acquire("u", Lease())
+
+    first.release()
+    first.release()
+    await limiter.acquire("u", Lease())
+    assert await state.get_count("rl:t:u:active") == 2
+
+
+async def test_admit_releases_earlier_slots_when_a_later_check_fails(state):
+    user = RateLimiter("user", 0, 4, state=state)
+    key = RateLimiter("key", 0, 1, state=state)
+    await admit((user, 1), (key, 7))
+    with pytest.raises(RateLimited) as raised:
+        await admit((user, 1), (key, 7))
+    assert raised.value.limiter == "key"
+    assert await state.get_count("rl:user:1:active") == 1
+
+
+def test_over_the_limit_is_a_429_with_retry_after(monkeypatch):
+    import app
+    monkeypatch.setattr(demo_ip_limiter, "rate", 1 / 60)
+    monkeypatch.setattr(demo_ip_limiter, "capacity", 0.5)
+    monkeypatch.setattr(demo_ip_limiter, "name", "client_ip_test")
+    client = TestClient(app.app)
+    response = client.post("/api/chat-demo", json={"developer_message": "d", "user_message": "hi", "use_demo_mode": True})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    # The concurrency slot taken before the bucket check is handed back
+    assert app.shared_state._get_count("rl:client_ip_test:testclient:active") == 0
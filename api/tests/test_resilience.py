@@ -0,0 +1,120 @@
+import asyncio
+import httpx
+import openai
+import pytest
+import resilience
+from circuit_breaker import KeyBreakers
+from resilience import is_retryable, resilient_stream
+from streaming import HEDGE_CANCELLED
+
+pytestmark = pytest.mark.anyio
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def status_error(status: int, code: str = None) -> openai.APIStatusError:
+    response = httpx.Response(status, request=REQUEST)
+    return openai.APIStatusError("upstream error", response=response, body={"code": code} if code else None)
+
+
+class Attempts:
+    """open_attempt stand-in; behaviours[n] drives the nth attempt"""
+
+    def __init__(self, *behaviours):
+        self.behaviours = list(behaviours)
+        self.models = []
+        self.reasons = []
+
+    def __call__(self, model, cancel_reason):
+        behaviour = self.behaviours[len(self.models)]
+        self.models.append(model)
+        self.reasons.append(cancel_reason)
+        return behaviour(model)
+
+
+def answer(delay: float = 0, chunks=("a", "b")):
+    async def stream(model):
+        await asyncio.sleep(delay)
+        for chunk in chunks:
+            yield f"{model}:{chunk}"
+    return stream
+
+
+def fail(error: Exception):
+    async def stream(model):
+        raise error
+        yield
+    return stream
+
+
+async def collect(stream) -> list:
+    return [chunk async for chunk in stream]
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    monkeypatch.setattr(resilience, "backoff_delay", lambda failures: 0)
+    monkeypatch.setattr(resilience, "resilience_counters", resilience.ResilienceCounters())
+    monkeypatch.setattr(resilience, "key_breakers", KeyBreakers())
+
+
+async def test_hedge_wins_when_the_first_attempt_is_slow():
+    attempts = Attempts(answer(delay=5), answer())
+    chunks = await collect(resilient_stream(attempts, "m", fallbacks=[], hedge_after=0.01))
+    assert chunks == ["m:a", "m:b"]
+    assert len(attempts.models) == 2
+    assert attempts.reasons[0].outcome == HEDGE_CANCELLED
+    assert resilience.resilience_counters.stats()["hedge_wins"] == 1
+
+
+async def test_no_hedge_when_content_arrives_in_time():
+    attempts = Attempts(answer(delay=0), answer())
+    chunks = await collect(resilient_stream(attempts, "m", fallbacks=[], hedge_after=1))
+    assert chunks == ["m:a", "m:b"]
+    assert len(attempts.models) == 1
+    assert resilience.resilience_counters.hedged == 0
+
+
+async def test_retryable_failure_moves_down_the_fallbacks():
+    attempts = Attempts(fail(status_error(503)), fail(openai.APIConnectionError(request=REQUEST)), answer())
+    chunks = await collect(resilient_stream(attempts, "big", fallbacks=["small"], retries=2, hedge_after=0))
+    assert chunks == ["small:a", "small:b"]
+    assert attempts.models == ["big", "small", "small"]
+    assert resilience.resilience_counters.retries == 2
+
+
+async def test_non_retryable_failure_is_raised_at_once():
+    attempts = Attempts(fail(status_error(400)), answer())
+    with pytest.raises(openai.APIStatusError):
+        await collect(resilient_stream(attempts, "m", fallbacks=[], hedge_after=0))
+    assert len(attempts.models) == 1
+
+
+async def test_retries_are_bounded():
+    attempts = Attempts(*[fail(status_error(500))] * 3)
+    with pytest.raises(openai.APIStatusError):
+        await collect(resilient_stream(attempts, "m", fallbacks=[], retries=2, hedge_after=0))
+    assert len(attempts.models) == 3
+    assert resilience.resilience_counters.failures == 1
+
+
+async def test_outcome_is_recorded_on_the_key_breaker():
+    attempts = Attempts(fail(status_error(401)))
+    with pytest.raises(openai.APIStatusError):
+        await collect(resilient_stream(attempts, "m", fallbacks=[], hedge_after=0, breaker_id=7))
+    assert not resilience.key_breakers.allow(7)
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (status_error(500), True),
+    (status_error(502), True),
+    (status_error(429), True),
+    (status_error(429, "insufficient_quota"), False),
+    (status_error(400), False),
+    (status_error(401), False),
+    (openai.APIConnectionError(request=REQUEST), True),
+    (openai.APITimeoutError(request=REQUEST), True),
+    (ValueError("bug"), False),
+])
+def test_is_retryable(error, retryable):
+    assert is_retryable(error) == retryable
@@ -0,0 +1,121 @@
+import asyncio
+import pytest
+from framing import NDJSON, ndjson_event
+from resumable import ResumableStreams
+from shared_state import MemoryState
+
+pytestmark = pytest.mark.anyio
+
+
+class Events:
+    """Framed events released one step at a time"""
+
+    def __init__(self, count: int):
+        self.count = count
+        self.permits = asyncio.Queue()
+        self.cancelled = False
+
+    def allow(self, steps: int = 1) -> None:
+        for _ in range(steps):
+            self.permits.put_nowait(None)
+
+    async def stream(self):
+        try:
+            for seq in range(self.count):
+                await self.permits.get()
+                yield ndjson_event("delta", {"seq": seq, "delta": f"d{seq}"})
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+def streams(**options) -> ResumableStreams:
+    return ResumableStreams(state=MemoryState(), **options)
+
+
+async def collect(stream) -> list:
+    return [event async for event in stream]
+
+
+def seqs(events: list) -> list:
+    return [int(event.split('"seq":')[1].split(",")[0]) for event in events]
+
+
+async def test_resume_replays_the_events_after_last_seq():
+    registry = streams()
+    events = Events(5)
+    finished = []
+    stream = registry.start(events.stream(), 1, NDJSON, lambda: finished.append(True))
+    first = registry.subscribe(stream)
+    events.allow(3)
+    assert seqs([await first.__anext__() for _ in range(3)]) == [0, 1, 2]
+    # The client drops after seq 2; generation keeps going without it
+    await first.aclose()
+    events.allow(2)
+    await stream.task
+    assert finished == [True]
+
+    assert await registry.can_resume(stream, 2)
+    assert seqs(await collect(registry.subscribe(stream, 2))) == [3, 4]
+    assert seqs(await collect(registry.subscribe(stream, -1))) == [0, 1, 2, 3, 4]
+    assert registry.stats()["resumed"] == 1
+
+
+async def test_resumed_subscriber_follows_the_live_stream():
+    registry = streams()
+    events = Events(4)
+    stream = registry.start(events.stream(), 1, NDJSON, lambda: None)
+    events.allow(2)
+    await asyncio.sleep(0.01)
+
+    follower = asyncio.get_running_loop().create_task(collect(registry.subscribe(stream, 0)))
+    await asyncio.sleep(0.01)
+    events.allow(2)
+    assert seqs(await follower) == [1, 2, 3]
+
+
+async def test_cannot_resume_past_the_replay_buffer():
+    event_size = len(ndjson_event("delta", {"seq": 0, "delta": "d0"}))
+    registry = streams(stream_max_bytes=2 * event_size)
+    events = Events(5)
+    stream = registry.start(events.stream(), 1, NDJSON, lambda: None)
+    events.allow(5)
+    await stream.task
+
+    assert not await registry.can_resume(stream, 0)
+    assert await registry.can_resume(stream, 2)
+    assert seqs(await collect(registry.subscribe(stream, 2))) == [3, 4]
+
+
+async def test_abandoned_generation_is_cancelled_after_the_grace_period():
+    registry = streams(grace_seconds=0.01)
+    events = Events(3)
+    stream = registry.start(events.stream(), 1, NDJSON, lambda: None)
+    subscriber = registry.subscribe(stream)
+    events.allow()
+    await subscriber.__anext__()
+    await subscriber.aclose()
+
+    await asyncio.sleep(0.05)
+    assert events.cancelled and stream.done
+    assert registry.stats()["abandoned"] == 1
+
+
+async def test_full_buffers_refuse_new_streams():
+    registry = streams(max_bytes=0)
+    events = Events(1)
+    running = registry.start(events.stream(), 1, NDJSON, lambda: None)
+    events.allow()
+    await running.task
+
+    # The finished stream is evicted to make room
+    assert registry.has_room()
+    blocker = Events(2)
+    live = registry.start(blocker.stream(), 1, NDJSON, lambda: None)
+    blocker.allow()
+    await asyncio.sleep(0.01)
+    assert not registry.has_room()
+    assert registry.start(Events(1).stream(), 1, NDJSON, lambda: None) is None
+    assert registry.stats()["refused"] == 1
+    live.task.cancel()
+    await asyncio.gather(live.task, return_exceptions=True)
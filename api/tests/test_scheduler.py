@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+from rate_limit import Lease
+from scheduler import AUTHENTICATED, DEMO, SCHEDULER_AUTH_WEIGHT, SCHEDULER_DEMO_WEIGHT, SchedulerOverloaded, StreamScheduler
+
+pytestmark = pytest.mark.anyio
+
+
+async def queue(scheduler: StreamScheduler, traffic_class: str, granted: list) -> asyncio.Task:
+    """Start a request waiting for a slot; granted records (class, lease) in grant order"""
+    async def wait() -> Lease:
+        lease = Lease()
+        await scheduler.acquire(traffic_class, lease)
+        granted.append((traffic_class, lease))
+        return lease
+    task = asyncio.get_running_loop().create_task(wait())
+    await asyncio.sleep(0)
+    return task
+
+
+async def test_runs_immediately_while_slots_are_free():
+    scheduler = StreamScheduler(max_streams=2)
+    first, second = Lease(), Lease()
+    await scheduler.acquire(AUTHENTICATED, first)
+    await scheduler.acquire(DEMO, second)
+    assert scheduler.active == 2
+    first.release()
+    second.release()
+    assert scheduler.active == 0
+
+
+async def test_freed_slots_follow_the_weights():
+    scheduler = StreamScheduler(max_streams=1, shed_demo_depth=100)
+    running = Lease()
+    await scheduler.acquire(AUTHENTICATED, running)
+    granted = []
+    rounds = SCHEDULER_AUTH_WEIGHT + SCHEDULER_DEMO_WEIGHT
+    tasks = [await queue(scheduler, DEMO, granted) for _ in range(rounds)]
+    tasks += [await queue(scheduler, AUTHENTICATED, granted) for _ in range(rounds)]
+
+    running.release()
+    for index in range(rounds):
+        while len(granted) <= index:
+            await asyncio.sleep(0)
+        granted[index][1].release()
+    order = [traffic_class for traffic_class, _ in granted[:rounds]]
+    assert order.count(AUTHENTICATED) == SCHEDULER_AUTH_WEIGHT
+    assert order.count(DEMO) == SCHEDULER_DEMO_WEIGHT
+    # Demo was queued first but only gets its share of the slots
+    assert order[0] == AUTHENTICATED
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def test_demo_traffic_is_shed_once_the_backlog_is_deep():
+    scheduler = StreamScheduler(max_streams=1, shed_demo_depth=2)
+    running = Lease()
+    await scheduler.acquire(AUTHENTICATED, running)
+    granted = []
+    queued_demo = await queue(scheduler, DEMO, granted)
+    queued_auth = await queue(scheduler, AUTHENTICATED, granted)
+
+    with pytest.raises(SchedulerOverloaded) as raised:
+        await scheduler.acquire(DEMO, Lease())
+    assert raised.value.reason == "demo traffic shed"
+
+    # Authenticated requests push queued demo requests out instead
+    late_auth = await queue(scheduler, AUTHENTICATED, granted)
+    with pytest.raises(SchedulerOverloaded):
+        await queued_demo
+    assert scheduler.stats()[DEMO]["shed"] == 2
+
+    running.release()
+    (await queued_auth).release()
+    (await late_auth).release()
+    assert [traffic_class for traffic_class, _ in granted] == [AUTHENTICATED, AUTHENTICATED]
+    assert scheduler.active == 0
+
+
+async def test_cancelled_waiter_hands_its_slot_on():
+    scheduler = StreamScheduler(max_streams=1)
+    running = Lease()
+    await scheduler.acquire(AUTHENTICATED, running)
+    granted = []
+    cancelled = await queue(scheduler, AUTHENTICATED, granted)
+    waiting = await queue(scheduler, AUTHENTICATED, granted)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+
+    running.release()
+    (await waiting).release()
+    assert len(granted) == 1
+    assert scheduler.active == 0
@@ -0,0 +1,142 @@
+import asyncio
+import pytest
+from singleflight import SingleFlight, SubscriberLagged
+from streaming import StreamSummary
+
+pytestmark = pytest.mark.anyio
+
+
+class Upstream:
+    """Factory for an upstream stream that sends one chunk per allowed step and records how it was used"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.permits = asyncio.Queue()
+        self.opened = 0
+        self.closed = False
+        self.cancelled = False
+
+    def allow(self, steps: int = 1) -> None:
+        for _ in range(steps):
+            self.permits.put_nowait(None)
+
+    def __call__(self, summary: StreamSummary):
+        self.opened += 1
+        return self.stream(summary)
+
+    async def stream(self, summary: StreamSummary):
+        try:
+            for chunk in self.chunks:
+                await self.permits.get()
+                yield chunk
+            summary.finish_reason = "stop"
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        finally:
+            self.closed = True
+
+
+async def collect(stream, into: list = None) -> list:
+    chunks = [] if into is None else into
+    async for chunk in stream:
+        chunks.append(chunk)
+    return chunks
+
+
+def start(coroutine) -> asyncio.Task:
+    return asyncio.get_running_loop().create_task(coroutine)
+
+
+async def settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def test_identical_requests_share_one_upstream():
+    flight = SingleFlight()
+    upstream = Upstream(["a", "b", "c"])
+    summaries = [StreamSummary(), StreamSummary()]
+    readers = [start(collect(flight.stream("k", upstream, summary))) for summary in summaries]
+    await settle()
+    upstream.allow(3)
+
+    assert await asyncio.gather(*readers) == [["a", "b", "c"], ["a", "b", "c"]]
+    assert upstream.opened == 1
+    assert [summary.finish_reason for summary in summaries] == ["stop", "stop"]
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "followers": 1, "lagged": 0}
+
+
+async def test_late_joiner_replays_the_log():
+    flight = SingleFlight()
+    upstream = Upstream(["a", "b"])
+    first = flight.stream("k", upstream)
+    upstream.allow()
+    assert await first.__anext__() == "a"
+
+    second = flight.stream("k", upstream)
+    assert await second.__anext__() == "a"
+    upstream.allow()
+    assert await collect(second) == ["b"]
+    assert await collect(first) == ["b"]
+    assert upstream.opened == 1
+
+
+async def test_upstream_is_cancelled_when_every_subscriber_leaves():
+    flight = SingleFlight()
+    upstream = Upstream(["a", "b", "c"])
+    streams = [flight.stream("k", upstream), flight.stream("k", upstream)]
+    upstream.allow()
+    for stream in streams:
+        assert await stream.__anext__() == "a"
+
+    await streams[0].aclose()
+    await settle()
+    assert not upstream.closed
+    await streams[1].aclose()
+    await settle()
+    assert upstream.cancelled and upstream.closed
+    assert flight.stats()["in_flight"] == 0
+
+
+async def test_errors_reach_every_subscriber():
+    flight = SingleFlight()
+
+    def failing(summary: StreamSummary):
+        async def stream():
+            yield "a"
+            raise RuntimeError("upstream failed")
+        return stream()
+
+    results = await asyncio.gather(collect(flight.stream("k", failing)), collect(flight.stream("k", failing)),
+                                   return_exceptions=True)
+    assert [str(result) for result in results] == ["upstream failed", "upstream failed"]
+
+
+async def test_lagging_subscriber_is_detached():
+    flight = SingleFlight(max_bytes=4, max_lag_bytes=4)
+    upstream = Upstream(["ab", "cd", "ef", "gh", "ij"])
+    slow = flight.stream("k", upstream)
+    upstream.allow()
+    assert await slow.__anext__() == "ab"
+
+    fast = []
+    reader = start(collect(flight.stream("k", upstream), fast))
+    await settle()
+    for read in range(2, 6):
+        upstream.allow()
+        while len(fast) < read:
+            await asyncio.sleep(0)
+    await reader
+    assert fast == ["ab", "cd", "ef", "gh", "ij"]
+    with pytest.raises(SubscriberLagged):
+        await collect(slow)
+    assert flight.stats()["lagged"] == 1
+
+
+def test_flights_are_scoped_per_usage_scope():
+    messages = [{"role": "user", "content": "hi"}]
+    alice = SingleFlight.key_for("sk-shared", "gpt-4o-mini", messages, {"temperature": 0}, (1, 0))
+    bob = SingleFlight.key_for("sk-shared", "gpt-4o-mini", messages, {"temperature": 0}, (2, 0))
+    assert alice != bob
+    assert alice == SingleFlight.key_for("sk-shared", "gpt-4o-mini", messages, {"temperature": 0}, (1, 0))
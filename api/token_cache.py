@@ -0,0 +1,75 @@
+# Verified-token cache and revocation list for the JWT fast path
+import os
+import threading
+import time
+from typing import Dict, Optional
+from cache import TTLCache
+from shared_state import SharedState, shared_state
+
+# Token cache configuration; entries never outlive the token's exp claim
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300"))
+
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS)
+
+
+def get_cached_claims(token: str) -> Optional[dict]:
+    """Return the claims of a token verified earlier, if still cached"""
+    return token_cache.get(token)
+
+
+def cache_claims(token: str, claims: dict) -> None:
+    """Cache verified claims until the token expires (or the cache TTL, if sooner)"""
+    remaining = claims.get("exp", 0) - time.time()
+    if remaining > 0:
+        token_cache.set(token, claims, ttl=min(remaining, TOKEN_CACHE_TTL_SECONDS))
+
+
+class RevocationList:
+    """Revoked token ids (jti), kept until their token would have expired
+
+    Each revocation is stored in the shared state as a key per jti whose TTL
+    is the token's remaining lifetime, so with a cross-process backend every
+    worker (and a restarted one) rejects it. Ids revoked by this process are
+    also kept in a local dict that answers with one lookup; its expired
+    entries are purged whenever it has doubled since the last purge.
+    """
+
+    def __init__(self, state: SharedState = shared_state):
+        self.state = state
+        self._revoked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._purge_at = 1024
+        self.revocations = 0
+
+    async def revoke(self, jti: str, expires_at: float) -> bool:
+        """Revoke a token id; False when it was already revoked, here or by another worker"""
+        with self._lock:
+            revoked = jti not in self._revoked
+            self._revoked[jti] = expires_at
+            if revoked:
+                self.revocations += 1
+            if len(self._revoked) >= self._purge_at:
+                now = time.time()
+                self._revoked = {key: exp for key, exp in self._revoked.items() if exp > now}
+                self._purge_at = max(1024, 2 * len(self._revoked))
+        remaining = expires_at - time.time()
+        if self.state.cross_process and remaining > 0:
+            # The first worker to count the key revoked it, so a refresh token
+            # raced to two workers is still only accepted once
+            revoked = await self.state.incr(f"revoked:{jti}", 1, remaining) == 1 and revoked
+        return revoked
+
+    async def is_revoked(self, jti: Optional[str]) -> bool:
+        if jti is None:
+            return False
+        if jti in self._revoked:
+            return True
+        return self.state.cross_process and await self.state.get_count(f"revoked:{jti}") > 0
+
+    def stats(self) -> dict:
+        return {"size": len(self._revoked), "revocations": self.revocations, "shared": self.state.cross_process}
+
+
+# Shared revocation list consulted on every token verification
+revoked_tokens = RevocationList()
@@ -0,0 +1,53 @@
+# Token counting and per-model context budgets
+import os
+from functools import lru_cache
+from typing import Dict, List
+
+# Context window sizes (tokens); unknown models get DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_TOKENS = int(os.getenv("DEFAULT_CONTEXT_TOKENS", "8192"))
+# Tokens kept free for the model's answer
+CONTEXT_RESPONSE_RESERVE = int(os.getenv("CONTEXT_RESPONSE_RESERVE", "4096"))
+# Optional cap on prompt size regardless of the model window (0 = model window only)
+CONTEXT_MAX_PROMPT_TOKENS = int(os.getenv("CONTEXT_MAX_PROMPT_TOKENS", "16000"))
+# Fixed per-message overhead of the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=16)
+def _encoding(model: str):
+    """tiktoken encoding for a model, or None when tiktoken is not installed"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Count tokens in text, estimating ~4 characters per token without tiktoken"""
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str) -> int:
+    return sum(count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def prompt_budget(model: str) -> int:
+    """Tokens available for the prompt of a request to model"""
+    budget = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - CONTEXT_RESPONSE_RESERVE
+    if CONTEXT_MAX_PROMPT_TOKENS:
+        budget = min(budget, CONTEXT_MAX_PROMPT_TOKENS)
+    return max(budget, 0)
@@ -0,0 +1,211 @@
+# In-memory token/latency accounting flushed to hourly rollups
+import asyncio
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy import and_, func, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from database import SessionLocal
+from models import UsageRollup
+
+# Seconds between flushes of aggregated usage
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "10"))
+
+# USD per million (prompt, completion) tokens, used for cost estimates
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+}
+
+# Counter positions in an aggregate
+REQUESTS, CACHED, PROMPT, COMPLETION, DURATION_MS = range(5)
+COUNTER_COLUMNS = ("requests", "cached_requests", "prompt_tokens", "completion_tokens", "duration_ms")
+
+
+class UsageScope(NamedTuple):
+    """Who a request is billed to; 0 means anonymous user / shared default key"""
+    user_id: int
+    api_key_id: int
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+
+def period_start(when: datetime) -> datetime:
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+class UsageAccumulator:
+    """Aggregates per-request usage in memory and upserts hourly rollups in batches
+
+    Each finished stream adds to a counter keyed by (user, key, model, hour), so
+    the DB sees one row write per active bucket per flush instead of one per
+    request, and /api/usage reads small pre-aggregated rows.
+    """
+
+    def __init__(self, flush_seconds: float = USAGE_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self._pending: Dict[Tuple[int, int, str, datetime], List[int]] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.estimated = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def record(self, scope: UsageScope, model: str, prompt_tokens: int, completion_tokens: int,
+               duration: float, cached: bool = False, estimated: bool = False) -> None:
+        """Add one finished request to its bucket"""
+        key = (scope.user_id, scope.api_key_id, model, period_start(datetime.utcnow()))
+        with self._lock:
+            counters = self._pending.get(key)
+            if counters is None:
+                counters = self._pending[key] = [0, 0, 0, 0, 0]
+            counters[REQUESTS] += 1
+            counters[CACHED] += int(cached)
+            counters[PROMPT] += prompt_tokens
+            counters[COMPLETION] += completion_tokens
+            counters[DURATION_MS] += int(duration * 1000)
+            self.recorded += 1
+            self.estimated += int(estimated)
+
+    def pending_for_user(self, user_id: int, since: datetime) -> Dict[Tuple[int, str], List[int]]:
+        """Unflushed counters for a user, keyed by (api_key_id, model)"""
+        totals: Dict[Tuple[int, str], List[int]] = {}
+        with self._lock:
+            for (bucket_user, api_key_id, model, start), counters in self._pending.items():
+                if bucket_user != user_id or start < period_start(since):
+                    continue
+                total = totals.setdefault((api_key_id, model), [0, 0, 0, 0, 0])
+                for i, value in enumerate(counters):
+                    total[i] += value
+        return totals
+
+    def _merge(self, batch: Dict[Tuple[int, int, str, datetime], List[int]]) -> None:
+        with self._lock:
+            for key, counters in batch.items():
+                pending = self._pending.setdefault(key, [0, 0, 0, 0, 0])
+                for i, value in enumerate(counters):
+                    pending[i] += value
+
+    def _upsert(self, db: Session, key: Tuple[int, int, str, datetime], counters: List[int]) -> None:
+        user_id, api_key_id, model, start = key
+        table = UsageRollup.__table__
+        bucket = and_(
+            table.c.user_id == user_id,
+            table.c.period_start == start,
+            table.c.api_key_id == api_key_id,
+            table.c.model == model,
+        )
+        increments = {name: table.c[name] + counters[i] for i, name in enumerate(COUNTER_COLUMNS)}
+        if db.execute(update(table).where(bucket).values(**increments)).rowcount:
+            return
+        db.execute(table.insert().values(
+            user_id=user_id, api_key_id=api_key_id, model=model, period_start=start,
+            **{name: counters[i] for i, name in enumerate(COUNTER_COLUMNS)}
+        ))
+
+    def flush(self) -> int:
+        """Upsert all aggregated buckets in one transaction"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        db = SessionLocal()
+        try:
+            for key, counters in batch.items():
+                self._upsert(db, key, counters)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error flushing usage rollups: {e}")
+            # Put the batch back so the next flush retries it; a bucket inserted
+            # concurrently by another worker becomes an update next time
+            self._merge(batch)
+            return 0
+        finally:
+            db.close()
+        self.flushes += 1
+        self.rows_written += len(batch)
+        return len(batch)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await run_in_threadpool(self.flush)
+
+    def start(self) -> None:
+        """Start the periodic flush task on the running event loop"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the periodic task and write whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await run_in_threadpool(self.flush)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending_buckets": pending,
+            "recorded": self.recorded,
+            "estimated": self.estimated,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
+
+
+def usage_summary(db: Session, user_id: int, days: int) -> dict:
+    """Per key/model totals for a user over the last days, including unflushed usage"""
+    since = datetime.utcnow() - timedelta(days=days)
+    table = UsageRollup.__table__
+    rows = db.execute(
+        table.select()
+        .with_only_columns(table.c.api_key_id, table.c.model, *[func.sum(table.c[name]) for name in COUNTER_COLUMNS])
+        .where(table.c.user_id == user_id, table.c.period_start >= period_start(since))
+        .group_by(table.c.api_key_id, table.c.model)
+    ).all()
+    totals = {(row[0], row[1]): [int(value or 0) for value in row[2:]] for row in rows}
+    for key, counters in usage_accumulator.pending_for_user(user_id, since).items():
+        total = totals.setdefault(key, [0, 0, 0, 0, 0])
+        for i, value in enumerate(counters):
+            total[i] += value
+
+    breakdown = []
+    for (api_key_id, model), counters in sorted(totals.items(), key=lambda item: (item[0][1], item[0][0])):
+        breakdown.append({
+            "api_key_id": api_key_id or None,
+            "model": model,
+            "requests": counters[REQUESTS],
+            "cached_requests": counters[CACHED],
+            "prompt_tokens": counters[PROMPT],
+            "completion_tokens": counters[COMPLETION],
+            "avg_duration_ms": counters[DURATION_MS] // counters[REQUESTS] if counters[REQUESTS] else 0,
+            "estimated_cost_usd": round(estimate_cost(model, counters[PROMPT], counters[COMPLETION]), 6),
+        })
+    return {
+        "since": since,
+        "requests": sum(entry["requests"] for entry in breakdown),
+        "prompt_tokens": sum(entry["prompt_tokens"] for entry in breakdown),
+        "completion_tokens": sum(entry["completion_tokens"] for entry in breakdown),
+        "estimated_cost_usd": round(sum(entry["estimated_cost_usd"] for entry in breakdown), 6),
+        "breakdown": breakdown,
+    }
+
+
+# Shared accumulator fed by the streaming engine
+usage_accumulator = UsageAccumulator()
@@ -0,0 +1,46 @@
+# In-process cache of authenticated users keyed by token subject
+import os
+from typing import NamedTuple, Optional
+from sqlalchemy import event, inspect
+from cache import TTLCache
+from models import User
+
+# User cache configuration
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+
+
+class CachedUser(NamedTuple):
+    """Lightweight snapshot of the fields authenticated endpoints need"""
+    id: int
+    username: str
+    is_active: bool
+
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+
+
+def get_cached_user(username: str) -> Optional[CachedUser]:
+    """Return the cached snapshot for a token subject, if any"""
+    return user_cache.get(username)
+
+
+def cache_user(user: User) -> CachedUser:
+    """Snapshot a user row and cache it under its username"""
+    snapshot = CachedUser(id=user.id, username=user.username, is_active=bool(user.is_active))
+    user_cache.set(user.username, snapshot)
+    return snapshot
+
+
+def invalidate_user(username: str) -> None:
+    """Drop a user's snapshot so the next request reloads it"""
+    user_cache.pop(username)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_changed_user(mapper, connection, target: User) -> None:
+    # Invalidate both the current and any previous username of a changed row
+    invalidate_user(target.username)
+    for old_username in inspect(target).attrs.username.history.deleted:
+        invalidate_user(old_username)